@@ -24,11 +24,25 @@
 # *
 # **************************************************************************
 
+import atexit
 import pwem
 import os
+import shlex
+import sys
+import tempfile
+import threading
 from pyworkflow.utils import Environ
 from deepdewedge.constants import DEEPDEWEDGE_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD, DEEPDEWEDGE_ENV_NAME, \
-    DEEPDEWEDGE_DEFAULT_VERSION, DEEPDEWEDGE_HOME, DEEPDEWEDGE_CUDA_LIB, DEEPDEWEDGE
+    DEEPDEWEDGE_DEFAULT_VERSION, DEEPDEWEDGE_HOME, DEEPDEWEDGE_CUDA_LIB, DEEPDEWEDGE, \
+    DEEPDEWEDGE_CLI, DEEPDEWEDGE_CACHE_DIR, DEEPDEWEDGE_CACHE_SIZE, DEFAULT_CACHE_SIZE
+from deepdewedge import utils
+
+MONITOR_SCRIPT = os.path.join(os.path.dirname(__file__), 'utils', 'monitor.py')
+WORKER_LOG = 'ddw_worker.log'
+
+# Warm workers started by this process, by protocol working dir
+_workers = {}
+_workersLock = threading.Lock()
 
 _logo = "icon.png"
 _references = ['Wiedemann2024']
@@ -44,11 +58,23 @@ class Plugin(pwem.Plugin):
         # DEEPDEWEDGE does NOT need EmVar because it uses a conda environment.
         cls._defineVar(DEEPDEWEDGE_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
         cls._defineVar(DEEPDEWEDGE_CUDA_LIB, pwem.Config.CUDA_LIB)
+        # Empty cache dir means a cache inside each project
+        cls._defineVar(DEEPDEWEDGE_CACHE_DIR, '')
+        cls._defineVar(DEEPDEWEDGE_CACHE_SIZE, DEFAULT_CACHE_SIZE)
 
     @classmethod
     def getDeepdewedgeEnvActivation(cls):
         return cls.getVar(DEEPDEWEDGE_ENV_ACTIVATION)
 
+    @classmethod
+    def getCacheDir(cls):
+        return cls.getVar(DEEPDEWEDGE_CACHE_DIR)
+
+    @classmethod
+    def getCacheMaxBytes(cls):
+        """ Size limit of the subtomogram cache, configured in GB. """
+        return int(float(cls.getVar(DEEPDEWEDGE_CACHE_SIZE)) * 1024 ** 3)
+
     @classmethod
     def getEnviron(cls, gpuId='0'):
         """ Setup the environment variables needed to launch deepdewedge. """
@@ -110,9 +136,101 @@ class Plugin(pwem.Plugin):
         return neededProgs
 
     @classmethod
-    def runDeepdewedge(cls, protocol, program, args, cwd=None, gpuId='0'):
-        """ Run Deepdewedge command from a given protocol. """
-        fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
-                                       cls.getDeepdewedgeEnvActivation(),
-                                       program)
-        protocol.runJob(fullProgram, args, env=cls.getEnviron(gpuId=gpuId), cwd=cwd, numberOfMpi=1)
+    def getProgram(cls, program):
+        """ Return the deepdewedge command line for a given subcommand. """
+        return '%s %s' % (DEEPDEWEDGE_CLI, program)
+
+    @classmethod
+    def getStepGpu(cls, protocol):
+        """ Device the step executor gave to the running step, the first of
+        the protocol GPU list, which the executor fills per step. """
+        gpuList = protocol.getGpuList() if hasattr(protocol, 'getGpuList') else []
+        return str(gpuList[0]) if gpuList else '0'
+
+    @classmethod
+    def getMonitoredCommand(cls, program, args, metricsFile):
+        """ Wrap a command with the monitor script, which saves its metrics to
+        metricsFile and its output, with line times, next to it. """
+        fnLog = os.path.splitext(metricsFile)[0] + '.log'
+        monitor = '%s %s %s %s --' % (sys.executable, MONITOR_SCRIPT, metricsFile, fnLog)
+        return monitor, shlex.quote('%s %s' % (program, args))
+
+    @classmethod
+    def getWorker(cls, protocol):
+        """ Warm worker of a protocol run, started on first use inside the
+        deepdewedge environment. None if it could not be started, so the
+        jobs fall back to a new process each. """
+        key = os.path.abspath(protocol.getWorkingDir())
+        with _workersLock:
+            if key not in _workers:
+                socketPath = utils.getSocketPath(key)
+                launchCmd = '%s %s && exec python %s %s --preload torch --parent-pid %d' % (
+                    cls.getCondaActivationCmd(), cls.getDeepdewedgeEnvActivation(),
+                    utils.WORKER_SCRIPT, socketPath, os.getpid())
+                client = utils.startWorker(launchCmd, socketPath, env=cls.getEnviron(gpuId=''),
+                                           fnLog=protocol._getLogsPath(WORKER_LOG))
+                if client is None:
+                    protocol.warning('The deepdewedge worker could not be started, '
+                                     'every job will start its own process.')
+                else:
+                    atexit.register(client.shutdown)
+                _workers[key] = client
+            return _workers[key]
+
+    @classmethod
+    def dropWorker(cls, protocol, worker):
+        """ Forget a worker that stopped answering, so the next job starts
+        a new one. """
+        key = os.path.abspath(protocol.getWorkingDir())
+        with _workersLock:
+            if _workers.get(key) is worker:
+                del _workers[key]
+
+    @classmethod
+    def runInWorker(cls, worker, protocol, program, args, cwd=None, gpuId='', metricsFile=None):
+        """ Run a job in the warm worker and copy its output to the run log. """
+        argv = shlex.split(program)[1:] + shlex.split(args)
+        if metricsFile:
+            fnLog = os.path.splitext(metricsFile)[0] + '.log'
+        else:
+            fd, fnLog = tempfile.mkstemp(suffix='.log', dir=protocol._getTmpPath())
+            os.close(fd)
+        code = worker.run(argv, os.path.abspath(fnLog), cwd=os.path.abspath(cwd or os.getcwd()),
+                          env={'CUDA_VISIBLE_DEVICES': gpuId},
+                          fnMetrics=os.path.abspath(metricsFile) if metricsFile else None)
+        with open(fnLog) as f:
+            for line in f:
+                sys.stdout.write(line.split('\t', 1)[-1])
+        sys.stdout.flush()
+        if code != 0:
+            raise Exception('%s %s failed with exit code %d' % (program, args, code))
+
+    @classmethod
+    def runDeepdewedge(cls, protocol, program, args, cwd=None, gpuId=None, metricsFile=None):
+        """ Run Deepdewedge command from a given protocol. If no gpuId is
+        given, the command runs on the device the step executor booked for
+        the running step. If metricsFile is given, the wall time,
+        peak memory and I/O of the command are recorded there. If the protocol
+        enables the warm worker, the job runs there instead of a new process,
+        unless the worker does not answer. """
+        useWorker = getattr(protocol, 'useWarmWorker', None)
+        worker = cls.getWorker(protocol) if useWorker is not None and useWorker.get() else None
+
+        def run(gpu):
+            if worker is not None:
+                try:
+                    cls.runInWorker(worker, protocol, program, args, cwd, gpu, metricsFile)
+                    return
+                except (OSError, ValueError) as e:
+                    cls.dropWorker(protocol, worker)
+                    protocol.warning('The deepdewedge worker failed (%s), the job is run '
+                                     'in its own process.' % e)
+            fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
+                                           cls.getDeepdewedgeEnvActivation(),
+                                           program)
+            fullArgs = args
+            if metricsFile:
+                fullProgram, fullArgs = cls.getMonitoredCommand(fullProgram, args, metricsFile)
+            protocol.runJob(fullProgram, fullArgs, env=cls.getEnviron(gpuId=gpu), cwd=cwd, numberOfMpi=1)
+
+        run(cls.getStepGpu(protocol) if gpuId is None else gpuId)
@@ -30,6 +30,7 @@ V0_2_2 = '0.2.2'
 V0_3_0 = '0.3.0'
 DEEPDEWEDGE_DEFAULT_VERSION = V0_3_0
 DEEPDEWEDGE = 'deepdewedge'
+DEEPDEWEDGE_CLI = 'ddw'
 DEEPDEWEDGE_ENV_NAME = '%s-%s' % (DEEPDEWEDGE, DEEPDEWEDGE_DEFAULT_VERSION)
 DEEPDEWEDGE_ENV_ACTIVATION = 'DEEPDEWEDGE_ENV_ACTIVATION'
 DEFAULT_ACTIVATION_CMD = 'conda activate %s' % DEEPDEWEDGE_ENV_NAME
@@ -43,3 +44,29 @@ TRAIN_DATA_CONFIG = 'training_data_config'
 DEEPDEWEDGE_MODEL = 'deepdewedge_model'
 DEEPDEWEDGE_MODEL_TGZ = DEEPDEWEDGE_MODEL + '.tar.gz'
 PREDICT_CONFIG = 'predict_config'
+SUBTOMO_STORE_DIR = 'subtomo_store'
+MASK_SCREENING_FN = 'mask_screening.json'
+MASK_POSITIONS_FN = 'mask_positions.npz'
+METRICS_DIR = 'metrics'
+METRICS_FN = 'metrics.json'
+EARLY_STOP_FN = 'early_stop.json'
+AUTOTUNE_FN = 'autotune.json'
+PREPARE_DONE_FN = 'prepare.done'
+FIT_DONE_FN = 'fit.done'
+PRECISION_FN = 'precision.json'
+SUBTOMO_PRECISION_FN = 'subtomo_precision.json'
+SELECTION_FN = 'subtomo_selection.json'
+REFINED_DIR = 'refined'
+JOINT_MODEL = 'joint'
+PREVIEW_MODEL = 'preview'
+BEST_MODEL = 'best'
+SWEEP_FN = 'sweep.json'
+BINNED_DIR = 'binned'
+
+# Subtomogram extraction cache
+DEEPDEWEDGE_CACHE_DIR = 'DEEPDEWEDGE_CACHE_DIR'
+DEEPDEWEDGE_CACHE_SIZE = 'DEEPDEWEDGE_CACHE_SIZE'  # In GB
+DEFAULT_CACHE_SIZE = 50
+SUBTOMO_CACHE_DIR = 'deepdewedge_cache'
+CACHE_STATUS_FN = 'subtomo_cache.json'
+NORM_STATS_DIR = 'normalization_stats'
@@ -3,4 +3,6 @@
 # Module to declare protocols
 # Find documentation here: https://scipion-em.github.io/docs/docs/developer/creating-a-protocol
 # **************************************************************************
-from .protocol_hello_world import MyPluginPrefixHelloWorld
+from .protocol_deepDeWedge import DeepDeWedgeDenoising
+from .protocol_deepDeWedge_apply import DeepDeWedgeApplyModel
+from .protocol_deepDeWedge_sweep import DeepDeWedgeSweep
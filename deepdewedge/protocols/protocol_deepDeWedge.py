@@ -25,19 +25,68 @@
 # *
 # **************************************************************************
 
+import glob
+import json
+import os
+import re
+import shlex
+import shutil
+import threading
+
 from pyworkflow.constants import BETA
-from pyworkflow.protocol import params
-from pyworkflow.utils import Message
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.utils import Message, makePath, cleanPath
 from pyworkflow.object import Integer
 
 from pwem.protocols import EMProtocol
+from tomo.objects import SetOfTomograms
 
 from deepdewedge import Plugin
+from deepdewedge.constants import TRAIN_DATA_DIR, DEEPDEWEDGE_MODEL, REFINED_DIR, JOINT_MODEL, \
+    SUBTOMO_CACHE_DIR, CACHE_STATUS_FN, SUBTOMO_STORE_DIR, TRAIN_DATA_FN, VALIDATION_DATA_FN, MEAN_STD_FN, \
+    MASK_SCREENING_FN, MASK_POSITIONS_FN, METRICS_DIR, METRICS_FN, EARLY_STOP_FN, AUTOTUNE_FN, \
+    NORM_STATS_DIR, PREVIEW_MODEL, BINNED_DIR, PREPARE_DONE_FN, FIT_DONE_FN, \
+    PRECISION_FN, SUBTOMO_PRECISION_FN, SELECTION_FN
+from deepdewedge import utils
 
 PROGRAM_PREPARE_STAR = 'prepare_data'
 PROGRAM_FIT_MODEL = 'fit-model'
 PROGRAM_REFINE_MODEL = 'refine-tomogram'
 
+OUTPUT_TOMOS = 'Tomograms'
+OUTPUT_PREVIEW = 'PreviewTomograms'
+TILES_PER_CALL = 8
+EARLY_STOP_POLL_SECONDS = 10
+MIN_PREVIEW_BOXSIZE = 32
+# Subtomogram selection modes
+SELECT_BEST = 0
+SELECT_PER_TOMO = 1
+
+
+def _getStem(fn):
+    return os.path.splitext(os.path.basename(fn))[0]
+
+
+def _findRefined(refinedDir, fnTomo0):
+    """ Refined tomogram of a given tomo0 file, named <tomo0 stem>_refined.mrc,
+    or None if it does not exist. """
+    fnRefined = os.path.join(refinedDir, '%s_refined.mrc' % _getStem(fnTomo0))
+    return fnRefined if os.path.exists(fnRefined) else None
+
+
+def _ckptEpoch(fnCkpt):
+    """ Read the epoch from a checkpoint name such as 'epoch=9-val_loss=0.12345.ckpt'. """
+    match = re.search(r'epoch=(\d+)', _getStem(fnCkpt))
+    return int(match.group(1)) if match else -1
+
+
+def _ckptValLoss(fnCkpt):
+    """ Read the validation loss from a checkpoint name such as
+    'epoch=9-val_loss=0.12345.ckpt'. """
+    match = re.search(r'val_loss=([0-9.eE+-]+)', _getStem(fnCkpt))
+    return float(match.group(1)) if match else float('inf')
+
+
 class DeepDeWedgeDenoising(EMProtocol):
     """
     This protocol will print hello world in the console
@@ -45,7 +94,9 @@ class DeepDeWedgeDenoising(EMProtocol):
     """
     _label = 'deepDeWedge denoising'
     _devStatus = BETA
-    tomoList = []
+    _possibleOutputs = {OUTPUT_TOMOS: SetOfTomograms,
+                        OUTPUT_PREVIEW: SetOfTomograms}
+    stepsExecutionMode = STEPS_PARALLEL
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -53,6 +104,60 @@ class DeepDeWedgeDenoising(EMProtocol):
         Params:
             form: this is the form to be populated with sections and params.
         """
+        self._defineInputParams(form)
+        self._defineExtractionParams(form)
+
+        group = form.addGroup('Model Fit')
+        group.addParam('jointFit', params.BooleanParam,
+              label='Fit a single model for all tomograms?',
+              default = False,
+              help='If yes, the subtomograms of all the tomograms are extracted '
+                   'together and one shared model is fitted and used to refine '
+                   'every tomogram. Recommended for tomograms of the same sample, '
+                   'as fitting is by far the most expensive stage. If no, a '
+                   'model is fitted for each tomogram.')
+        group.addParam('refineBatch', params.IntParam,
+              label='Tomograms per refine job',
+              default = 4,
+              condition='jointFit',
+              expertLevel=params.LEVEL_ADVANCED,
+              help='Number of tomograms refined by each refine-tomogram call '
+                   'when a single model is fitted.')
+        self._defineFitParams(group)
+
+        group = form.addGroup('Preview')
+        group.addParam('previewMode', params.BooleanParam,
+              label='Run a binned preview?',
+              default = False,
+              help='If yes, the half maps are first binned, a model is fitted '
+                   'for a few epochs on all of them and they are refined, which '
+                   'takes minutes instead of hours. The result is registered as '
+                   'a separate output as soon as it is ready, to check if '
+                   'deepDeWedge helps on the data. The subtomo size, strides '
+                   'and overlap are divided by the binning factor, the subtomo '
+                   'size is reduced to fit in the binned tomograms if needed, '
+                   'and the masks are not used.')
+        group.addParam('previewBinning', params.IntParam,
+              label='Binning factor',
+              default = 4,
+              condition='previewMode',
+              help='The half maps are downsampled by averaging blocks of this '
+                   'number of voxels along each axis.')
+        group.addParam('previewEpochs', params.IntParam,
+              label='Number of epochs',
+              default = 5,
+              condition='previewMode',
+              help='Number of epochs of the preview fit.')
+        group.addParam('previewOnly', params.BooleanParam,
+              label='Only run the preview?',
+              default = False,
+              condition='previewMode',
+              help='If yes, the full resolution fit and refinement are skipped.')
+
+        self._defineRefineParams(form)
+
+    def _defineInputParams(self, form):
+        """ Input section with the tomograms and their odd/even half maps. """
         # You need a params to belong to a section:
         form.addSection(label=Message.LABEL_INPUT)
         form.addParam('oddEvenImported', params.BooleanParam,
@@ -60,12 +165,14 @@ class DeepDeWedgeDenoising(EMProtocol):
                       label="Are odd-even associated to the Tomograms?")
 
         form.addParam('inputTomograms', params.PointerParam,
+                      pointerClass='SetOfTomograms',
                       condition='oddEvenImported == False',
-                      label="Are odd-even associated to the Tomograms?")
+                      label="Tomograms",
+                      help='Set of tomograms with their odd/even half maps associated.')
 
         form.addParam('evenTomos', params.PointerParam,
                       pointerClass='SetOfTomograms',
-                      condition='not areEvenOddLinked',
+                      condition='oddEvenImported',
                       label='Even tomograms',
                       allowsNull=True,
                       important=True,
@@ -73,13 +180,15 @@ class DeepDeWedgeDenoising(EMProtocol):
                            'series movies.')
         form.addParam('oddTomos', params.PointerParam,
                       pointerClass='SetOfTomograms',
-                      condition='not areEvenOddLinked',
+                      condition='oddEvenImported',
                       label='Odd tomograms',
                       allowsNull=True,
                       important=True,
                       help='Set of tomogram reconstructed from the odd frames of the tilt'
                            'series movies.')
 
+    def _defineExtractionParams(self, form):
+        """ Masks and subtomogram extraction params. """
         form.addParam('inputTomoMasks', params.PointerParam, pointerClass='SetOfTomoMasks',
                       allowsNull=True,
                       label="Mask (Optional)",
@@ -111,6 +220,60 @@ class DeepDeWedgeDenoising(EMProtocol):
                            'parameter has to be provided as well. If no mask_files are '
                            'provided, this parameter is ignored')
 
+        form.addParam('roiRefine', params.BooleanParam,
+                      label='Refine only inside the masks?',
+                      default=False,
+                      help='If yes, only the bounding box of the mask of each tomogram, '
+                           'grown by the padding, is cropped, refined and pasted back '
+                           'into a full size tomogram filled with the mean of the half '
+                           'maps. For thin lamellae most of the volume is skipped. '
+                           'Tomograms without a mask are refined whole.')
+        form.addParam('roiPadding', params.IntParam,
+                      label='Mask padding (voxels)',
+                      default=32,
+                      condition='roiRefine',
+                      help='Voxels added on every side of the mask bounding box.')
+
+        form.addParam('useSubtomoCache', params.BooleanParam,
+                      label='Reuse previous extractions?',
+                      default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, the extracted subtomograms are stored in a cache '
+                           'shared by the protocols of the project. A later run with the '
+                           'same tomograms, masks, subtomo size, strides, validation '
+                           'fraction and mask fraction links the cached extraction '
+                           'instead of extracting again.')
+
+        form.addParam('extractInPlugin', params.BooleanParam,
+                      label='Extract subtomograms in the plugin?',
+                      default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, the subtomograms are extracted by the plugin into '
+                           'chunked memory mapped files and then exported for fitting. '
+                           'The memory used does not grow with the number of '
+                           'subtomograms, which allows small strides on large datasets.')
+        form.addParam('maxSubtomos', params.IntParam,
+                      label='Maximum number of subtomograms',
+                      default=0,
+                      condition='extractInPlugin',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If larger than 0 and there are more candidate subtomograms, '
+                           'only this number of them is extracted, which bounds the time '
+                           'of each fitting epoch. The candidates are scored by the '
+                           'variance of the binned tomogram inside them, times their mask '
+                           'coverage if masks are used, and chosen greedily, lowering the '
+                           'score of the candidates overlapping the ones already chosen.')
+        form.addParam('subtomoSelection', params.EnumParam,
+                      label='Selection',
+                      choices=['Best scores', 'Per tomogram'],
+                      default=SELECT_BEST,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      condition='extractInPlugin and maxSubtomos > 0',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Best scores: the best candidates of all the tomograms. '
+                           'Per tomogram: every tomogram gets a share of the maximum '
+                           'proportional to its number of candidates.')
+
         line = form.addLine('Subtomo Extraction strides',
                              help="List of 3 integers specifying the 3D Strides used for subtomogram extraction."
                                   " If set to None, stride 'subtomo_size' is used in all 3 directions."
@@ -121,13 +284,44 @@ class DeepDeWedgeDenoising(EMProtocol):
         line.addParam('strideZ', params.IntParam, allowsNull=True, label='Step',
                       expertLevel=params.LEVEL_ADVANCED)
 
-        group = form.addGroup('Model Fit')
-        group.addParam('epochs', params.IntegerParam,
+    def _defineFitParams(self, group):
+        """ Model fitting params, added to the given group. """
+        group.addParam('epochs', params.IntParam,
               label='Number of epochs',
               default = 1,
               important=True,
-              help='Number of epochs to fit the model.' )
-        group.addParam('batchSize', params.IntegerParam,
+              help='Number of epochs to fit the model. It is the maximum if the '
+                   'fit stops when the validation loss plateaus.' )
+        group.addParam('adaptiveEpochs', params.BooleanParam,
+              label='Stop when the validation loss plateaus?',
+              default = False,
+              help='If yes, the validation loss is followed during fitting and the '
+                   'fit stops once it has not improved for a number of epochs. The '
+                   'number of epochs is then the maximum, and the model with the '
+                   'lowest validation loss is kept.')
+        group.addParam('esPatience', params.IntParam,
+              label='Patience (epochs)',
+              default = 5,
+              condition='adaptiveEpochs',
+              help='Number of epochs without improvement of the validation loss '
+                   'before stopping.')
+        group.addParam('esTolerance', params.FloatParam,
+              label='Relative tolerance',
+              default = 0.01,
+              condition='adaptiveEpochs',
+              expertLevel=params.LEVEL_ADVANCED,
+              help='Minimum relative decrease of the best validation loss that '
+                   'counts as an improvement.')
+        group.addParam('autotune', params.BooleanParam,
+              label='Tune batch size and CPU workers automatically?',
+              default = False,
+              help='If yes, the batch size is the largest one that fits in the free '
+                   'GPU and host memory, estimated from the subtomo size and the '
+                   'U-Net depth, and the number of data loading workers is taken '
+                   'from the CPU cores available to each running job. The chosen '
+                   'values are shown in the summary. If the GPU memory cannot be '
+                   'queried, the batch size is not raised above the given one.')
+        group.addParam('batchSize', params.IntParam,
               label='Batch size',
               default = 1,
               important=True,
@@ -136,21 +330,37 @@ class DeepDeWedgeDenoising(EMProtocol):
               label='Missing Wedge angle (deg)',
               default = -1,
               help='Width of the missing wedge in degrees.' )
-        group.addParam('numworkers', params.IntegerParam,
+        group.addParam('numworkers', params.IntParam,
               label='Number of CPU',
               default = -1,
-              help='Number of CPU workers to use for data loading.'
-                   'If fitting is slow, try increasing this number')
+              help='Number of CPU workers to use for data loading. '
+                   'If fitting is slow, try increasing this number. '
+                   'With -1 the deepdewedge default is used.')
         group.addParam('distributedBackend', params.BooleanParam,
               label='Fit in Multiple GPU?',
               default = True,
               help='Distributed backend to use when fitting on '
                    'multiple GPUs, e.g, nccl (default) or gloo. '
                    'Ignored if fitting on a single GPU. [default: nccl]')
+        group.addParam('unetParams', params.StringParam,
+              label='U-Net params',
+              default = '',
+              expertLevel=params.LEVEL_ADVANCED,
+              help='Dictionary in JSON format with the U-Net params, e.g. '
+                   '{"chans": 64, "num_downsample_layers": 3, "drop_prob": 0.0}. '
+                   'Empty to use the deepdewedge defaults.')
+        group.addParam('adamParams', params.StringParam,
+              label='Adam params',
+              default = '',
+              expertLevel=params.LEVEL_ADVANCED,
+              help='Dictionary in JSON format with the Adam optimizer params, e.g. '
+                   '{"lr": 0.0004}. Empty to use the deepdewedge defaults.')
 
-        group2 = form.addGroup('Refine Tomogram')
-        group2.addParam('recomputeNormalization', params.BooleanParam,
-              label='Fit in Multiple GPU?',
+    def _defineRefineParams(self, form):
+        """ Tomogram refinement, GPU and parallelization params. """
+        group = form.addGroup('Refine Tomogram')
+        group.addParam('recomputeNormalization', params.BooleanParam,
+              label='Recompute normalization?',
               default = True,
               help='Whether to recompute the mean and variance used to normalize '
                    'the tomo0s and tomo1s (see Appendix B in the paper). '
@@ -163,85 +373,1014 @@ class DeepDeWedgeDenoising(EMProtocol):
                    'variances of the tomograms during model fitting are considerably '
                    'different, recomputing the normalization is expected to be '
                    'very beneficial for tomogram refinement.')
+        group.addParam('subtomoOverlap', params.IntParam,
+              label='Subtomo overlap',
+              default = 32,
+              expertLevel=params.LEVEL_ADVANCED,
+              help='Overlap in voxels between the subtomograms the tomograms '
+                   'are split into for refinement.')
+        group.addParam('tiledRefine', params.BooleanParam,
+              label='Refine in tiles?',
+              default = False,
+              help='If yes, every tomogram is split into overlapping tiles that '
+                   'are refined separately and blended into the output, so the '
+                   'memory needed depends on the tile size and not on the '
+                   'tomogram size. Use it for tomograms that do not fit in '
+                   'memory. The tiles overlap by the subtomo overlap. If the '
+                   'normalization is recomputed, the mean and variance of the '
+                   'whole tomogram are used for all its tiles. They are computed '
+                   'in slabs and cached, so refining the same tomogram again '
+                   'does not read it twice.')
+        group.addParam('tileSize', params.IntParam,
+              label='Tile size (voxels)',
+              default = 256,
+              condition='tiledRefine',
+              help='Size of the cubic tiles. It must be larger than the '
+                   'subtomo size.')
+
+        group.addParam('halfPrecision', params.BooleanParam,
+              label='Store intermediate data in half precision?',
+              default = False,
+              expertLevel=params.LEVEL_ADVANCED,
+              help='If yes, the subtomograms extracted in the plugin and the refined '
+                   'tomograms are stored as float16, which halves their size on disk '
+                   'and the data read from it. The conversion error is measured and '
+                   'shown in the summary. Subtomograms or a refined tomogram with '
+                   'values out of the float16 range are kept as float32. The refined '
+                   'tomograms are written as mode 12 MRC files, check that the '
+                   'programs used next can read them.')
+
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution",
+                       help="This protocol has both CPU and GPU implementation. "
+                            "Choose one.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0',
+                       label="Choose GPU IDs",
+                       help="GPUs the fit and refine steps are distributed over. "
+                            "Each running step takes one free GPU and waits "
+                            "when all of them are busy.")
+
+        form.addParam('useWarmWorker', params.BooleanParam,
+                      label='Use a warm deepdewedge worker?',
+                      default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, a single process is started in the deepdewedge '
+                           'environment and runs every prepare, fit and refine job, '
+                           'so the conda activation and the torch import are paid '
+                           'once per run instead of once per job. If the worker '
+                           'cannot be started, each job starts its own process.')
+
+        form.addParallelSection(threads=1, mpi=0)
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        self.tomoList = self._insertFunctionStep(self.createTomoListStep)
+        """ Every fit group (one tomogram, or all of them in joint mode) gets
+        its own prepare -> fit -> refine chain. The chains only depend on
+        createTomoListStep and on their own previous step, so they can be run
+        concurrently by the parallel executor. """
+        listStepId = self._insertFunctionStep(self.createTomoListStep, prerequisites=[],
+                                              needsGPU=False)
+
+        if self._usePreview():
+            self._insertPreviewSteps(listStepId)
+            if self.previewOnly.get():
+                return
 
-        for tom in self.tomoList:
-            self._insertFunctionStep(self.prepareDataForDeepDeWedge, tom)
-            self._insertFunctionStep(self.createOutputStep)
+        refineStepIds = []
+        for fitName, tomos in self._getFitGroups().items():
+            prepareId = self._insertFunctionStep(self.prepareDataForDeepDeWedge, fitName, tomos,
+                                                 prerequisites=[listStepId], needsGPU=False)
+            fitId = self._insertFunctionStep(self.fittingModelStep, fitName,
+                                             prerequisites=[prepareId])
+            for batch in self._getRefineBatches(tomos):
+                refineId = self._insertFunctionStep(self.refineModelStep, fitName, batch,
+                                                    prerequisites=[fitId])
+                refineStepIds.append(refineId)
 
+        self._insertFunctionStep(self.createOutputStep, prerequisites=refineStepIds, needsGPU=False)
+
+    def _insertPreviewSteps(self, listStepId):
+        """ Bin -> prepare -> fit -> refine chain on the binned half maps,
+        inserted first so the preview is ready early. """
+        tomos = self._getPreviewTomos()
+        binId = self._insertFunctionStep(self.binTomogramsStep, prerequisites=[listStepId],
+                                         needsGPU=False)
+        prepareId = self._insertFunctionStep(self.prepareDataForDeepDeWedge, PREVIEW_MODEL, tomos,
+                                             prerequisites=[binId], needsGPU=False)
+        fitId = self._insertFunctionStep(self.fittingModelStep, PREVIEW_MODEL,
+                                         prerequisites=[prepareId])
+        size = max(1, self.refineBatch.get())
+        refineStepIds = [self._insertFunctionStep(self.refineModelStep, PREVIEW_MODEL,
+                                                  tomos[i:i + size], prerequisites=[fitId])
+                         for i in range(0, len(tomos), size)]
+        self._insertFunctionStep(self.createPreviewOutputStep, prerequisites=refineStepIds,
+                                 needsGPU=False)
 
     def createTomoListStep(self):
+        """ Create the working folders of every fit group before the chains start. """
+        makePath(self._getExtraPath(METRICS_DIR))
+        if self._usePreview():
+            makePath(self._getTomoPath(PREVIEW_MODEL, BINNED_DIR))
+        for fitName in self._getFitNames():
+            makePath(self._getTomoPath(fitName),
+                     self._getSubtomoDir(fitName),
+                     self._getFitDir(fitName),
+                     self._getRefinedDir(fitName))
+
+    def binTomogramsStep(self):
+        factor = self.previewBinning.get()
+        for (tsId, fnOdd, fnEven), (_, fnBinOdd, fnBinEven) in zip(self._getTomoList(),
+                                                                   self._getPreviewTomos()):
+            shape = utils.binVolume(fnOdd, fnBinOdd, factor)
+            utils.binVolume(fnEven, fnBinEven, factor)
+            self.info('%s: binned by %d to %s' % (tsId, factor, 'x'.join(map(str, shape[::-1]))))
+        if self._getBoxSize(PREVIEW_MODEL) < 8:
+            raise Exception('The tomograms binned by %d are too small for the preview, use a '
+                            'lower binning factor.' % factor)
+
+    def prepareDataForDeepDeWedge(self, fitName, tomos):
+        """ Extract the subtomograms of a fit group, unless a previous
+        execution of the step finished the extraction and its files, which
+        may link to an evicted cache entry, are still there. """
+        fnDone = self._getTomoPath(fitName, PREPARE_DONE_FN)
+        if os.path.exists(fnDone):
+            if self._hasSubtomos(fitName):
+                self.info('%s: reusing the subtomograms extracted before' % fitName)
+                return
+            self.warning('%s: the subtomograms extracted before are gone, extracting again'
+                         % fitName)
+            cleanPath(fnDone)
+        # Remove what an interrupted extraction left
+        cleanPath(self._getSubtomoDir(fitName))
+        makePath(self._getSubtomoDir(fitName))
+        self._prepareData(fitName, tomos)
+        open(fnDone, 'w').close()
+
+    def _prepareData(self, fitName, tomos):
+        fnOdds = [fnOdd for _, fnOdd, _ in tomos]
+        fnEvens = [fnEven for _, _, fnEven in tomos]
+        if fitName == PREVIEW_MODEL:
+            fnMasks = [None] * len(tomos)
+        else:
+            fnMasks = [self._getMaskFile(tsId) for tsId, _, _ in tomos]
+
+        params  = ' --tomo0_files %s ' % ' '.join(fnOdds)
+        params += ' --tomo1_files %s ' % ' '.join(fnEvens)
+        params += ' --subtomo_size %i ' % self._getBoxSize(fitName)
+        strides = self._getStrides(fitName)
+        if strides:
+            params += ' --subtomo_extraction_strides %i %i %i ' % strides
+        params += ' --val-fraction %f ' % self.validationFraction.get()
+
+        # Masks are only used if every tomogram of the group has one
+        useMasks = all(fnMasks)
+        if useMasks:
+            params += ' --mask_files %s ' % ' '.join(fnMasks)
+            params += ' --min_nonzero_mask_fraction_in_subtomo %f ' % self.minNonZeroMaskSubtomo.get()
+        params += ' --subtomo-dir %s ' % self._getSubtomoDir(fitName)
+
+        if not self.useSubtomoCache.get():
+            maskPositions = self._screenMasks(fitName, tomos) if useMasks else None
+            self._runPrepareData(fitName, tomos, params, maskPositions)
+            return
+
+        cache = self._getSubtomoCache()
+        key = self._getExtractionKey(fitName, fnOdds + fnEvens + [fn for fn in fnMasks if fn],
+                                     useMasks)
+        # The entry stays pinned until the output is created
+        subtomoDir = self._getSubtomoDir(fitName)
+        entryPath = cache.get(key, user=os.path.abspath(subtomoDir))
+        hit = entryPath is not None
+        if hit:
+            self.info('Reusing cached extraction %s' % entryPath)
+            if useMasks:
+                self._reuseMaskScreening(fitName, tomos, entryPath)
+        else:
+            maskPositions = self._screenMasks(fitName, tomos) if useMasks else None
+            self._runPrepareData(fitName, tomos, params, maskPositions)
+            if useMasks:
+                self._saveMaskScreening(fitName, maskPositions)
+            entryPath = cache.put(key, subtomoDir, user=os.path.abspath(subtomoDir))
+        utils.linkEntry(entryPath, subtomoDir)
+
+        with open(self._getTomoPath(fitName, CACHE_STATUS_FN), 'w') as f:
+            json.dump({'key': key, 'hit': hit}, f)
+
+    def fittingModelStep(self, fitName):
+        """ Fit the model of a group. If a previous execution was interrupted,
+        the fit resumes from its latest checkpoint for the remaining epochs. """
+        fnDone = self._getTomoPath(fitName, FIT_DONE_FN)
+        if os.path.exists(fnDone):
+            self.info('%s: the model was already fitted' % fitName)
+            return
+
+        if self.autotune.get():
+            self._autotune(fitName)
+
+        numEpochs = self._getEpochs(fitName)
+        fnCkpt = self._getLatestCheckpoint(fitName)
+        resumeArgs = ''
+        if fnCkpt is not None:
+            doneEpochs = _ckptEpoch(fnCkpt) + 1
+            self.info('%s: resuming from %s, %d of %d epochs done'
+                      % (fitName, fnCkpt, doneEpochs, numEpochs))
+            numEpochs -= doneEpochs
+            resumeArgs = ' --resume-from-checkpoint %s ' % fnCkpt
+            if numEpochs <= 0:
+                open(fnDone, 'w').close()
+                return
+
+        params = ' --num-epochs %i ' % numEpochs
+        params += resumeArgs
+        params += ' --subtomo_size %i ' % self._getBoxSize(fitName)
+        params += ' --batch-size %i ' % self._getBatchSize(fitName)
+        params += self._getNumWorkersArg(fitName)
+        params += ' --mw-angle %f ' % self._getMwAngle(fitName)
+        params += ' --subtomo-dir %s ' % self._getSubtomoDir(fitName)
+        params += ' --logdir %s ' % self._getFitDir(fitName)
+        unetParams, adamParams = self._getUnetParams(fitName), self._getAdamParams(fitName)
+        if unetParams:
+            params += ' --unet-params-dict %s ' % shlex.quote(unetParams)
+        if adamParams:
+            params += ' --adam-params-dict %s ' % shlex.quote(adamParams)
+
+        params += ' --gpu 0 '
+
+        if self.adaptiveEpochs.get():
+            params += ' --check-val-every-n-epochs 1 '
+            params += ' --save-n-models-with-lowest-val-loss 1 '
+
+        metricsFile = self._getMetricsFile('fit_%s' % fitName)
+        if not self.adaptiveEpochs.get():
+            Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_FIT_MODEL), args=params,
+                                  metricsFile=metricsFile)
+            open(fnDone, 'w').close()
+            return
+
+        cleanPath(os.path.splitext(metricsFile)[0] + '.stop')
+        done = threading.Event()
+        watcher = threading.Thread(target=self._watchValidationLoss,
+                                   args=(fitName, metricsFile, done))
+        watcher.start()
+        try:
+            Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_FIT_MODEL), args=params,
+                                  metricsFile=metricsFile)
+        finally:
+            done.set()
+            watcher.join()
+        open(fnDone, 'w').close()
+
+    def _watchValidationLoss(self, fitName, metricsFile, done):
+        """ Follow the validation loss in the fit log and stop the fit once
+        it reaches a plateau. The outcome is saved to a report. """
+        fnLog = os.path.splitext(metricsFile)[0] + '.log'
+        detector = utils.PlateauDetector(self.esTolerance.get(), self.esPatience.get())
+        checked = 0
+        stoppedAt = None
+        while stoppedAt is None and not done.wait(EARLY_STOP_POLL_SECONDS):
+            # The last epoch in the log may still be running
+            epochs = [e for e in utils.parseTimedLog(fnLog)[:-1] if 'val_loss' in e]
+            for epoch in epochs[checked:]:
+                if detector.update(epoch['epoch'], epoch['val_loss']):
+                    stoppedAt = epoch['epoch']
+                    open(os.path.splitext(metricsFile)[0] + '.stop', 'w').close()
+                    break
+            checked = len(epochs)
+
+        if stoppedAt is None:
+            return
+        maxEpochs = self._getEpochs(fitName)
+        report = {'stoppedAtEpoch': stoppedAt,
+                  'bestEpoch': detector.bestEpoch,
+                  'bestValLoss': detector.bestLoss,
+                  'maxEpochs': maxEpochs,
+                  'epochsSaved': maxEpochs - stoppedAt - 1}
+        self.info('%s: validation loss plateau at epoch %d, %d epochs saved'
+                  % (fitName, stoppedAt, report['epochsSaved']))
+        with open(self._getTomoPath(fitName, EARLY_STOP_FN), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def refineModelStep(self, fitName, tomos):
+        """ Refine a batch of tomograms, skipping the ones a previous
+        execution of the step already refined. """
+        refined = [tsId for tsId, _, _ in tomos if self._isRefined(fitName, tsId)]
+        if refined:
+            self.info('%s: already refined, skipped' % ', '.join(refined))
+            tomos = [tomo for tomo in tomos if tomo[0] not in refined]
+            if not tomos:
+                return
+        rois = self._cropRois(fitName, tomos) if self._useRoi(fitName) else {}
+        refineTomos = [rois[tsId]['tomo'] if tsId in rois else [tsId, fnOdd, fnEven]
+                       for tsId, fnOdd, fnEven in tomos]
+        # The refined crops go to a temporary folder, until they are pasted back
+        outputDir = self._getTmpPath(fitName, 'roi_%s' % tomos[0][0], REFINED_DIR) if rois \
+            else self._getRefinedDir(fitName)
+        makePath(outputDir)
+
+        if self.tiledRefine.get() and fitName != PREVIEW_MODEL:
+            for tomo in refineTomos:
+                self._refineTiled(fitName, tomo, outputDir)
+        else:
+            self._runRefine(fitName,
+                            [fnOdd for _, fnOdd, _ in refineTomos],
+                            [fnEven for _, _, fnEven in refineTomos],
+                            outputDir,
+                            'refine_%s_%s' % (fitName, tomos[0][0]))
+
+        if rois:
+            for tsId, fnOdd, fnEven in refineTomos:
+                if tsId in rois:
+                    self._pasteRoi(fitName, rois[tsId], _findRefined(outputDir, fnOdd))
+                else:
+                    os.replace(_findRefined(outputDir, fnOdd),
+                               os.path.join(self._getRefinedDir(fitName),
+                                            '%s_refined.mrc' % _getStem(fnOdd)))
+            cleanPath(os.path.dirname(outputDir))
+        if self.halfPrecision.get():
+            for tsId, fnOdd, _ in tomos:
+                self._convertRefined(fitName, tsId, fnOdd)
+        for tsId, _, _ in tomos:
+            open(self._getRefinedMarker(fitName, tsId), 'w').close()
+
+    def _runRefine(self, fitName, fnOdds, fnEvens, outputDir, label, recomputeNormalization=None):
+        if recomputeNormalization is None:
+            recomputeNormalization = self.recomputeNormalization.get()
+        params  = ' --tomo0_files %s ' % ' '.join(fnOdds)
+        params += ' --tomo1_files %s ' % ' '.join(fnEvens)
+        params += ' --model-checkpoint-file %s ' % self._getModelCheckpoint(fitName)
+        params += ' --subtomo_size %i ' % self._getBoxSize(fitName)
+        params += ' --mw-angle %f ' % self._getMwAngle(fitName)
+        params += ' --subtomo-overlap %i ' % self._getSubtomoOverlap(fitName)
+        if recomputeNormalization:
+            params += ' --recompute-normalization'
+        params += ' --batch-size %i ' % self._getBatchSize(fitName)
+        params += self._getNumWorkersArg(fitName)
+        params += ' --output_dir %s ' % outputDir
+        params += ' --gpu 0 '
+        Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_REFINE_MODEL), args=params,
+                              metricsFile=self._getMetricsFile(label))
+
+    def _convertRefined(self, fitName, tsId, fnOdd):
+        """ Store a refined tomogram as float16 and save the conversion error. """
+        report = utils.convertToFloat16(self._getRefinedTomo(fitName, fnOdd))
+        if report['overflow']:
+            self.warning('%s: values out of the float16 range, kept as float32' % tsId)
+        with open(self._getTomoPath(fitName, '%s_%s' % (tsId, PRECISION_FN)), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def _cropRois(self, fitName, tomos):
+        """ Crop the mask bounding box of the half maps of the tomograms with
+        a mask. Returns the crops and their location per tsId. """
+        import mrcfile
+        import numpy as np
+
+        rois = {}
+        for tsId, fnOdd, fnEven in tomos:
+            fnMask = self._getMaskFile(tsId)
+            if fnMask is None:
+                continue
+            roi = utils.maskBoundingBox(fnMask, self.roiPadding.get(), self._getBoxSize(fitName))
+            with mrcfile.mmap(fnOdd, mode='r', permissive=True) as mrc:
+                shape, voxelSize = mrc.data.shape, mrc.voxel_size
+            if roi is None:
+                self.warning('%s: empty mask, the whole tomogram is refined' % tsId)
+                continue
+            roiSize = [s.stop - s.start for s in roi]
+            if roiSize == list(shape):
+                continue
+            self.info('%s: refining %s of %s voxels (%.1f%% of the volume)'
+                      % (tsId, 'x'.join(map(str, roiSize[::-1])), 'x'.join(map(str, shape[::-1])),
+                         100. * np.prod(roiSize) / np.prod(shape)))
+            roiDir = self._getTmpPath(fitName, 'roi_%s' % tomos[0][0])
+            makePath(roiDir)
+            crop = [tsId, os.path.join(roiDir, '%s_odd.mrc' % tsId),
+                    os.path.join(roiDir, '%s_even.mrc' % tsId)]
+            utils.writeTile(fnOdd, roi, crop[1])
+            utils.writeTile(fnEven, roi, crop[2])
+            rois[tsId] = {'tomo': crop, 'roi': roi, 'shape': shape, 'voxelSize': voxelSize,
+                          'fnOdd': fnOdd, 'fnEven': fnEven}
+        return rois
+
+    def _pasteRoi(self, fitName, roiInfo, fnRefinedCrop):
+        """ Paste a refined crop into a full size tomogram filled with the
+        mean of the half maps. """
+        cache = self._getNormalizationCache()
+        stats = utils.combineVolumeStats([cache.getStats(roiInfo['fnOdd']),
+                                          cache.getStats(roiInfo['fnEven'])])
+        fnOut = os.path.join(self._getRefinedDir(fitName),
+                             '%s_refined.mrc' % _getStem(roiInfo['fnOdd']))
+        utils.pasteRoi(fnRefinedCrop, roiInfo['roi'], roiInfo['shape'], fnOut,
+                       stats['mean'], roiInfo['voxelSize'])
+
+    def _refineTiled(self, fitName, tomo, outputDir=None):
+        """ Refine a tomogram as overlapping tiles, a few tiles per call, and
+        blend the refined tiles into a memory mapped output. """
+        import mrcfile
+        import numpy as np
+
+        tsId, fnOdd, fnEven = tomo
+        tileDir = self._getTmpPath(fitName, tsId)
+        tileRefinedDir = os.path.join(tileDir, REFINED_DIR)
+        makePath(tileDir, tileRefinedDir)
+
+        with mrcfile.mmap(fnOdd, mode='r', permissive=True) as mrc:
+            shape, voxelSize = mrc.data.shape, mrc.voxel_size
+        overlap = self.subtomoOverlap.get()
+        tiles = utils.getTiles(shape, self.tileSize.get(), overlap)
+        fnOut = os.path.join(outputDir or self._getRefinedDir(fitName),
+                             '%s_refined.mrc' % _getStem(fnOdd))
+        blender = utils.TileBlender(fnOut, shape, overlap, voxelSize)
+        scale, offset = self._getTileNormalization(fitName, tomo)
+        recomputeTiles = self.recomputeNormalization.get() and scale is None
+        scale, offset = (1., 0.) if scale is None else (scale, offset)
+
+        for first in range(0, len(tiles), TILES_PER_CALL):
+            batch = list(enumerate(tiles[first:first + TILES_PER_CALL], first))
+            fnTileOdds, fnTileEvens = [], []
+            for i, tile in batch:
+                fnTileOdds.append(os.path.join(tileDir, 'tile_%05d_0.mrc' % i))
+                fnTileEvens.append(os.path.join(tileDir, 'tile_%05d_1.mrc' % i))
+                utils.writeTile(fnOdd, tile, fnTileOdds[-1], scale, offset)
+                utils.writeTile(fnEven, tile, fnTileEvens[-1], scale, offset)
+            self._runRefine(fitName, fnTileOdds, fnTileEvens, tileRefinedDir,
+                            'refine_%s_%s_tiles_%05d' % (fitName, tsId, first),
+                            recomputeNormalization=recomputeTiles)
+
+            for (i, tile), fnTileOdd in zip(batch, fnTileOdds):
+                fnRefined = _findRefined(tileRefinedDir, fnTileOdd)
+                # Back from the space of the fit statistics to the one of the tomogram
+                blender.add(tile, (mrcfile.read(fnRefined) - np.float32(offset)) / np.float32(scale))
+                cleanPath(fnRefined)
+            cleanPath(*(fnTileOdds + fnTileEvens))
+        blender.close()
+
+    def _getTileNormalization(self, fitName, tomo):
+        """ Map applied to the tiles of a tomogram so that the model, which
+        normalizes with the statistics of the fit, sees them normalized with
+        the statistics of the whole tomogram. The refined tiles come back in
+        the mapped space and are mapped back. Returns (None, None) if the
+        normalization is not recomputed or the fit statistics are missing,
+        in which case it is recomputed per tile. """
+        import numpy as np
+
+        if not self.recomputeNormalization.get():
+            return None, None
+        fnFitStats = os.path.join(self._getSubtomoDir(fitName), MEAN_STD_FN)
+        if not os.path.exists(fnFitStats):
+            self.warning('%s not found, the normalization is recomputed per tile' % fnFitStats)
+            return None, None
+        fitStats = np.load(fnFitStats)
+        tsId, fnOdd, fnEven = tomo
+        cache = self._getNormalizationCache()
+        tomoStats = utils.combineVolumeStats([cache.getStats(fnOdd), cache.getStats(fnEven)])
+        self.info('%s: mean %f, std %f' % (tsId, tomoStats['mean'], tomoStats['std']))
+        scale = float(fitStats['std']) / tomoStats['std']
+        return scale, float(fitStats['mean']) - tomoStats['mean'] * scale
+
+    def createOutputStep(self):
+        inTomos = self._getInputTomos()
+        outTomos = SetOfTomograms.create(self._getPath(), template='tomograms%s.sqlite')
+        outTomos.copyInfo(inTomos)
+
+        refinedDict = {}
+        for fitName, tomos in self._getFitGroups().items():
+            for tsId, fnOdd, _ in tomos:
+                refinedDict[tsId] = self._getRefinedTomo(fitName, fnOdd)
+
+        for inTomo in inTomos:
+            fnRefined = refinedDict.get(inTomo.getTsId())
+            if fnRefined is None:
+                continue
+            tomo = inTomo.clone()
+            tomo.setLocation(fnRefined)
+            outTomos.append(tomo)
+
+        self._defineOutputs(**{OUTPUT_TOMOS: outTomos})
+        self._defineSourceRelation(self._getInputTomosPointer(), outTomos)
+        self._releaseCacheEntries([fitName for fitName in self._getFitNames()
+                                   if fitName != PREVIEW_MODEL])
+        self._writeRunMetrics()
+
+    def createPreviewOutputStep(self):
+        inTomos = self._getInputTomos()
+        samplingRate = inTomos.getSamplingRate() * self.previewBinning.get()
+        outTomos = SetOfTomograms.create(self._getPath(), template='tomograms%s.sqlite',
+                                         suffix='Preview')
+        outTomos.copyInfo(inTomos)
+        outTomos.setSamplingRate(samplingRate)
+
+        refinedDict = {tsId: self._getRefinedTomo(PREVIEW_MODEL, fnOdd)
+                       for tsId, fnOdd, _ in self._getPreviewTomos()}
+        for inTomo in inTomos:
+            fnRefined = refinedDict.get(inTomo.getTsId())
+            if fnRefined is None:
+                continue
+            tomo = inTomo.clone()
+            tomo.setLocation(fnRefined)
+            tomo.setSamplingRate(samplingRate)
+            outTomos.append(tomo)
+
+        self._defineOutputs(**{OUTPUT_PREVIEW: outTomos})
+        self._defineSourceRelation(self._getInputTomosPointer(), outTomos)
+        self._releaseCacheEntries([PREVIEW_MODEL])
+        self._writeRunMetrics()
+
+    # --------------------------- UTILS functions -----------------------------------
+    def _getInputTomosPointer(self):
+        return self.evenTomos if self.oddEvenImported.get() else self.inputTomograms
+
+    def _getInputTomos(self):
+        return self._getInputTomosPointer().get()
+
+    def _getTomoList(self, getSet=None):
+        """ List of [tsId, odd, even] per tomogram. It is computed from the
+        inputs so the step graph can be built at insertion time. getSet
+        returns the set of an input pointer, by default the pointed object. """
+        getSet = getSet or (lambda pointer: pointer.get())
+        tomoList = []
         if self.oddEvenImported.get():
-            pass
+            oddDict = {t.getTsId(): t.getFileName() for t in getSet(self.oddTomos)}
+            for t in getSet(self.evenTomos):
+                tsId = t.getTsId()
+                if tsId in oddDict:
+                    tomoList.append([tsId, oddDict[tsId], t.getFileName()])
         else:
-            for t in self.inputTomograms.get():
+            for t in getSet(self.inputTomograms):
                 tsId = t.getTsId()
                 odd, even = t.getHalfMaps().split(',')
-                self.tomoList.append([tsId, odd, even])
-
-    def prepareDataForDeepDeWedge(self, tomo):
-        tsId = tomo[0]
-        fnOdd = tomo[1]
-        fnEven = tomo[2]
-        fnMask = None
-
-        params  = ' --tomo0_files %s ' % fnOdd
-        params += ' --tomo1_files %s ' % fnEven
-        params += ' --subtomo_size %i ' % self.boxsize.get()
-        params += ' --subtomo_extraction_strides %i ' % (a, b, c)
-        params += ' --val-fraction %f ' % self.validationFraction.get()
+                tomoList.append([tsId, odd, even])
+        return tomoList
 
-        params += ' --mask_files %s ' % fnMask
-        params += ' --min_nonzero_mask_fraction_in_subtomo %f ' % (a, b, c)
-
-        Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_PREPARE_STAR), args=params)
-
-    def fittingModelStep(self, tomo):
-        tsId = tomo[0]
-        fnOdd = tomo[1]
-        fnEven = tomo[2]
-        fnMask = None
-
-        params = ' --num-epochs %i ' % self.epochs.get()
-        params += ' --subtomo_size %i ' % self.boxsize.get()
-        params += ' --batch-size %i ' % self.batchSize.get()
-        params += ' --mw-angle %f ' % mwAngle
-        params += ' --subtomo-dir %s 'subtomoDir
-
-        #TODO: Add --gpu and --num-workers
-        #TODO: Check and add --unet-params-dict
-        #TODO: Check and add --adam-params-dict
-        Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_FIT_MODEL), args=params)
-                                                                                                                                                                                      │
-
-    def refineModelStep(self, tomo):
-
-        params  = ' --tomo0_files %s ' % fnOdd
-        params += ' --tomo1_files %s ' % fnEven
-        params += ' --model-checkpoint-file % ' fnModel
-        params += ' --subtomo_size %i ' % self.boxsize.get()
-        params += ' --mw-angle %f ' % mwAngle
-        params += ' --subtomo-overlap %f ' % subtomoOverlap
-        params += ' --recompute-normalization'
-        params += ' --batch-size %i ' % batchSize
-        params += ' --output_dir %s ' % outputDrir
-        #TODO: Add --num-workers  and --gpu
-        Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_REFINE_MODEL), args=params)
+    def _runPrepareData(self, fitName, tomos, params, maskPositions=None):
+        if self.extractInPlugin.get():
+            self._extractInPlugin(fitName, tomos, maskPositions)
+            return
+        # Extraction runs on the CPU, in a step that does not book a device
+        Plugin.runDeepdewedge(self, Plugin.getProgram(PROGRAM_PREPARE_STAR), args=params, gpuId='',
+                              metricsFile=self._getMetricsFile('prepare_%s' % fitName))
 
-    def createOutputStep(self):
-        #TODO
+    def _extractInPlugin(self, fitName, tomos, maskPositions=None):
+        """ Extract the subtomograms into a memory mapped store and export
+        them to the files read by the fit tool. maskPositions holds the
+        corners accepted by the mask screening, if masks are used. """
+        import mrcfile
+        import numpy as np
+
+        subtomoDir = self._getSubtomoDir(fitName)
+        boxSize = self._getBoxSize(fitName)
+
+        candidates = {}
+        for tsId, fnOdd, fnEven in tomos:
+            with mrcfile.mmap(fnOdd, mode='r', permissive=True) as mrc:
+                shape = mrc.data.shape
+            if maskPositions is not None:
+                # The corners were screened on the mask
+                with mrcfile.mmap(self._getMaskFile(tsId), mode='r', permissive=True) as mrc:
+                    maskShape = mrc.data.shape
+                if maskShape != shape:
+                    raise Exception('%s: the mask is %s voxels and the tomogram %s. The masks '
+                                    'must have the size and binning of the tomograms.'
+                                    % (tsId, 'x'.join(map(str, maskShape[::-1])),
+                                       'x'.join(map(str, shape[::-1]))))
+                positions = maskPositions[tsId]
+            else:
+                positions = utils.getExtractionPositions(shape, boxSize, self._getStrides(fitName))
+            candidates[tsId] = (positions, shape)
+        positionsDict = self._selectSubtomos(fitName, tomos, candidates)
+
+        storeDir = os.path.join(subtomoDir, SUBTOMO_STORE_DIR)
+        try:
+            store = self._fillStore(storeDir, boxSize, self._getStoreDtype(), tomos, positionsDict)
+            report = store.getPrecisionReport()
+        except OverflowError as e:
+            self.warning('%s: %s The subtomograms are extracted again as float32.' % (fitName, e))
+            cleanPath(storeDir)
+            store = self._fillStore(storeDir, boxSize, 'float32', tomos, positionsDict)
+            report = {'overflow': True}
+        if report is not None:
+            with open(self._getTomoPath(fitName, SUBTOMO_PRECISION_FN), 'w') as f:
+                json.dump(report, f, indent=2)
+
+        # The fit tool gets float32 whatever the store holds
+        store.exportNpz(os.path.join(subtomoDir, TRAIN_DATA_FN),
+                        os.path.join(subtomoDir, VALIDATION_DATA_FN), dtype=np.float32)
+        mean, std = store.computeMeanStd()
+        np.savez(os.path.join(subtomoDir, MEAN_STD_FN), mean=mean, std=std)
+        # Only the exported files are read from now on
+        cleanPath(storeDir)
+
+    def _fillStore(self, storeDir, boxSize, dtype, tomos, positionsDict):
+        """ Extract the subtomograms at the given corners into a new store. """
+        store = utils.SubtomoStore.create(storeDir, boxSize, dtype=dtype)
+        for tomoIndex, (tsId, fnOdd, fnEven) in enumerate(tomos):
+            n = utils.extractSubtomos(store, fnOdd, fnEven, positionsDict[tsId],
+                                      self.validationFraction.get(), tomoIndex)
+            self.info('%s: %d subtomograms extracted' % (tsId, n))
+        store.close()
+        return store
+
+    def _selectSubtomos(self, fitName, tomos, candidates):
+        """ Keep up to maxSubtomos of the candidate corners, given with the
+        tomogram shape by tsId, and save the counts to a report. Returns the
+        corners to extract by tsId. """
+        maxCount = self.maxSubtomos.get()
+        total = sum(len(positions) for positions, _ in candidates.values())
+        if not maxCount or total <= maxCount:
+            return {tsId: positions for tsId, (positions, _) in candidates.items()}
+
+        boxSize = self._getBoxSize(fitName)
+        scored = {}
+        for tsId, fnOdd, _ in tomos:
+            positions, shape = candidates[tsId]
+            fnMask = None if fitName == PREVIEW_MODEL else self._getMaskFile(tsId)
+            scored[tsId] = (positions, utils.scoreSubtomos(fnOdd, positions, boxSize, fnMask),
+                            shape)
+        selected = utils.selectSubtomos(scored, boxSize, maxCount,
+                                        stratify=self.subtomoSelection.get() == SELECT_PER_TOMO)
+
+        report = {}
+        for tsId, positions in selected.items():
+            report[tsId] = {'candidates': len(candidates[tsId][0]), 'selected': len(positions)}
+            self.info('%s: %d of %d candidate subtomograms selected'
+                      % (tsId, len(positions), len(candidates[tsId][0])))
+        with open(self._getTomoPath(fitName, SELECTION_FN), 'w') as f:
+            json.dump(report, f, indent=2)
+        return selected
+
+    def _getSelectionReport(self):
+        report = {}
+        for fitName in self._getFitNames():
+            fnReport = self._getTomoPath(fitName, SELECTION_FN)
+            if os.path.exists(fnReport):
+                with open(fnReport) as f:
+                    for tsId, counts in json.load(f).items():
+                        report['%s %s' % (fitName, tsId) if fitName == PREVIEW_MODEL else tsId] = counts
+        return report
+
+    def _screenMasks(self, fitName, tomos):
+        """ Count the candidate boxes that pass the mask threshold with a
+        summed volume table. The counts, also for other thresholds, are
+        logged and written to a report. Returns the accepted corners per tsId. """
+        boxSize = self.boxsize.get()
+        minFraction = self.minNonZeroMaskSubtomo.get()
+        positionsDict, report = {}, {}
+        for tsId, _, _ in tomos:
+            positions, fractions, nCandidates = utils.screenMask(self._getMaskFile(tsId), boxSize,
+                                                                 self._getStrides(), 0.)
+            accepted = fractions >= minFraction
+            positionsDict[tsId] = positions[accepted]
+            report[tsId] = {'candidates': nCandidates,
+                            'accepted': int(accepted.sum()),
+                            'acceptedByThreshold': {str(t): n for t, n in
+                                                    utils.countsForThresholds(fractions).items()}}
+            self.info('%s: %d of %d subtomograms pass the mask fraction %0.2f'
+                      % (tsId, report[tsId]['accepted'], nCandidates, minFraction))
+        with open(self._getTomoPath(fitName, MASK_SCREENING_FN), 'w') as f:
+            json.dump(report, f, indent=2)
+        return positionsDict
+
+    def _saveMaskScreening(self, fitName, maskPositions):
+        """ Keep the screening report and the accepted corners with the
+        extraction, so they go to the cache entry with it. """
+        import numpy as np
+
+        subtomoDir = self._getSubtomoDir(fitName)
+        shutil.copy(self._getTomoPath(fitName, MASK_SCREENING_FN), subtomoDir)
+        np.savez(os.path.join(subtomoDir, MASK_POSITIONS_FN), **maskPositions)
+
+    def _reuseMaskScreening(self, fitName, tomos, entryPath):
+        """ Take the screening report from a cache entry instead of screening
+        the masks again. Entries cached without it are screened. """
+        fnReport = os.path.join(entryPath, MASK_SCREENING_FN)
+        if os.path.exists(fnReport):
+            shutil.copy(fnReport, self._getTomoPath(fitName, MASK_SCREENING_FN))
+        else:
+            self._screenMasks(fitName, tomos)
+
+    def _getCacheDir(self):
+        return Plugin.getCacheDir() or self.getProject().getPath(SUBTOMO_CACHE_DIR)
+
+    def _getSubtomoCache(self):
+        return utils.SubtomoCache(self._getCacheDir(), Plugin.getCacheMaxBytes())
+
+    def _getNormalizationCache(self):
+        return utils.NormalizationCache(os.path.join(self._getCacheDir(), NORM_STATS_DIR))
+
+    def _getExtractionKey(self, fitName, files, useMasks):
+        """ Key of an extraction: input files plus every parameter that
+        changes the extracted subtomograms. """
+        extractionParams = {'boxsize': self._getBoxSize(fitName),
+                            'strides': self._getStrides(fitName),
+                            'validationFraction': self.validationFraction.get()}
+        if useMasks:
+            extractionParams['minNonZeroMaskSubtomo'] = self.minNonZeroMaskSubtomo.get()
+        if self.extractInPlugin.get():
+            extractionParams['extractInPlugin'] = True
+            extractionParams['dtype'] = self._getStoreDtype()
+            if self.maxSubtomos.get():
+                extractionParams['maxSubtomos'] = self.maxSubtomos.get()
+                extractionParams['subtomoSelection'] = self.subtomoSelection.get()
+        return utils.computeExtractionKey(files, extractionParams)
+
+    def _releaseCacheEntries(self, fitNames):
+        """ Unpin the cache entries the given fits extracted or reused. """
+        if not self.useSubtomoCache.get():
+            return
+        cache = self._getSubtomoCache()
+        for fitName in fitNames:
+            fnStatus = self._getTomoPath(fitName, CACHE_STATUS_FN)
+            if os.path.exists(fnStatus):
+                with open(fnStatus) as f:
+                    key = json.load(f)['key']
+                cache.release(key, os.path.abspath(self._getSubtomoDir(fitName)))
+
+    def _getCacheStatus(self):
+        """ Number of cache hits and misses of the finished extractions. """
+        hits = misses = 0
+        for fitName in self._getFitNames():
+            fnStatus = self._getTomoPath(fitName, CACHE_STATUS_FN)
+            if os.path.exists(fnStatus):
+                with open(fnStatus) as f:
+                    if json.load(f)['hit']:
+                        hits += 1
+                    else:
+                        misses += 1
+        return hits, misses
+
+    def _getMaskScreening(self):
+        report = {}
+        for fitName in self._getFitGroups():
+            fnReport = self._getTomoPath(fitName, MASK_SCREENING_FN)
+            if os.path.exists(fnReport):
+                with open(fnReport) as f:
+                    report.update(json.load(f))
+        return report
+
+    def _autotune(self, fitName):
+        """ Pick and record the batch size and data loader workers of a fit
+        group, for the U-Net depth and channels it is fitted with. """
+        concurrentJobs = min(self.numberOfThreads.get(), len(self.getGpuList()) or 1)
+        unetParams = json.loads(self._getUnetParams(fitName) or '{}')
+        unetSize = {name: int(unetParams[key]) for key, name in
+                    [('num_downsample_layers', 'numLayers'), ('chans', 'channels')]
+                    if key in unetParams}
+        choice = utils.autotune(self._getBoxSize(fitName), self.getGpuList(), concurrentJobs,
+                                self.batchSize.get(), **unetSize)
+        self.info('%s: batch size %d and %d data loader workers chosen'
+                  % (fitName, choice['batchSize'], choice['numWorkers']))
+        with open(self._getTomoPath(fitName, AUTOTUNE_FN), 'w') as f:
+            json.dump(choice, f, indent=2)
+
+    def _getAutotune(self, fitName):
+        fnAutotune = self._getTomoPath(fitName, AUTOTUNE_FN)
+        if self.autotune.get() and os.path.exists(fnAutotune):
+            with open(fnAutotune) as f:
+                return json.load(f)
+        return None
+
+    def _getBatchSize(self, fitName):
+        choice = self._getAutotune(fitName)
+        return choice['batchSize'] if choice else self.batchSize.get()
+
+    def _getNumWorkersArg(self, fitName):
+        choice = self._getAutotune(fitName)
+        numWorkers = choice['numWorkers'] if choice else self.numworkers.get()
+        return ' --num-workers %i ' % numWorkers if numWorkers > 0 else ''
+
+    def _getStoreDtype(self):
+        return 'float16' if self.halfPrecision.get() else 'float32'
+
+    def _getSubtomoPrecisionReports(self):
+        """ Conversion errors of the subtomograms of each fit group. """
+        reports = {}
+        for fitName in self._getFitNames():
+            fnReport = self._getTomoPath(fitName, SUBTOMO_PRECISION_FN)
+            if os.path.exists(fnReport):
+                with open(fnReport) as f:
+                    reports[fitName] = json.load(f)
+        return reports
+
+    def _getRefinedPrecisionReports(self):
+        """ Conversion errors of each refined tomogram, by tsId. """
+        reports = {}
+        for fitName in self._getFitNames():
+            for fnReport in sorted(glob.glob(self._getTomoPath(fitName, '*_' + PRECISION_FN))):
+                if os.path.basename(fnReport) == SUBTOMO_PRECISION_FN:
+                    continue
+                with open(fnReport) as f:
+                    reports[os.path.basename(fnReport)[:-len(PRECISION_FN) - 1]] = json.load(f)
+        return reports
+
+    def _getEarlyStopReports(self):
+        reports = {}
+        for fitName in self._getFitNames():
+            fnReport = self._getTomoPath(fitName, EARLY_STOP_FN)
+            if os.path.exists(fnReport):
+                with open(fnReport) as f:
+                    reports[fitName] = json.load(f)
+        return reports
+
+    def _getFitGroups(self):
+        """ Tomograms sharing a fitted model, indexed by the model name. """
+        tomoList = self._getTomoList()
+        if self.jointFit.get():
+            return {JOINT_MODEL: tomoList}
+        return {tomo[0]: [tomo] for tomo in tomoList}
+
+    def _usePreview(self):
+        return self.previewMode.get()
+
+    def _useRoi(self, fitName):
+        return fitName != PREVIEW_MODEL and self.roiRefine.get()
+
+    def _getFitNames(self):
+        """ Names of the fit groups, plus the preview one if it is run. """
+        fitNames = list(self._getFitGroups())
+        if self._usePreview():
+            fitNames.insert(0, PREVIEW_MODEL)
+        return fitNames
+
+    def _getPreviewTomos(self):
+        """ [tsId, odd, even] of the binned half maps. """
+        binnedDir = self._getTomoPath(PREVIEW_MODEL, BINNED_DIR)
+        return [[tsId, os.path.join(binnedDir, '%s_odd.mrc' % tsId),
+                 os.path.join(binnedDir, '%s_even.mrc' % tsId)]
+                for tsId, _, _ in self._getTomoList()]
+
+    def _getBoxSize(self, fitName):
+        """ Subtomo size, divided by the binning for the preview, kept a
+        multiple of 8 for the U-Net and no larger than the binned tomograms. """
+        if fitName != PREVIEW_MODEL:
+            return self.boxsize.get()
+        boxSize = max(MIN_PREVIEW_BOXSIZE, self.boxsize.get() // self.previewBinning.get() // 8 * 8)
+        return min(boxSize, self._getPreviewMinSize() // 8 * 8)
+
+    def _getPreviewMinSize(self):
+        """ Smallest dimension of the binned half maps. """
+        import mrcfile
+
+        sizes = []
+        for _, fnOdd, _ in self._getPreviewTomos():
+            with mrcfile.open(fnOdd, header_only=True, permissive=True) as mrc:
+                sizes.append(min(int(mrc.header.nx), int(mrc.header.ny), int(mrc.header.nz)))
+        return min(sizes)
+
+    def _getEpochs(self, fitName):
+        return self.previewEpochs.get() if fitName == PREVIEW_MODEL else self.epochs.get()
+
+    def _getMwAngle(self, fitName):
+        return self.mwAngle.get()
+
+    def _getUnetParams(self, fitName):
+        return self.unetParams.get()
+
+    def _getAdamParams(self, fitName):
+        return self.adamParams.get()
+
+    def _getSubtomoOverlap(self, fitName):
+        if fitName != PREVIEW_MODEL:
+            return self.subtomoOverlap.get()
+        return self.subtomoOverlap.get() // self.previewBinning.get()
+
+    def _getRefineBatches(self, tomos):
+        if not self.jointFit.get():
+            return [tomos]
+        size = max(1, self.refineBatch.get())
+        return [tomos[i:i + size] for i in range(0, len(tomos), size)]
+
+    def _getStrides(self, fitName=None):
+        strides = (self.strideX.get(), self.strideY.get(), self.strideZ.get())
+        if None in strides:
+            return None
+        if fitName == PREVIEW_MODEL:
+            return tuple(max(1, s // self.previewBinning.get()) for s in strides)
+        return strides
+
+    def _getMaskFile(self, tsId):
+        if not self.inputTomoMasks.get():
+            return None
+        for mask in self.inputTomoMasks.get():
+            if mask.getTsId() == tsId:
+                return mask.getFileName()
+        return None
+
+    def _getTomoPath(self, fitName, *paths):
+        return self._getExtraPath(fitName, *paths)
+
+    def _getSubtomoDir(self, fitName):
+        return self._getTomoPath(fitName, TRAIN_DATA_DIR)
+
+    def _hasSubtomos(self, fitName):
+        """ Whether the subtomogram folder is not empty and none of its
+        links is dangling. """
+        subtomoDir = self._getSubtomoDir(fitName)
+        if not os.path.isdir(subtomoDir):
+            return False
+        files = [os.path.join(subtomoDir, fn) for fn in os.listdir(subtomoDir)]
+        return bool(files) and all(os.path.exists(fn) for fn in files)
+
+    def _getFitDir(self, fitName):
+        return self._getTomoPath(fitName, DEEPDEWEDGE_MODEL)
+
+    def _getRefinedDir(self, fitName):
+        return self._getTomoPath(fitName, REFINED_DIR)
+
+    def _getModelCheckpoint(self, fitName):
+        """ Checkpoint with the lowest validation loss, or the latest one if
+        the validation checkpoints were not saved. """
+        fitDir = self._getFitDir(fitName)
+        valCkpts = glob.glob(os.path.join(fitDir, '**', 'val_loss', '*.ckpt'), recursive=True)
+        if valCkpts:
+            return min(valCkpts, key=_ckptValLoss)
+        ckpts = glob.glob(os.path.join(fitDir, '**', '*.ckpt'), recursive=True)
+        return max(ckpts, key=os.path.getmtime) if ckpts else None
+
+    def _getMetricsFile(self, label):
+        return self._getExtraPath(METRICS_DIR, '%s.json' % label)
+
+    def _writeRunMetrics(self):
+        """ Gather the metrics of every deepdewedge call in a single file. """
+        with open(self._getExtraPath(METRICS_FN), 'w') as f:
+            json.dump(utils.loadStepMetrics(self._getExtraPath(METRICS_DIR)), f, indent=2)
+
+    def _getRefinedMarker(self, fitName, tsId):
+        """ Empty file flagging a tomogram whose refinement has finished. """
+        return os.path.join(self._getRefinedDir(fitName), '%s.done' % tsId)
+
+    def _getRefinedTomo(self, fitName, fnOdd):
+        return _findRefined(self._getRefinedDir(fitName), fnOdd)
+
+    def _isRefined(self, fitName, tsId):
+        return os.path.exists(self._getRefinedMarker(fitName, tsId))
+
+    def _getLatestCheckpoint(self, fitName):
+        """ Checkpoint of the latest epoch saved by the fits of a group. """
+        ckpts = glob.glob(os.path.join(self._getFitDir(fitName), '**', '*.ckpt'), recursive=True)
+        return max(ckpts, key=lambda fn: (_ckptEpoch(fn), os.path.getmtime(fn))) if ckpts else None
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
+        for label, value in [('U-Net params', self.unetParams.get()),
+                             ('Adam params', self.adamParams.get())]:
+            try:
+                if value and not isinstance(json.loads(value), dict):
+                    raise ValueError
+            except ValueError:
+                errors.append('%s must be a dictionary in JSON format.' % label)
+        if self._usePreview() and self.previewBinning.get() < 1:
+            errors.append('The preview binning factor must be at least 1.')
+        return errors + self._validateTiles()
+
+    def _validateTiles(self):
+        """ The tiles must hold a subtomogram, and move forward by more
+        than the overlap. """
+        errors = []
+        if self.tiledRefine.get():
+            tileSize = self.tileSize.get()
+            if self.boxsize.get() and tileSize <= self.boxsize.get():
+                errors.append('The tile size must be larger than the subtomo size.')
+            if tileSize <= self.subtomoOverlap.get():
+                errors.append('The tile size must be larger than the subtomo overlap.')
         return errors
 
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
+        hits, misses = self._getCacheStatus()
+        if hits or misses:
+            summary.append('Subtomogram extractions reused from cache: %d, extracted: %d'
+                           % (hits, misses))
+        for tsId, counts in self._getMaskScreening().items():
+            summary.append('%s: %d of %d subtomograms inside the mask'
+                           % (tsId, counts['accepted'], counts['candidates']))
+        for tsId, counts in self._getSelectionReport().items():
+            summary.append('%s: %d of %d candidate subtomograms selected'
+                           % (tsId, counts['selected'], counts['candidates']))
+        for fitName in self._getFitNames():
+            choice = self._getAutotune(fitName)
+            if choice:
+                summary.append('%s: autotuned batch size %d, %d data loader workers'
+                               % (fitName, choice['batchSize'], choice['numWorkers']))
+        for fitName, report in self._getEarlyStopReports().items():
+            summary.append('%s: fit stopped at epoch %d of %d (best epoch %d), %d epochs saved'
+                           % (fitName, report['stoppedAtEpoch'], report['maxEpochs'],
+                              report['bestEpoch'], report['epochsSaved']))
+        for fitName, report in self._getSubtomoPrecisionReports().items():
+            if report['overflow']:
+                summary.append('%s subtomograms: out of the float16 range, stored as float32'
+                               % fitName)
+            else:
+                summary.append('%s subtomograms: float16 max error %g, relative RMS error %.2e'
+                               % (fitName, report['maxAbsError'], report['relativeRmsError']))
+        for tsId, report in self._getRefinedPrecisionReports().items():
+            if report['overflow']:
+                summary.append('%s: refined tomogram out of the float16 range, kept as float32'
+                               % tsId)
+            else:
+                summary.append('%s: refined tomogram float16 max error %g, relative RMS error %.2e'
+                               % (tsId, report['maxAbsError'], report['relativeRmsError']))
+        summary.extend(utils.summarizeStepMetrics(utils.loadStepMetrics(self._getExtraPath(METRICS_DIR))))
         return summary
 
     def _methods(self):
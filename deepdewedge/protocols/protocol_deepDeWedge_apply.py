@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import json
+import os
+import tarfile
+
+from pyworkflow.object import Set
+from pyworkflow.protocol import params, STATUS_NEW
+from pyworkflow.utils import makePath, createLink
+from tomo.objects import SetOfTomograms
+
+from deepdewedge.constants import JOINT_MODEL, METRICS_DIR
+from deepdewedge.protocols.protocol_deepDeWedge import DeepDeWedgeDenoising, OUTPUT_TOMOS
+
+
+class DeepDeWedgeApplyModel(DeepDeWedgeDenoising):
+    """
+    Refine a set of tomograms with a deepDeWedge model fitted in a previous
+    run, skipping the subtomogram extraction and the model fitting. Input
+    sets still being filled (streaming) are refined as the tomograms arrive.
+    """
+    _label = 'deepDeWedge apply model'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        self._defineInputParams(form)
+
+        form.addParam('inputModel', params.PathParam,
+                      label='Fitted model',
+                      important=True,
+                      help='Model checkpoint (.ckpt) or deepdewedge_model.tar.gz archive '
+                           'containing it, fitted in a previous deepDeWedge run on '
+                           'similar data.')
+        form.addParam('boxsize', params.IntParam,
+                      label='Subtomo Size',
+                      help='Size of the cubic subtomograms the model was fitted with.')
+        form.addParam('mwAngle', params.FloatParam,
+                      label='Missing Wedge angle (deg)',
+                      default=-1,
+                      help='Width of the missing wedge in degrees.')
+        form.addParam('batchSize', params.IntParam,
+                      label='Batch size',
+                      default=1,
+                      help='Batch size used to apply the model.')
+        form.addParam('refineBatch', params.IntParam,
+                      label='Tomograms per refine job',
+                      default=4,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Number of tomograms refined by each refine-tomogram call.')
+
+        self._defineRefineParams(form)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        """ The refine steps are inserted by _stepsCheck as the tomograms
+        show up in the input, so an input set still being filled is
+        processed as it grows. The close step waits until the input is
+        closed and every tomogram has been refined. """
+        modelStepId = self._insertFunctionStep(self.prepareModelStep, prerequisites=[],
+                                               needsGPU=False)
+        self._insertFunctionStep(self.closeOutputStep, prerequisites=[modelStepId],
+                                 wait=True, needsGPU=False)
+
+    def prepareModelStep(self):
+        """ Bring the fitted checkpoint into the run folder. """
+        fitDir = self._getFitDir(JOINT_MODEL)
+        makePath(fitDir, self._getRefinedDir(JOINT_MODEL), self._getExtraPath(METRICS_DIR))
+        fnModel = self.inputModel.get()
+        if tarfile.is_tarfile(fnModel):
+            with tarfile.open(fnModel) as tar:
+                tar.extractall(fitDir, filter='data')
+        else:
+            createLink(fnModel, os.path.join(fitDir, os.path.basename(fnModel)))
+
+    def closeOutputStep(self):
+        """ The output set is closed by _checkNewOutput, only the metrics of
+        the run are left to gather. """
+        self._writeRunMetrics()
+
+    # --------------------------- STREAMING functions ---------------------------
+    def _stepsCheck(self):
+        # The stream state is read before the tomograms, from the same load,
+        # so a tomogram added right before the input is closed is not missed
+        inputSets = {}
+
+        def getSet(pointer):
+            if id(pointer) not in inputSets:
+                inputSets[id(pointer)] = self._loadInputSet(pointer)
+            return inputSets[id(pointer)]
+
+        inputClosed = not any(getSet(pointer).isStreamOpen()
+                              for pointer in self._getInputPointers())
+        tomos = self._getTomoList(getSet)
+        self._checkNewInput(tomos)
+        self._checkNewOutput(tomos, inputClosed, getSet(self._getInputTomosPointer()))
+
+    def _checkNewInput(self, tomos):
+        insertedIds = self._getInsertedIds()
+        newTomos = [tomo for tomo in tomos if tomo[0] not in insertedIds]
+        if not newTomos:
+            return
+
+        modelStepId = self._steps.index(self._getStep(self.prepareModelStep)) + 1
+        closeStep = self._getStep(self.closeOutputStep)
+        for batch in self._getRefineBatches(newTomos):
+            stepId = self._insertFunctionStep(self.refineModelStep, JOINT_MODEL, batch,
+                                              prerequisites=[modelStepId])
+            closeStep.addPrerequisites(stepId)
+        self.updateSteps()
+
+    def _checkNewOutput(self, tomos, inputClosed, inputSet):
+        """ Append the refined tomograms to the output set, and close it once
+        the input is closed and every tomogram is refined. """
+        outTomos = getattr(self, OUTPUT_TOMOS, None)
+        if outTomos is not None and outTomos.isStreamClosed():
+            return
+        doneIds = {tomo.getTsId() for tomo in outTomos} if outTomos is not None else set()
+        insertedIds = self._getInsertedIds()
+        refinedIds = {tsId for tsId in insertedIds
+                      if os.path.exists(self._getRefinedMarker(JOINT_MODEL, tsId))}
+        newIds = refinedIds - doneIds
+        allDone = (inputClosed and refinedIds == insertedIds
+                   and all(tsId in insertedIds for tsId, _, _ in tomos))
+
+        if not newIds and not allDone:
+            return
+
+        firstOutput = outTomos is None
+        if firstOutput:
+            outTomos = SetOfTomograms.create(self._getPath(), template='tomograms%s.sqlite')
+            outTomos.copyInfo(self._getInputTomos())
+            outTomos.setStreamState(Set.STREAM_OPEN)
+        else:
+            outTomos.enableAppend()
+
+        oddDict = {tsId: fnOdd for tsId, fnOdd, _ in tomos}
+        for inTomo in inputSet:
+            tsId = inTomo.getTsId()
+            if tsId not in newIds:
+                continue
+            tomo = inTomo.clone()
+            tomo.setLocation(self._getRefinedTomo(JOINT_MODEL, oddDict[tsId]))
+            outTomos.append(tomo)
+
+        streamState = Set.STREAM_CLOSED if allDone else Set.STREAM_OPEN
+        self._updateOutputSet(OUTPUT_TOMOS, outTomos, streamState)
+        if firstOutput:
+            self._defineSourceRelation(self._getInputTomosPointer(), outTomos)
+
+        if allDone:
+            closeStep = self._getStep(self.closeOutputStep)
+            if closeStep.isWaiting():
+                closeStep.setStatus(STATUS_NEW)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+        fnModel = self.inputModel.get()
+        if not fnModel or not os.path.exists(fnModel):
+            errors.append('The fitted model file does not exist.')
+        elif not (fnModel.endswith('.ckpt') or tarfile.is_tarfile(fnModel)):
+            errors.append('The fitted model must be a .ckpt file or a .tar.gz archive.')
+        return errors + self._validateTiles()
+
+    # --------------------------- UTILS functions -----------------------------------
+    def _loadInputSet(self, pointer):
+        """ Load the input set from its file, to see the items added while
+        the protocol is running. """
+        inSet = pointer.get()
+        inSet = inSet.getClass()(filename=inSet.getFileName())
+        inSet.loadAllProperties()
+        inSet.close()
+        return inSet
+
+    def _getInputPointers(self):
+        return ([self.evenTomos, self.oddTomos] if self.oddEvenImported.get()
+                else [self.inputTomograms])
+
+    def _getStep(self, func):
+        for step in self._steps:
+            if step.funcName.get() == func.__name__:
+                return step
+        return None
+
+    def _getInsertedIds(self):
+        """ tsIds of the tomograms with a refine step. They are read from the
+        steps, so a continued run sees the steps it already has. """
+        insertedIds = set()
+        for step in self._steps:
+            if step.funcName.get() == self.refineModelStep.__name__:
+                _, batch = json.loads(step.argsStr.get())
+                insertedIds.update(tsId for tsId, _, _ in batch)
+        return insertedIds
+
+    def _getFitGroups(self):
+        return {JOINT_MODEL: self._getTomoList()}
+
+    def _usePreview(self):
+        return False
+
+    def _useRoi(self, fitName):
+        return False
+
+    def _getAutotune(self, fitName):
+        return None
+
+    def _getNumWorkersArg(self, fitName):
+        return ''
+
+    def _getRefineBatches(self, tomos):
+        size = max(1, self.refineBatch.get())
+        return [tomos[i:i + size] for i in range(0, len(tomos), size)]
+
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import itertools
+import json
+import math
+import os
+import re
+
+from pyworkflow.protocol import params
+
+from deepdewedge import utils
+from deepdewedge.constants import JOINT_MODEL, BEST_MODEL, SWEEP_FN
+from deepdewedge.protocols.protocol_deepDeWedge import DeepDeWedgeDenoising, _ckptEpoch, \
+    _ckptValLoss
+
+# Swept settings: param holding the values, label and type of each value
+SWEEP_PARAMS = [('mwAngle', 'sweepMwAngles', 'Missing wedge angles', float),
+                ('epochs', 'sweepEpochs', 'Numbers of epochs', int),
+                ('batchSize', 'sweepBatchSizes', 'Batch sizes', int),
+                ('unetParams', 'sweepUnetParams', 'U-Net params', str),
+                ('adamParams', 'sweepAdamParams', 'Adam params', str)]
+
+
+def _parseValues(text, valueType):
+    """ Values of a sweep param: one JSON dictionary per line for the
+    dictionaries, numbers separated by spaces or commas otherwise. """
+    text = (text or '').strip()
+    if not text:
+        return []
+    if valueType is str:
+        values = [line.strip() for line in text.splitlines() if line.strip()]
+        for value in values:
+            if not isinstance(json.loads(value), dict):
+                raise ValueError('%s is not a dictionary' % value)
+        return values
+    return [valueType(v) for v in re.split(r'[\s,]+', text)]
+
+
+class DeepDeWedgeSweep(DeepDeWedgeDenoising):
+    """
+    Fit deepDeWedge models for a grid of settings on a single extraction of
+    the subtomograms of all the tomograms. The fits run concurrently on the
+    available GPUs, their validation loss and time are recorded, and the
+    tomograms are refined with the model of lowest validation loss.
+    """
+    _label = 'deepDeWedge sweep'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        self._defineInputParams(form)
+        self._defineExtractionParams(form)
+
+        group = form.addGroup('Model Fit')
+        group.addParam('refineBatch', params.IntParam,
+                       label='Tomograms per refine job',
+                       default=4,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       help='Number of tomograms refined by each refine-tomogram call.')
+        self._defineFitParams(group)
+
+        group = form.addGroup('Sweep')
+        group.addParam('sweepMwAngles', params.StringParam,
+                       label='Missing wedge angles (deg)',
+                       default='',
+                       help='Missing wedge angles to try, separated by spaces. '
+                            'Empty to use the one of the Model Fit section.')
+        group.addParam('sweepEpochs', params.StringParam,
+                       label='Numbers of epochs',
+                       default='',
+                       help='Numbers of epochs to try, separated by spaces. '
+                            'Empty to use the one of the Model Fit section.')
+        group.addParam('sweepBatchSizes', params.StringParam,
+                       label='Batch sizes',
+                       default='',
+                       help='Batch sizes to try, separated by spaces. '
+                            'Empty to use the one of the Model Fit section.')
+        group.addParam('sweepUnetParams', params.TextParam,
+                       label='U-Net params',
+                       default='',
+                       help='U-Net params to try, one dictionary in JSON format '
+                            'per line. Empty to use the one of the Model Fit section.')
+        group.addParam('sweepAdamParams', params.TextParam,
+                       label='Adam params',
+                       default='',
+                       help='Adam optimizer params to try, one dictionary in JSON '
+                            'format per line. Empty to use the one of the Model Fit '
+                            'section.')
+
+        self._defineRefineParams(form)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        """ One extraction, the fits of all the configurations depending only
+        on it so they run concurrently, then the selection of the best model
+        and the refinement with it. """
+        listStepId = self._insertFunctionStep(self.createTomoListStep, prerequisites=[],
+                                              needsGPU=False)
+        tomos = self._getTomoList()
+        prepareId = self._insertFunctionStep(self.prepareDataForDeepDeWedge, JOINT_MODEL, tomos,
+                                             prerequisites=[listStepId], needsGPU=False)
+        fitIds = [self._insertFunctionStep(self.fittingModelStep, configName,
+                                           prerequisites=[prepareId])
+                  for configName in self._getSweepConfigs()]
+        selectId = self._insertFunctionStep(self.selectBestModelStep, prerequisites=fitIds,
+                                            needsGPU=False)
+        refineStepIds = [self._insertFunctionStep(self.refineModelStep, BEST_MODEL, batch,
+                                                  prerequisites=[selectId])
+                         for batch in self._getRefineBatches(tomos)]
+        self._insertFunctionStep(self.createOutputStep, prerequisites=refineStepIds, needsGPU=False)
+
+    def selectBestModelStep(self):
+        """ Record the validation loss and time of every configuration and
+        pick the one with the lowest validation loss. """
+        results = {}
+        for configName, config in self._getSweepConfigs().items():
+            result = {k: v for k, v in config.items() if v is not None}
+            result['valLoss'] = self._getValLoss(configName)
+            result['wallTime'] = self._getFitWallTime(configName)
+            results[configName] = result
+            self.info('%s: %s' % (configName, result))
+
+        fitted = [name for name, result in results.items() if result['valLoss'] is not None]
+        if not fitted:
+            raise Exception('None of the fits recorded a validation loss.')
+        best = min(fitted, key=lambda name: results[name]['valLoss'])
+        self.info('Best configuration: %s' % best)
+        with open(self._getExtraPath(SWEEP_FN), 'w') as f:
+            json.dump({'best': best, 'configs': results}, f, indent=2)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = DeepDeWedgeDenoising._validate(self)
+        for _, paramName, label, valueType in SWEEP_PARAMS:
+            try:
+                _parseValues(getattr(self, paramName).get(), valueType)
+            except ValueError:
+                errors.append('%s could not be read.' % label)
+        return errors
+
+    def _summary(self):
+        summary = []
+        report = self._getSweepReport()
+        if report:
+            for configName, result in report['configs'].items():
+                summary.append('%s%s: %s' % (configName, ' (best)' if configName == report['best'] else '',
+                                             ', '.join('%s %s' % item for item in result.items())))
+        return summary + DeepDeWedgeDenoising._summary(self)
+
+    # --------------------------- UTILS functions -----------------------------------
+    def _getSweepConfigs(self):
+        """ Configurations of the grid by name. The settings that are not
+        swept are None, and taken from the Model Fit section. """
+        keys, grids = [], []
+        for key, paramName, _, valueType in SWEEP_PARAMS:
+            keys.append(key)
+            grids.append(_parseValues(getattr(self, paramName).get(), valueType) or [None])
+        return {'config_%02d' % i: dict(zip(keys, values))
+                for i, values in enumerate(itertools.product(*grids))}
+
+    def _getValLoss(self, configName):
+        """ Validation loss of the checkpoint of a configuration, from its
+        name or else from the fit log. None if neither has it. """
+        fnCkpt = self._getModelCheckpoint(configName)
+        if fnCkpt is None:
+            return None
+        valLoss = _ckptValLoss(fnCkpt)
+        if not math.isinf(valLoss):
+            return valLoss
+        fnLog = os.path.splitext(self._getMetricsFile('fit_%s' % configName))[0] + '.log'
+        epochs = [e for e in utils.parseTimedLog(fnLog) if 'val_loss' in e]
+        ckptEpochs = [e for e in epochs if e['epoch'] == _ckptEpoch(fnCkpt)]
+        # Without the epoch in its name, the checkpoint is the latest one
+        epochs = ckptEpochs or epochs[-1:]
+        return epochs[0]['val_loss'] if epochs else None
+
+    def _getFitWallTime(self, configName):
+        """ Time the fit of a configuration ran, as measured by the monitor,
+        so the time waiting for a GPU is not counted. """
+        fnMetrics = self._getMetricsFile('fit_%s' % configName)
+        if not os.path.exists(fnMetrics):
+            return None
+        with open(fnMetrics) as f:
+            return json.load(f).get('wallTime')
+
+    def _getSweepReport(self):
+        fnReport = self._getExtraPath(SWEEP_FN)
+        if not os.path.exists(fnReport):
+            return None
+        with open(fnReport) as f:
+            return json.load(f)
+
+    def _getConfigName(self, fitName):
+        """ Configuration behind a fit name, resolving the best one. """
+        return self._getSweepReport()['best'] if fitName == BEST_MODEL else fitName
+
+    def _getConfig(self, fitName):
+        return self._getSweepConfigs().get(self._getConfigName(fitName), {})
+
+    def _getConfigValue(self, fitName, key, default):
+        value = self._getConfig(fitName).get(key)
+        return default if value is None else value
+
+    def _getFitGroups(self):
+        return {BEST_MODEL: self._getTomoList()}
+
+    def _getFitNames(self):
+        return [JOINT_MODEL] + list(self._getSweepConfigs()) + [BEST_MODEL]
+
+    def _getRefineBatches(self, tomos):
+        size = max(1, self.refineBatch.get())
+        return [tomos[i:i + size] for i in range(0, len(tomos), size)]
+
+    def _usePreview(self):
+        return False
+
+    def _getSubtomoDir(self, fitName):
+        """ All the configurations share the extraction. """
+        return DeepDeWedgeDenoising._getSubtomoDir(self, JOINT_MODEL)
+
+    def _getModelCheckpoint(self, fitName):
+        return DeepDeWedgeDenoising._getModelCheckpoint(self, self._getConfigName(fitName))
+
+    def _getAutotune(self, fitName):
+        if fitName == BEST_MODEL and self._getSweepReport() is None:
+            return None
+        return DeepDeWedgeDenoising._getAutotune(self, self._getConfigName(fitName))
+
+    def _getEpochs(self, fitName):
+        return self._getConfigValue(fitName, 'epochs', self.epochs.get())
+
+    def _getBatchSize(self, fitName):
+        return self._getConfigValue(fitName, 'batchSize',
+                                    DeepDeWedgeDenoising._getBatchSize(self, fitName))
+
+    def _getMwAngle(self, fitName):
+        return self._getConfigValue(fitName, 'mwAngle', self.mwAngle.get())
+
+    def _getUnetParams(self, fitName):
+        return self._getConfigValue(fitName, 'unetParams', self.unetParams.get())
+
+    def _getAdamParams(self, fitName):
+        return self._getConfigValue(fitName, 'adamParams', self.adamParams.get())
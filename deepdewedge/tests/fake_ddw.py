@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Stand-in for the deepdewedge command line used by the tests and
+benchmarks. It accepts the arguments the plugin passes to prepare_data,
+fit-model and refine-tomogram and reproduces their file outputs on small
+data, so the plugin can be exercised on machines without a GPU or the
+deepdewedge environment:
+
+    python fake_ddw.py prepare_data --tomo0_files ... --subtomo-dir ...
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import mrcfile
+
+PREPARE = 'prepare_data'
+FIT = 'fit-model'
+REFINE = 'refine-tomogram'
+
+# Seconds each simulated fitting epoch takes
+EPOCH_TIME_VAR = 'FAKE_DDW_EPOCH_TIME'
+# Epoch from which the validation loss stops improving
+PLATEAU_EPOCH_VAR = 'FAKE_DDW_PLATEAU_EPOCH'
+# File where every call appends its CUDA_VISIBLE_DEVICES, start and end time
+DEVICE_LOG_VAR = 'FAKE_DDW_DEVICE_LOG'
+
+
+def _normalizeArgs(args):
+    """ The plugin mixes --foo_bar and --foo-bar spellings. """
+    return [a.replace('_', '-') if a.startswith('--') else a for a in args]
+
+
+def _stem(fn):
+    return os.path.splitext(os.path.basename(fn))[0]
+
+
+def prepareData(args):
+    """ Write small train/validation archives and the normalization stats. """
+    os.makedirs(args.subtomo_dir, exist_ok=True)
+    box = args.subtomo_size
+    rng = np.random.default_rng(0)
+    numSubtomos = 0
+    for fn0 in args.tomo0_files:
+        with mrcfile.mmap(fn0, mode='r', permissive=True) as mrc:
+            numSubtomos += int(np.prod([max(1, d // box) for d in mrc.data.shape]))
+    numVal = int(round(numSubtomos * args.val_fraction))
+    for fn, n in [('train_data.npz', numSubtomos - numVal), ('val_data.npz', numVal)]:
+        data = rng.normal(size=(n, box, box, box)).astype(np.float32)
+        np.savez(os.path.join(args.subtomo_dir, fn), subtomos0=data, subtomos1=data)
+    np.savez(os.path.join(args.subtomo_dir, 'mean_std.npz'), mean=0.0, std=1.0)
+    print('Extracted %d subtomograms' % numSubtomos)
+
+
+def _ckptEpoch(fnCkpt):
+    return int(re.search(r'epoch=(\d+)', os.path.basename(fnCkpt)).group(1))
+
+
+def fitModel(args):
+    """ Simulate the epochs, printing the losses and keeping the checkpoint
+    with the lowest validation loss, named after it like the real tool. Each
+    call logs to a new version folder, and a resumed fit goes on numbering
+    the epochs after the checkpoint. An interruption (SIGINT) ends the fit
+    cleanly, as Ctrl+C does with the real tool. """
+    try:
+        _fitEpochs(args)
+    except KeyboardInterrupt:
+        print('Fitting interrupted')
+
+
+def _fitEpochs(args):
+    epochTime = float(os.environ.get(EPOCH_TIME_VAR, 0))
+    plateauEpoch = int(os.environ.get(PLATEAU_EPOCH_VAR, -1))
+    logsDir = os.path.join(args.logdir, 'fitting_logs')
+    version = 0
+    while os.path.exists(os.path.join(logsDir, 'version_%d' % version)):
+        version += 1
+    versionDir = os.path.join(logsDir, 'version_%d' % version)
+    firstEpoch = _ckptEpoch(args.resume_from_checkpoint) + 1 if args.resume_from_checkpoint else 0
+    ckptDir = os.path.join(versionDir, 'checkpoints', 'val_loss')
+    os.makedirs(ckptDir, exist_ok=True)
+    # The checkpoints keep the normalization of the fit, like the real ones
+    fitStats = {'mean': 0.0, 'std': 1.0}
+    fnStats = os.path.join(args.subtomo_dir, 'mean_std.npz')
+    if os.path.exists(fnStats):
+        with np.load(fnStats) as stats:
+            fitStats = {'mean': float(stats['mean']), 'std': float(stats['std'])}
+    fnBest = None
+    with open(os.path.join(versionDir, 'metrics.csv'), 'w') as f:
+        f.write('epoch,fitting_loss,val_loss\n')
+        for epoch in range(firstEpoch, firstEpoch + args.num_epochs):
+            print('Epoch %d: 0%%' % epoch)
+            sys.stdout.flush()
+            time.sleep(epochTime)
+            fitLoss = 1.0 / (epoch + 1)
+            valLoss = 1.0 / (epoch + 1) + 0.05
+            if 0 <= plateauEpoch < epoch:
+                valLoss = 1.0 / (plateauEpoch + 1) + 0.05
+            f.write('%d,%f,%f\n' % (epoch, fitLoss, valLoss))
+            f.flush()
+            print('Epoch %d: fitting_loss=%f val_loss=%f' % (epoch, fitLoss, valLoss))
+            sys.stdout.flush()
+            if fnBest is not None:
+                os.remove(fnBest)
+            fnBest = os.path.join(ckptDir, 'epoch=%d-val_loss=%0.5f.ckpt' % (epoch, valLoss))
+            with open(fnBest, 'w') as fCkpt:
+                json.dump(fitStats, fCkpt)
+
+
+def refineTomogram(args):
+    """ Normalize the two halves with the statistics of the fit, or with
+    their own ones if the normalization is recomputed, apply a stand-in
+    model to their average and undo the normalization, slab by slab, into
+    <tomo0 stem>_refined.mrc. The model is not linear, so the result depends
+    on the normalization as with the real tool. """
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(args.model_checkpoint_file) as f:
+        fitStats = json.load(f)
+    for fn0, fn1 in zip(args.tomo0_files, args.tomo1_files):
+        fnOut = os.path.join(args.output_dir, '%s_refined.mrc' % _stem(fn0))
+        with mrcfile.mmap(fn0, mode='r', permissive=True) as mrc0, \
+                mrcfile.mmap(fn1, mode='r', permissive=True) as mrc1:
+            if args.recompute_normalization:
+                halves = np.stack([mrc0.data, mrc1.data]).astype(np.float64)
+                mean, std = halves.mean(), halves.std()
+            else:
+                mean, std = fitStats['mean'], fitStats['std']
+            with mrcfile.new_mmap(fnOut, shape=mrc0.data.shape, mrc_mode=2,
+                                  overwrite=True) as mrcOut:
+                for z in range(mrc0.data.shape[0]):
+                    average = (mrc0.data[z].astype(np.float64) + mrc1.data[z]) / 2
+                    mrcOut.data[z] = np.tanh((average - mean) / std) * std + mean
+                mrcOut.voxel_size = mrc0.voxel_size
+        print('Refined %s' % fnOut)
+
+
+def main(argv=None):
+    argv = _normalizeArgs(sys.argv[1:] if argv is None else argv)
+    parser = argparse.ArgumentParser(prog='fake_ddw')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    prepare = sub.add_parser(PREPARE)
+    prepare.add_argument('--tomo0-files', nargs='+', required=True)
+    prepare.add_argument('--tomo1-files', nargs='+', required=True)
+    prepare.add_argument('--subtomo-size', type=int, required=True)
+    prepare.add_argument('--val-fraction', type=float, default=0.1)
+    prepare.add_argument('--subtomo-dir', required=True)
+
+    fit = sub.add_parser(FIT)
+    fit.add_argument('--num-epochs', type=int, default=1)
+    fit.add_argument('--subtomo-dir', required=True)
+    fit.add_argument('--logdir', required=True)
+    fit.add_argument('--resume-from-checkpoint')
+
+    refine = sub.add_parser(REFINE)
+    refine.add_argument('--tomo0-files', nargs='+', required=True)
+    refine.add_argument('--tomo1-files', nargs='+', required=True)
+    refine.add_argument('--model-checkpoint-file', required=True)
+    refine.add_argument('--output-dir', required=True)
+    refine.add_argument('--recompute-normalization', action='store_true')
+
+    args, _ = parser.parse_known_args(argv)
+    start = time.time()
+    {PREPARE: prepareData, FIT: fitModel, REFINE: refineTomogram}[args.command](args)
+    if os.environ.get(DEVICE_LOG_VAR):
+        with open(os.environ[DEVICE_LOG_VAR], 'a') as f:
+            f.write('%s %f %f\n' % (os.environ.get('CUDA_VISIBLE_DEVICES', ''), start, time.time()))
+
+
+if __name__ == '__main__':
+    main()
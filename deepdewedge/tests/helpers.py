@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Shared setup of the protocol tests and benchmarks: input sets of synthetic
+tomograms, and the fake_ddw.py stand-in run in place of the deepdewedge
+tools, either as a new process per job or in a warm worker.
+"""
+
+import os
+import subprocess
+import sys
+
+from pwem.protocols import EMProtocol
+from tomo.objects import SetOfTomograms, Tomogram
+
+from deepdewedge import Plugin
+from deepdewedge.utils import getSocketPath, startWorker, WORKER_SCRIPT
+
+FAKE_DDW = os.path.join(os.path.dirname(__file__), 'fake_ddw.py')
+
+
+def runFakeDeepdewedge(protocol, program, args, cwd=None, gpuId=None, metricsFile=None):
+    """ Replacement of Plugin.runDeepdewedge running the stand-in tool. """
+    program = '%s %s %s' % (sys.executable, FAKE_DDW, program.split()[-1])
+    if metricsFile:
+        program, args = Plugin.getMonitoredCommand(program, args, metricsFile)
+    subprocess.check_call('%s %s' % (program, args), shell=True, cwd=cwd,
+                          stdout=subprocess.DEVNULL)
+
+
+def startFakeWorker(tmpDir, env=None, timeout=60):
+    """ Warm worker serving the stand-in tool, with its socket in tmpDir.
+    Returns None if it does not start. """
+    socketPath = getSocketPath(tmpDir)
+    launchCmd = 'exec %s %s %s --entry %s:main --preload numpy --parent-pid %d' % (
+        sys.executable, WORKER_SCRIPT, socketPath, FAKE_DDW, os.getpid())
+    return startWorker(launchCmd, socketPath, env=env, timeout=timeout)
+
+
+def appendTomos(tomoSet, dataset):
+    """ Add the (tsId, odd, even, mask) entries of a synthetic dataset to a
+    set of tomograms, with the odd half as the tomogram. """
+    for tsId, fnOdd, fnEven, _ in dataset:
+        tomo = Tomogram(tsId=tsId, location=fnOdd)
+        tomo.setSamplingRate(1.0)
+        tomo.setHalfMaps([fnOdd, fnEven])
+        tomoSet.append(tomo)
+
+
+def createTomoSet(test, label, dataset, streamState=None):
+    """ Register a set of tomograms with half maps as the output of an
+    empty protocol of the test project, so it can be used as protocol input. """
+    source = test.newProtocol(EMProtocol, objLabel=label)
+    test.proj.saveProtocol(source)
+    tomoSet = SetOfTomograms.create(source._getPath())
+    tomoSet.setSamplingRate(1.0)
+    appendTomos(tomoSet, dataset)
+    if streamState is not None:
+        tomoSet.setStreamState(streamState)
+    source._defineOutputs(outputTomograms=tomoSet)
+    return source.outputTomograms
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Synthetic odd/even tomograms and masks for the tests and benchmarks. The
+volumes are smooth random blobs plus independent noise in each half, so
+they have the odd/even structure deepDeWedge expects without any data
+download.
+"""
+
+import os
+
+import numpy as np
+import mrcfile
+
+
+def createSyntheticVolume(shape, seed=0, numBlobs=20):
+    """ Float32 volume with a few gaussian blobs on a zero background. """
+    rng = np.random.default_rng(seed)
+    vol = np.zeros(shape, dtype=np.float32)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    for _ in range(numBlobs):
+        center = rng.uniform(0, shape)
+        sigma = rng.uniform(2, max(3, min(shape) / 8))
+        dist2 = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2
+        vol += np.exp(-dist2 / (2 * sigma ** 2)).astype(np.float32)
+    return vol
+
+
+def writeMrc(fn, data, voxelSize=1.0):
+    with mrcfile.new(fn, data=data.astype(np.float32), overwrite=True) as mrc:
+        mrc.voxel_size = voxelSize
+
+
+def createHalfMaps(outDir, tsId, shape, seed=0, noise=0.5, voxelSize=1.0):
+    """ Write the odd/even half maps of a synthetic tomogram and return
+    their file names. """
+    os.makedirs(outDir, exist_ok=True)
+    signal = createSyntheticVolume(shape, seed)
+    rng = np.random.default_rng(seed + 1)
+    fnOdd = os.path.join(outDir, '%s_odd.mrc' % tsId)
+    fnEven = os.path.join(outDir, '%s_even.mrc' % tsId)
+    writeMrc(fnOdd, signal + rng.normal(0, noise, shape), voxelSize)
+    writeMrc(fnEven, signal + rng.normal(0, noise, shape), voxelSize)
+    return fnOdd, fnEven
+
+
+def createSlabMask(fn, shape, fraction=0.5, voxelSize=1.0):
+    """ Binary mask of a centred slab along z covering the given fraction
+    of the tomogram, like a lamella. """
+    mask = np.zeros(shape, dtype=np.int8)
+    thickness = max(1, int(round(shape[0] * fraction)))
+    z0 = (shape[0] - thickness) // 2
+    mask[z0:z0 + thickness] = 1
+    with mrcfile.new(fn, data=mask, overwrite=True) as mrc:
+        mrc.voxel_size = voxelSize
+    return fn
+
+
+def createDataset(outDir, numTomos, shape, maskFraction=None, seed=0):
+    """ Synthetic dataset as a list of (tsId, odd, even, mask) tuples. The
+    mask is None unless a mask fraction is given. """
+    dataset = []
+    for i in range(numTomos):
+        tsId = 'TS_%03d' % i
+        fnOdd, fnEven = createHalfMaps(outDir, tsId, shape, seed + 10 * i)
+        fnMask = None
+        if maskFraction is not None:
+            fnMask = createSlabMask(os.path.join(outDir, '%s_mask.mrc' % tsId),
+                                    shape, maskFraction)
+        dataset.append((tsId, fnOdd, fnEven, fnMask))
+    return dataset
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Benchmarks of the plugin's own stages on synthetic data: step insertion,
+argument building, extraction helpers and output registration. The
+deepdewedge tools are replaced by the fake_ddw.py stand-in, so they run on
+machines without GPU. Sizes can be tuned with DEEPDEWEDGE_BENCH_TOMOS and
+DEEPDEWEDGE_BENCH_SIZE, and the timings are written as JSON to the file
+given in DEEPDEWEDGE_BENCH_OUTPUT.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestProject
+
+from deepdewedge import Plugin
+from deepdewedge.protocols import DeepDeWedgeDenoising
+from deepdewedge.utils import SubtomoStore, extractSubtomos, getExtractionPositions, \
+    screenMask, getTiles, TileBlender, loadStepMetrics
+from deepdewedge.constants import METRICS_DIR
+from deepdewedge.tests.synthetic import createDataset, createSlabMask
+from deepdewedge.tests.helpers import FAKE_DDW, runFakeDeepdewedge, startFakeWorker, createTomoSet
+
+NUM_TOMOS = int(os.environ.get('DEEPDEWEDGE_BENCH_TOMOS', 200))
+VOL_SIZE = int(os.environ.get('DEEPDEWEDGE_BENCH_SIZE', 64))
+BENCH_OUTPUT = os.environ.get('DEEPDEWEDGE_BENCH_OUTPUT')
+
+_results = {}
+
+
+def measure(name, func, *args, **kwargs):
+    """ Run func recording its wall time and its peak of traced Python and
+    numpy allocations. Memory mapped pages are not counted. """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    _results[name] = {'seconds': elapsed, 'peakBytes': peak}
+    print('%-45s %10.4f s %12.1f MB' % (name, elapsed, peak / 1024 ** 2))
+    if BENCH_OUTPUT:
+        with open(BENCH_OUTPUT, 'w') as f:
+            json.dump(_results, f, indent=2)
+    return result
+
+
+class TestDeepDeWedgeHelpersBenchmark(BaseTest):
+    """ Scaling of the in-plugin numerical helpers. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp(prefix='ddw_bench_')
+        cls.dataset = createDataset(cls.tmpDir, 1, (VOL_SIZE,) * 3, maskFraction=0.5)
+
+    def _extract(self, name, strides):
+        _, fnOdd, fnEven, _ = self.dataset[0]
+        box = VOL_SIZE // 4
+        positions = getExtractionPositions((VOL_SIZE,) * 3, box, strides)
+        store = SubtomoStore.create(os.path.join(self.tmpDir, name), box, chunkSize=32)
+        label = 'extraction %s (%d subtomos)' % (name, len(positions))
+        measure(label, extractSubtomos, store, fnOdd, fnEven, positions, 0.1)
+        store.close()
+        return _results[label]['peakBytes']
+
+    def testExtractionMemoryIsFlat(self):
+        box = VOL_SIZE // 4
+        peakFew = self._extract('coarse', (box, box, box))
+        peakMany = self._extract('fine', (box // 4,) * 3)
+        # Many more subtomograms should not need much more memory
+        self.assertLess(peakMany, 3 * peakFew + 1024 ** 2)
+
+    def testMaskScreening(self):
+        fnMask = createSlabMask(os.path.join(self.tmpDir, 'big_mask.mrc'), (2 * VOL_SIZE,) * 3)
+        positions, _, candidates = measure('mask screening', screenMask, fnMask,
+                                           VOL_SIZE // 4, (4, 4, 4), 0.3)
+        self.assertGreater(candidates, len(positions))
+
+    def testTiledBlending(self):
+        _, fnOdd, _, _ = self.dataset[0]
+        data = mrcfile.read(fnOdd)
+        fnOut = os.path.join(self.tmpDir, 'blended.mrc')
+
+        def blend():
+            blender = TileBlender(fnOut, data.shape, 8)
+            for tile in getTiles(data.shape, VOL_SIZE // 2, 8):
+                blender.add(tile, data[tile])
+            blender.close()
+
+        measure('tiled blending', blend)
+        self.assertTrue(np.allclose(mrcfile.read(fnOut), data, atol=1e-5))
+        # The tiles of half the volume size, and no full size temporary
+        self.assertLess(_results['tiled blending']['peakBytes'], data.nbytes / 2)
+
+
+class TestDeepDeWedgeWorkerBenchmark(BaseTest):
+    """ Job launch overhead with a new process per job and with the warm
+    worker, both running the stand-in tool. """
+    NUM_JOBS = 10
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp(prefix='ddw_worker_')
+        cls.worker = startFakeWorker(cls.tmpDir)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.worker is not None:
+            cls.worker.shutdown()
+
+    def _fitArgs(self, i):
+        return ['fit-model', '--num-epochs', '1', '--subtomo-dir', self.tmpDir,
+                '--logdir', os.path.join(self.tmpDir, 'fit%d' % i)]
+
+    def testWarmWorker(self):
+        self.assertIsNotNone(self.worker, 'The stand-in worker did not start.')
+
+        def launchEach():
+            for i in range(self.NUM_JOBS):
+                subprocess.check_call([sys.executable, FAKE_DDW] + self._fitArgs(i),
+                                      stdout=subprocess.DEVNULL)
+
+        def runInWorker():
+            for i in range(self.NUM_JOBS):
+                fnLog = os.path.join(self.tmpDir, 'job%d.log' % i)
+                self.assertEqual(self.worker.run(self._fitArgs(i), fnLog), 0)
+
+        measure('%d jobs, one process each' % self.NUM_JOBS, launchEach)
+        measure('%d jobs, warm worker' % self.NUM_JOBS, runInWorker)
+        self.assertLess(_results['%d jobs, warm worker' % self.NUM_JOBS]['seconds'],
+                        _results['%d jobs, one process each' % self.NUM_JOBS]['seconds'])
+
+
+class TestDeepDeWedgeProtocolBenchmark(BaseTest):
+    """ Cost of the protocol bookkeeping for many tomograms. """
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.dataDir = cls.proj.getTmpPath()
+        cls.smallDataset = createDataset(cls.dataDir, 4, (VOL_SIZE // 2,) * 3)
+
+    def _newProtocol(self, tomoSet, **kwargs):
+        prot = self.newProtocol(DeepDeWedgeDenoising, boxsize=VOL_SIZE // 4,
+                                useSubtomoCache=False, **kwargs)
+        prot.inputTomograms.set(tomoSet)
+        self.proj.saveProtocol(prot)
+        return prot
+
+    def testStepInsertionScaling(self):
+        times = []
+        for n in [NUM_TOMOS // 4, NUM_TOMOS]:
+            fakeDataset = [('TS_%05d' % i, 'odd_%d.mrc' % i, 'even_%d.mrc' % i, None)
+                           for i in range(n)]
+            prot = self._newProtocol(createTomoSet(self, 'insert%d' % n, fakeDataset))
+            label = 'step insertion (%d tomos)' % n
+            measure(label, prot._insertAllSteps)
+            times.append(_results[label]['seconds'])
+            self.assertEqual(len(prot._steps), 3 * n + 2)
+        # Four times more tomograms must not cost much more than four times
+        self.assertLess(times[1], 8 * times[0] + 0.5)
+
+    def testStagesWithFakeTool(self):
+        prot = self._newProtocol(createTomoSet(self, 'stages', self.smallDataset), epochs=2)
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            measure('create tomo list', prot.createTomoListStep)
+            for fitName, tomos in prot._getFitGroups().items():
+                measure('prepare %s' % fitName, prot.prepareDataForDeepDeWedge, fitName, tomos)
+                measure('fit %s' % fitName, prot.fittingModelStep, fitName)
+                measure('refine %s' % fitName, prot.refineModelStep, fitName, tomos)
+            measure('output registration', prot.createOutputStep)
+
+        outTomos = getattr(prot, 'Tomograms')
+        self.assertEqual(outTomos.getSize(), len(self.smallDataset))
+        fitMetrics = loadStepMetrics(prot._getExtraPath(METRICS_DIR))['fit_%s' % self.smallDataset[0][0]]
+        self.assertEqual(len(fitMetrics['epochs']), 2)
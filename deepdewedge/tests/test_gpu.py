@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Device given to the deepdewedge jobs, with fake device ids. The jobs run the
+fake_ddw.py stand-in, which records the CUDA_VISIBLE_DEVICES it was given,
+so no GPU is needed.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from pyworkflow.tests import BaseTest
+
+from deepdewedge import Plugin
+from deepdewedge.tests.fake_ddw import DEVICE_LOG_VAR
+from deepdewedge.tests.helpers import FAKE_DDW
+
+
+class FakeProtocol:
+    """ The part of a protocol used by Plugin.runDeepdewedge. The GPU list
+    is the one the step executor booked for the running step. """
+
+    def __init__(self, gpuIds):
+        self._gpuIds = gpuIds
+
+    def getGpuList(self):
+        return self._gpuIds
+
+    def runJob(self, program, args, env=None, cwd=None, numberOfMpi=1):
+        subprocess.check_call('%s %s' % (program, args), shell=True, env=env, cwd=cwd,
+                              stdout=subprocess.DEVNULL)
+
+
+class TestRunDeepdewedgeDevice(BaseTest):
+    """ Plugin.runDeepdewedge running on the device of the step. """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_gpu_')
+        self.fnDevices = os.path.join(self.tmpDir, 'devices.log')
+        patcher = mock.patch.multiple(Plugin, getCondaActivationCmd=mock.Mock(return_value=''),
+                                      getDeepdewedgeEnvActivation=mock.Mock(return_value='true'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _runFit(self, protocol, **kwargs):
+        args = '--num-epochs 1 --subtomo-dir %s --logdir %s' % (self.tmpDir,
+                                                                os.path.join(self.tmpDir, 'fit'))
+        with mock.patch.dict(os.environ, {DEVICE_LOG_VAR: self.fnDevices}):
+            Plugin.runDeepdewedge(protocol, '%s %s fit-model' % (sys.executable, FAKE_DDW), args,
+                                  **kwargs)
+        with open(self.fnDevices) as f:
+            return [line.rsplit(' ', 2)[0] for line in f.read().splitlines()]
+
+    def testStepDevice(self):
+        self.assertEqual(self._runFit(FakeProtocol(['fake_b', 'fake_c'])), ['fake_b'])
+
+    def testWithoutGpuList(self):
+        self.assertEqual(self._runFit(FakeProtocol([])), ['0'])
+
+    def testCpuJob(self):
+        self.assertEqual(self._runFit(FakeProtocol(['fake_a']), gpuId=''), [''])
+
+    def testFailedJob(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            Plugin.runDeepdewedge(FakeProtocol(['fake_a']),
+                                  '%s %s fit-model' % (sys.executable, FAKE_DDW),
+                                  '--missing-required-args')
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Import time budget of the plugin. Every measure runs in a new interpreter
+where pyworkflow, pwem and tomo are already loaded, as Scipion has them
+when it discovers the plugins, so only the plugin's own cost is timed. The
+budget, in seconds, can be changed with DEEPDEWEDGE_IMPORT_BUDGET. Only the
+modules the plugin import adds to the already loaded ones are checked.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from pyworkflow.tests import BaseTest
+
+IMPORT_BUDGET = float(os.environ.get('DEEPDEWEDGE_IMPORT_BUDGET', 0.5))
+REPEATS = 3
+
+MEASURE_SCRIPT = """
+import json, sys, time
+import pyworkflow.protocol, pwem, pwem.protocols, tomo.objects
+t0 = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - t0
+print(json.dumps({'seconds': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+# Modules only needed when a protocol runs
+LAZY_MODULES = ['deepdewedge.utils.subtomo_store', 'deepdewedge.utils.masks',
+                'deepdewedge.utils.tiling', 'deepdewedge.utils.autotune',
+                'deepdewedge.utils.worker', 'deepdewedge.utils.binning',
+                'deepdewedge.utils.precision']
+
+
+def measureImport(module):
+    """ Best time of a few fresh imports of module, and the modules it added. """
+    results = []
+    for _ in range(REPEATS):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE_SCRIPT % module])
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    best = min(results, key=lambda r: r['seconds'])
+    print('import %-25s %8.4f s' % (module, best['seconds']))
+    return best['seconds'], best['modules']
+
+
+class TestDeepDeWedgeImportTime(BaseTest):
+    """ Loading the plugin stays cheap and does not fail on optional modules. """
+
+    def testPluginImport(self):
+        seconds, modules = measureImport('deepdewedge')
+        self.assertLess(seconds, IMPORT_BUDGET)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules)
+
+    def testProtocolsImport(self):
+        seconds, modules = measureImport('deepdewedge.protocols')
+        self.assertLess(seconds, IMPORT_BUDGET)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules)
+
+    def testOptionalModulesImport(self):
+        for module in ['deepdewedge.wizards', 'deepdewedge.viewers']:
+            seconds, _ = measureImport(module)
+            self.assertLess(seconds, IMPORT_BUDGET)
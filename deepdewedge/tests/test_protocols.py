@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Protocol steps run one after the other on small synthetic data, with the
+fake_ddw.py stand-in in place of the deepdewedge tools, so they run on
+machines without GPU.
+"""
+
+import glob
+import json
+import os
+import shutil
+import sys
+from unittest import mock
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.object import Set
+from pyworkflow.tests import BaseTest, setupTestProject
+
+from deepdewedge import Plugin, utils
+from deepdewedge.protocols import DeepDeWedgeDenoising, DeepDeWedgeSweep, DeepDeWedgeApplyModel, \
+    protocol_deepDeWedge
+from deepdewedge.utils import PlateauDetector, loadStepMetrics
+from deepdewedge.constants import EARLY_STOP_FN, METRICS_DIR, JOINT_MODEL, CACHE_STATUS_FN, \
+    SUBTOMO_STORE_DIR, MEAN_STD_FN, SWEEP_FN, TRAIN_DATA_FN, MASK_POSITIONS_FN
+from deepdewedge.protocols.protocol_deepDeWedge import OUTPUT_TOMOS, OUTPUT_PREVIEW, PREVIEW_MODEL, \
+    MIN_PREVIEW_BOXSIZE
+from deepdewedge.tests.fake_ddw import EPOCH_TIME_VAR, PLATEAU_EPOCH_VAR
+from deepdewedge.tests.synthetic import createDataset, writeMrc
+from deepdewedge.tests.helpers import runFakeDeepdewedge, startFakeWorker, createTomoSet, \
+    appendTomos
+
+VOL_SIZE = 32
+
+
+class TestPlateauDetector(BaseTest):
+
+    def testPlateau(self):
+        detector = PlateauDetector(tolerance=0.01, patience=2)
+        stops = [detector.update(epoch, loss)
+                 for epoch, loss in enumerate([1.0, 0.5, 0.4, 0.399, 0.398])]
+        self.assertEqual(stops, [False, False, False, False, True])
+        # Lower losses within the tolerance are still kept as the best
+        self.assertEqual(detector.bestEpoch, 4)
+        self.assertAlmostEqual(detector.bestLoss, 0.398)
+
+    def testImprovementResetsPatience(self):
+        detector = PlateauDetector(tolerance=0.01, patience=2)
+        for epoch, loss in enumerate([1.0, 1.0, 0.5, 0.5]):
+            self.assertFalse(detector.update(epoch, loss))
+
+
+class TestDeepDeWedgeStepsBase(BaseTest):
+    """ Synthetic input set and protocols whose steps are called directly. """
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.dataset = createDataset(cls.proj.getTmpPath(), 2, (VOL_SIZE,) * 3)
+
+    def _createTomoSet(self, dataset, streamState=None):
+        return createTomoSet(self, 'input %s' % self._testMethodName, dataset, streamState)
+
+    def _newProtocol(self, protocolClass=DeepDeWedgeDenoising, dataset=None, **kwargs):
+        kwargs.setdefault('boxsize', VOL_SIZE // 4)
+        kwargs.setdefault('useSubtomoCache', False)
+        prot = self.newProtocol(protocolClass, **kwargs)
+        prot.inputTomograms.set(self._createTomoSet(dataset or self.dataset))
+        self.proj.saveProtocol(prot)
+        return prot
+
+
+class TestDeepDeWedgeStepGraph(TestDeepDeWedgeStepsBase):
+    """ Only the steps running the fit and refine tools book a GPU, so the
+    CPU steps of a group overlap with the GPU steps of another. """
+
+    def _getGpuSteps(self, prot):
+        prot._insertAllSteps()
+        return {step.funcName.get() for step in prot._steps if step.needsGPU()}
+
+    def testDenoisingGpuSteps(self):
+        prot = self._newProtocol(previewMode=True, previewBinning=2)
+        self.assertEqual(self._getGpuSteps(prot), {'fittingModelStep', 'refineModelStep'})
+
+    def testSweepGpuSteps(self):
+        prot = self._newProtocol(DeepDeWedgeSweep, sweepEpochs='1 2')
+        self.assertEqual(self._getGpuSteps(prot), {'fittingModelStep', 'refineModelStep'})
+
+
+class TestDeepDeWedgeEarlyStop(TestDeepDeWedgeStepsBase):
+    """ The fit stops once the validation loss of the stand-in plateaus,
+    both through the monitor and through the warm worker. """
+    MAX_EPOCHS = 30
+    FIT_ENV = {EPOCH_TIME_VAR: '0.2', PLATEAU_EPOCH_VAR: '2'}
+
+    @classmethod
+    def setUpClass(cls):
+        TestDeepDeWedgeStepsBase.setUpClass()
+        cls.worker = startFakeWorker(cls.proj.getTmpPath(), env=dict(os.environ, **cls.FIT_ENV))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.worker is not None:
+            cls.worker.shutdown()
+
+    def _fitUntilPlateau(self, prot):
+        fitName, tomos = list(prot._getFitGroups().items())[0]
+        with mock.patch.dict(os.environ, self.FIT_ENV), \
+                mock.patch.object(protocol_deepDeWedge, 'EARLY_STOP_POLL_SECONDS', 0.1):
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(fitName, tomos)
+            prot.fittingModelStep(fitName)
+
+        # Epochs 3 and 4 do not improve on epoch 2
+        with open(prot._getTomoPath(fitName, EARLY_STOP_FN)) as f:
+            report = json.load(f)
+        self.assertEqual(report['stoppedAtEpoch'], 4)
+        self.assertEqual(report['bestEpoch'], 2)
+        self.assertEqual(report['maxEpochs'], self.MAX_EPOCHS)
+
+        fitMetrics = loadStepMetrics(prot._getExtraPath(METRICS_DIR))['fit_%s' % fitName]
+        self.assertTrue(fitMetrics['stopped'])
+        self.assertEqual(fitMetrics['returnCode'], 0)
+        self.assertLess(len(fitMetrics['epochs']), self.MAX_EPOCHS)
+
+    def _newEarlyStopProtocol(self, **kwargs):
+        return self._newProtocol(epochs=self.MAX_EPOCHS, adaptiveEpochs=True, esPatience=2,
+                                 esTolerance=0.01, **kwargs)
+
+    def testStopThroughMonitor(self):
+        prot = self._newEarlyStopProtocol()
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            self._fitUntilPlateau(prot)
+
+    def testStopThroughWorker(self):
+        self.assertIsNotNone(self.worker, 'The stand-in worker did not start.')
+        prot = self._newEarlyStopProtocol(useWarmWorker=True)
+        with mock.patch.object(Plugin, 'getWorker', return_value=self.worker):
+            self._fitUntilPlateau(prot)
+
+
+class TestDeepDeWedgeAutotune(TestDeepDeWedgeStepsBase):
+    """ The fit gets the tuned batch size, limited by the configured one
+    when the GPU memory cannot be queried. """
+
+    def _getModule(self):
+        # Not imported by name, which would hide the utils.autotune function
+        return sys.modules[utils.autotune.__module__]
+
+    def _fit(self, prot, gpuFree):
+        fitName = list(prot._getFitGroups())[0]
+        autotuneModule = self._getModule()
+        with mock.patch.object(autotuneModule, 'getFreeGpuMemory', return_value=gpuFree), \
+                mock.patch.object(autotuneModule, 'getNumCores', return_value=4), \
+                mock.patch.object(Plugin, 'runDeepdewedge') as runDeepdewedge:
+            prot.createTomoListStep()
+            prot.fittingModelStep(fitName)
+        return fitName, runDeepdewedge.call_args.kwargs['args']
+
+    def testFallback(self):
+        prot = self._newProtocol(autotune=True, batchSize=6, adaptiveEpochs=False)
+        fitName, args = self._fit(prot, None)
+        self.assertEqual(prot._getAutotune(fitName)['gpuFreeBytes'], None)
+        self.assertEqual(prot._getBatchSize(fitName), 4)
+        self.assertIn(' --batch-size 4 ', args)
+        self.assertIn(' --num-workers 3 ', args)
+
+    def testGpuProbe(self):
+        prot = self._newProtocol(autotune=True, batchSize=1, adaptiveEpochs=False)
+        fitName, args = self._fit(prot, 16 * 1024 ** 3)
+        maxBatchSize = self._getModule().MAX_BATCH_SIZE
+        self.assertEqual(prot._getBatchSize(fitName), maxBatchSize)
+        self.assertIn(' --batch-size %d ' % maxBatchSize, args)
+
+    def testDisabled(self):
+        prot = self._newProtocol(autotune=False, batchSize=6, numworkers=2,
+                                 adaptiveEpochs=False)
+        fitName, args = self._fit(prot, None)
+        self.assertIsNone(prot._getAutotune(fitName))
+        self.assertIn(' --batch-size 6 ', args)
+        self.assertIn(' --num-workers 2 ', args)
+
+
+class TestDeepDeWedgeTiledRefine(TestDeepDeWedgeStepsBase):
+    """ Tiles normalized with the whole tomogram statistics give the same
+    refined tomogram as refining it whole, with the stand-in model
+    normalizing like the real one. """
+
+    def _refine(self, **kwargs):
+        prot = self._newProtocol(**kwargs)
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            prot.createTomoListStep()
+            for fitName, tomos in prot._getFitGroups().items():
+                prot.prepareDataForDeepDeWedge(fitName, tomos)
+                prot.fittingModelStep(fitName)
+                prot.refineModelStep(fitName, tomos)
+        return [mrcfile.read(prot._getRefinedTomo(tsId, fnOdd))
+                for tsId, fnOdd, _, _ in self.dataset]
+
+    def testTiledMatchesWhole(self):
+        wholeTomos = self._refine()
+        tiledTomos = self._refine(tiledRefine=True, tileSize=VOL_SIZE // 2, subtomoOverlap=4)
+        for whole, tiled in zip(wholeTomos, tiledTomos):
+            self.assertTrue(np.allclose(tiled, whole, atol=1e-4))
+
+
+class TestDeepDeWedgeRoiRefine(TestDeepDeWedgeStepsBase):
+    """ The mask bounding box is cropped from the half maps and the refined
+    crop is pasted back at the same place. """
+
+    def testCropPaste(self):
+        prot = self._newProtocol(roiRefine=True, roiPadding=2)
+        fitName, tomos = list(prot._getFitGroups().items())[0]
+        tsId, fnOdd, fnEven = tomos[0]
+        # A mask at the corner of the volume, so the box is clipped
+        mask = np.zeros((VOL_SIZE,) * 3, dtype=np.int8)
+        mask[-6:, :5, 10:14] = 1
+        fnMask = os.path.join(self.proj.getTmpPath(), 'roi_mask.mrc')
+        writeMrc(fnMask, mask)
+
+        prot.createTomoListStep()
+        with mock.patch.object(prot, '_getMaskFile', return_value=fnMask):
+            rois = prot._cropRois(fitName, tomos[:1])
+        roiInfo = rois[tsId]
+        roi = roiInfo['roi']
+        self.assertEqual(roi[0].stop, VOL_SIZE)
+        self.assertEqual(roi[1].start, 0)
+        odd, even = mrcfile.read(fnOdd), mrcfile.read(fnEven)
+        self.assertTrue(np.array_equal(mrcfile.read(roiInfo['tomo'][1]), odd[roi]))
+        self.assertTrue(np.array_equal(mrcfile.read(roiInfo['tomo'][2]), even[roi]))
+
+        # The odd crop stands for the refined one
+        prot._pasteRoi(fitName, roiInfo, roiInfo['tomo'][1])
+        pasted = mrcfile.read(prot._getRefinedTomo(fitName, fnOdd))
+        self.assertTrue(np.array_equal(pasted[roi], odd[roi]))
+        outside = np.ones(pasted.shape, dtype=bool)
+        outside[roi] = False
+        fill = (odd.mean(dtype=np.float64) + even.mean(dtype=np.float64)) / 2
+        self.assertTrue(np.allclose(pasted[outside], fill, atol=1e-5))
+
+
+class TestDeepDeWedgePreview(TestDeepDeWedgeStepsBase):
+    """ Preview fitted and refined on the binned half maps. """
+
+    def testPreviewBoxSize(self):
+        prot = self._newProtocol(previewMode=True, boxsize=128)
+        with mock.patch.object(prot, '_getPreviewMinSize', return_value=200):
+            for binning, boxSize in [(2, 64), (4, 32), (8, MIN_PREVIEW_BOXSIZE)]:
+                prot.previewBinning.set(binning)
+                self.assertEqual(prot._getBoxSize(PREVIEW_MODEL), boxSize)
+            self.assertEqual(prot._getBoxSize(JOINT_MODEL), 128)
+        # No larger than the binned tomograms
+        with mock.patch.object(prot, '_getPreviewMinSize', return_value=45):
+            prot.previewBinning.set(2)
+            self.assertEqual(prot._getBoxSize(PREVIEW_MODEL), 40)
+
+    def testPreviewOnly(self):
+        prot = self._newProtocol(previewMode=True, previewOnly=True, previewBinning=2,
+                                 previewEpochs=1, boxsize=64)
+        prot._insertAllSteps()
+        funcNames = [step.funcName.get() for step in prot._steps]
+        self.assertEqual(funcNames[:4], ['createTomoListStep', 'binTomogramsStep',
+                                         'prepareDataForDeepDeWedge', 'fittingModelStep'])
+        self.assertEqual(funcNames[-1], 'createPreviewOutputStep')
+        self.assertNotIn('createOutputStep', funcNames)
+
+        tomos = prot._getPreviewTomos()
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            prot.createTomoListStep()
+            prot.binTomogramsStep()
+            self.assertEqual(prot._getBoxSize(PREVIEW_MODEL), VOL_SIZE // 2)
+            prot.prepareDataForDeepDeWedge(PREVIEW_MODEL, tomos)
+            prot.fittingModelStep(PREVIEW_MODEL)
+            prot.refineModelStep(PREVIEW_MODEL, tomos)
+            prot.createPreviewOutputStep()
+
+        preview = getattr(prot, OUTPUT_PREVIEW)
+        self.assertEqual(preview.getSize(), len(self.dataset))
+        self.assertAlmostEqual(preview.getSamplingRate(), 2.0)
+        for tomo in preview:
+            self.assertEqual(mrcfile.read(tomo.getFileName()).shape, (VOL_SIZE // 2,) * 3)
+
+
+class TestDeepDeWedgeResume(TestDeepDeWedgeStepsBase):
+    """ Steps executed again after an interruption reuse what was finished. """
+
+    def _newJointProtocol(self, **kwargs):
+        prot = self._newProtocol(jointFit=True, **kwargs)
+        return prot, prot._getFitGroups()[JOINT_MODEL]
+
+    def testResumeFit(self):
+        prot, tomos = self._newJointProtocol(epochs=4)
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge) as run:
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, tomos)
+            # A fit interrupted after 2 of its 4 epochs
+            runFakeDeepdewedge(prot, 'ddw fit-model', '--num-epochs 2 --subtomo-dir %s --logdir %s'
+                               % (prot._getSubtomoDir(JOINT_MODEL), prot._getFitDir(JOINT_MODEL)))
+            prot.fittingModelStep(JOINT_MODEL)
+            fitCalls = run.call_count
+            # Once finished, the fit is not run again
+            prot.fittingModelStep(JOINT_MODEL)
+            self.assertEqual(run.call_count, fitCalls)
+
+        args = run.call_args.kwargs['args']
+        self.assertIn('--resume-from-checkpoint', args)
+        self.assertIn('--num-epochs 2 ', args)
+        self.assertEqual(protocol_deepDeWedge._ckptEpoch(prot._getLatestCheckpoint(JOINT_MODEL)), 3)
+        fitMetrics = loadStepMetrics(prot._getExtraPath(METRICS_DIR))['fit_%s' % JOINT_MODEL]
+        self.assertEqual([epoch['epoch'] for epoch in fitMetrics['epochs']], [2, 3])
+
+    def testSkipRefinedTomograms(self):
+        prot, tomos = self._newJointProtocol()
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge) as run:
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, tomos)
+            prot.fittingModelStep(JOINT_MODEL)
+            prot.refineModelStep(JOINT_MODEL, tomos)
+            # The refinement of the second tomogram did not finish
+            os.remove(prot._getRefinedMarker(JOINT_MODEL, tomos[1][0]))
+            run.reset_mock()
+            prot.refineModelStep(JOINT_MODEL, tomos)
+
+        self.assertEqual(run.call_count, 1)
+        args = run.call_args.kwargs['args']
+        self.assertIn(tomos[1][1], args)
+        self.assertNotIn(tomos[0][1], args)
+        self.assertTrue(prot._isRefined(JOINT_MODEL, tomos[1][0]))
+
+    def testExtractAgainAfterCacheEviction(self):
+        prot, tomos = self._newJointProtocol(useSubtomoCache=True)
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, tomos)
+            # The cache entry the extraction links to is evicted
+            with open(prot._getTomoPath(JOINT_MODEL, CACHE_STATUS_FN)) as f:
+                key = json.load(f)['key']
+            shutil.rmtree(prot._getSubtomoCache().getEntryPath(key))
+            self.assertFalse(prot._hasSubtomos(JOINT_MODEL))
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, tomos)
+
+        self.assertTrue(prot._hasSubtomos(JOINT_MODEL))
+
+
+class TestDeepDeWedgeMaskCache(TestDeepDeWedgeStepsBase):
+    """ A cached extraction keeps its mask screening, so reusing it does
+    not screen the masks again. """
+
+    def _prepare(self, dataset):
+        prot = self._newProtocol(dataset=dataset, jointFit=True, useSubtomoCache=True,
+                                 extractInPlugin=True, minNonZeroMaskSubtomo=0.5)
+        tomos = prot._getFitGroups()[JOINT_MODEL]
+        fnMasks = {tsId: fnMask for tsId, _, _, fnMask in dataset}
+        with mock.patch.object(prot, '_getMaskFile', side_effect=fnMasks.get), \
+                mock.patch.object(prot, '_screenMasks', wraps=prot._screenMasks) as screen:
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, tomos)
+        with open(prot._getTomoPath(JOINT_MODEL, CACHE_STATUS_FN)) as f:
+            return prot, json.load(f)['hit'], screen.call_count
+
+    def testReuseScreening(self):
+        dataset = createDataset(os.path.join(self.proj.getTmpPath(), 'masked'), 2,
+                                (VOL_SIZE,) * 3, maskFraction=0.5)
+        prot, hit, screenings = self._prepare(dataset)
+        self.assertFalse(hit)
+        self.assertEqual(screenings, 1)
+        positions = np.load(os.path.join(prot._getSubtomoDir(JOINT_MODEL), MASK_POSITIONS_FN))
+        self.assertEqual(sorted(positions.files), [tsId for tsId, _, _, _ in dataset])
+
+        reused, hit, screenings = self._prepare(dataset)
+        self.assertTrue(hit)
+        self.assertEqual(screenings, 0)
+        self.assertEqual(reused._getMaskScreening(), prot._getMaskScreening())
+        self.assertEqual(sorted(reused._getMaskScreening()), [tsId for tsId, _, _, _ in dataset])
+
+
+class TestDeepDeWedgeHalfPrecision(TestDeepDeWedgeStepsBase):
+    """ Subtomograms out of the float16 range are stored as float32. """
+
+    def testSubtomosOutOfRange(self):
+        dataset = createDataset(os.path.join(self.proj.getTmpPath(), 'bright'), 1, (VOL_SIZE,) * 3)
+        for _, fnOdd, fnEven, _ in dataset:
+            for fn in [fnOdd, fnEven]:
+                writeMrc(fn, mrcfile.read(fn) * 1e5)
+        prot = self._newProtocol(dataset=dataset, extractInPlugin=True, halfPrecision=True)
+        fitName, tomos = list(prot._getFitGroups().items())[0]
+        prot.createTomoListStep()
+        prot.prepareDataForDeepDeWedge(fitName, tomos)
+
+        # The store is removed once exported
+        subtomoDir = prot._getSubtomoDir(fitName)
+        self.assertFalse(os.path.exists(os.path.join(subtomoDir, SUBTOMO_STORE_DIR)))
+        with np.load(os.path.join(subtomoDir, TRAIN_DATA_FN)) as data:
+            self.assertEqual(data['subtomos0'].dtype, np.float32)
+        stats = np.load(os.path.join(subtomoDir, MEAN_STD_FN))
+        self.assertTrue(np.isfinite([stats['mean'], stats['std']]).all())
+        self.assertIn('%s subtomograms: out of the float16 range, stored as float32' % fitName,
+                      prot._summary())
+
+
+class TestDeepDeWedgeSweep(TestDeepDeWedgeStepsBase):
+    """ The sweep records the validation loss and the fit time of every
+    configuration and picks the lowest loss. """
+
+    def _rejectConstant(self, name):
+        raise ValueError('%s in the sweep report' % name)
+
+    def testSelectBestModel(self):
+        prot = self._newProtocol(DeepDeWedgeSweep, sweepEpochs='1 3')
+        configs = list(prot._getSweepConfigs())
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, prot._getTomoList())
+            for configName in configs:
+                prot.fittingModelStep(configName)
+        # A checkpoint without the loss in its name, the loss is read from the log
+        fnCkpt = prot._getModelCheckpoint(configs[1])
+        os.rename(fnCkpt, os.path.join(os.path.dirname(fnCkpt), 'last.ckpt'))
+        prot.selectBestModelStep()
+
+        with open(prot._getExtraPath(SWEEP_FN)) as f:
+            report = json.load(f, parse_constant=self._rejectConstant)
+        self.assertEqual(report['best'], configs[1])
+        self.assertAlmostEqual(report['configs'][configs[0]]['valLoss'], 1.05)
+        self.assertAlmostEqual(report['configs'][configs[1]]['valLoss'], 1 / 3. + 0.05, places=5)
+        for configName in configs:
+            with open(prot._getMetricsFile('fit_%s' % configName)) as f:
+                wallTime = json.load(f)['wallTime']
+            self.assertEqual(report['configs'][configName]['wallTime'], wallTime)
+
+    def testFitWithoutLoss(self):
+        prot = self._newProtocol(DeepDeWedgeSweep, sweepEpochs='1 2')
+        configs = list(prot._getSweepConfigs())
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge):
+            prot.createTomoListStep()
+            prot.prepareDataForDeepDeWedge(JOINT_MODEL, prot._getTomoList())
+            prot.fittingModelStep(configs[0])
+        prot.selectBestModelStep()
+
+        with open(prot._getExtraPath(SWEEP_FN)) as f:
+            report = json.load(f, parse_constant=self._rejectConstant)
+        self.assertEqual(report['best'], configs[0])
+        self.assertIsNone(report['configs'][configs[1]]['valLoss'])
+        self.assertIsNone(report['configs'][configs[1]]['wallTime'])
+
+
+class TestDeepDeWedgeApplyStreaming(TestDeepDeWedgeStepsBase):
+    """ A model applied to an input set that is still being filled. """
+
+    def _fitModel(self):
+        fitDir = os.path.join(self.proj.getTmpPath(), 'fitted_%s' % self._testMethodName)
+        runFakeDeepdewedge(None, 'ddw fit-model',
+                           '--num-epochs 1 --subtomo-dir %s --logdir %s' % (fitDir, fitDir))
+        return glob.glob(os.path.join(fitDir, '**', '*.ckpt'), recursive=True)[0]
+
+    def _runNewRefineSteps(self, prot, doneSteps):
+        for step in prot._steps:
+            if step.funcName.get() == prot.refineModelStep.__name__ and step not in doneSteps:
+                prot.refineModelStep(*json.loads(step.argsStr.get()))
+                doneSteps.append(step)
+
+    def testAppendThenClose(self):
+        tomoSet = self._createTomoSet(self.dataset[:1], streamState=Set.STREAM_OPEN)
+        prot = self.newProtocol(DeepDeWedgeApplyModel, inputModel=self._fitModel(),
+                                boxsize=VOL_SIZE // 4, refineBatch=1)
+        prot.inputTomograms.set(tomoSet)
+        self.proj.saveProtocol(prot)
+
+        doneSteps = []
+        with mock.patch.object(Plugin, 'runDeepdewedge', side_effect=runFakeDeepdewedge), \
+                mock.patch.object(prot, 'updateSteps'):
+            prot._insertAllSteps()
+            prot.prepareModelStep()
+            prot._stepsCheck()
+            self._runNewRefineSteps(prot, doneSteps)
+            prot._stepsCheck()
+            output = getattr(prot, OUTPUT_TOMOS)
+            self.assertEqual(output.getSize(), 1)
+            self.assertTrue(output.isStreamOpen())
+
+            # The last tomogram arrives and the input is closed
+            tomoSet.enableAppend()
+            appendTomos(tomoSet, self.dataset[1:])
+            tomoSet.setStreamState(Set.STREAM_CLOSED)
+            tomoSet.write()
+            prot._stepsCheck()
+            # Closed input, but the new tomogram is not refined yet
+            self.assertTrue(getattr(prot, OUTPUT_TOMOS).isStreamOpen())
+            self._runNewRefineSteps(prot, doneSteps)
+            prot._stepsCheck()
+
+        output = getattr(prot, OUTPUT_TOMOS)
+        self.assertEqual(output.getSize(), len(self.dataset))
+        self.assertTrue(output.isStreamClosed())
+        self.assertEqual(len(doneSteps), len(self.dataset))
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Unit tests of the in-plugin helpers on small synthetic data.
+"""
+
+import itertools
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest
+
+from deepdewedge.utils import autotune, SubtomoCache, linkEntry, SubtomoStore, scoreSubtomos, selectSubtomos, getTiles, \
+    TileBlender, maskBoundingBox, maskFractions, screenMask, countsForThresholds, writeTile, pasteRoi, convertToFloat16, binVolume
+from deepdewedge.utils import cache, monitor, worker_server
+from deepdewedge.tests.synthetic import writeMrc
+
+BOX = 8
+
+
+class TestSubtomoCache(BaseTest):
+    """ LRU eviction under the size limit, hit/miss counting and pinning
+    of the entries in use. """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_cache_')
+        # Every access gets a later time, so the LRU order is exact
+        patcher = mock.patch.object(cache, 'time', **{'time.side_effect': itertools.count()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _extraction(self, name, size=100):
+        srcDir = os.path.join(self.tmpDir, 'src_%s' % name)
+        os.makedirs(srcDir)
+        with open(os.path.join(srcDir, 'data.bin'), 'wb') as f:
+            f.write(b'0' * size)
+        return srcDir
+
+    def _put(self, subtomoCache, name, user=None):
+        return subtomoCache.put(name, self._extraction(name), user=user)
+
+    def _cached(self, subtomoCache):
+        return sorted(key for key in 'abcd' if os.path.isdir(subtomoCache.getEntryPath(key)))
+
+    def testHitsAndMisses(self):
+        subtomoCache = SubtomoCache(os.path.join(self.tmpDir, 'cache'), 1000)
+        self.assertIsNone(subtomoCache.get('a'))
+        self._put(subtomoCache, 'a')
+        self.assertEqual(subtomoCache.get('a'), subtomoCache.getEntryPath('a'))
+        self.assertEqual(subtomoCache.get('a'), subtomoCache.getEntryPath('a'))
+        self.assertIsNone(subtomoCache.get('b'))
+        self.assertEqual(subtomoCache.getStats(),
+                         {'hits': 2, 'misses': 2, 'entries': 1, 'bytes': 100})
+
+    def testLruEviction(self):
+        subtomoCache = SubtomoCache(os.path.join(self.tmpDir, 'cache'), 250)
+        self._put(subtomoCache, 'a')
+        self._put(subtomoCache, 'b')
+        # Using a makes b the least recently used
+        subtomoCache.get('a')
+        self._put(subtomoCache, 'c')
+        self.assertEqual(self._cached(subtomoCache), ['a', 'c'])
+        self.assertLessEqual(subtomoCache.getStats()['bytes'], 250)
+        # An evicted entry is a miss
+        self.assertIsNone(subtomoCache.get('b'))
+
+    def testNewEntryOverTheLimit(self):
+        subtomoCache = SubtomoCache(os.path.join(self.tmpDir, 'cache'), 50)
+        self._put(subtomoCache, 'a')
+        self.assertEqual(self._cached(subtomoCache), ['a'])
+        self._put(subtomoCache, 'b')
+        self.assertEqual(self._cached(subtomoCache), ['b'])
+
+    def testPinnedEntriesKept(self):
+        subtomoCache = SubtomoCache(os.path.join(self.tmpDir, 'cache'), 250)
+        userDir = os.path.join(self.tmpDir, 'fit_a')
+        linkEntry(self._put(subtomoCache, 'a', user=userDir), userDir)
+        self._put(subtomoCache, 'b')
+        self._put(subtomoCache, 'c')
+        # The least recently used but linked by a running fit
+        self.assertEqual(self._cached(subtomoCache), ['a', 'c'])
+        self.assertTrue(os.path.exists(os.path.join(userDir, 'data.bin')))
+
+        subtomoCache.release('a', userDir)
+        self._put(subtomoCache, 'd')
+        self.assertEqual(self._cached(subtomoCache), ['c', 'd'])
+
+    def testStalePin(self):
+        subtomoCache = SubtomoCache(os.path.join(self.tmpDir, 'cache'), 150)
+        userDir = os.path.join(self.tmpDir, 'fit_a')
+        self._put(subtomoCache, 'a')
+        linkEntry(subtomoCache.get('a', user=userDir), userDir)
+        # The folder of a deleted protocol does not pin the entry
+        shutil.rmtree(userDir)
+        self._put(subtomoCache, 'b')
+        self.assertEqual(self._cached(subtomoCache), ['b'])
+
+
+class TestAutotune(BaseTest):
+    """ Batch size and data loader workers chosen from fake memory and core
+    probes. """
+    GIB = 1024 ** 3
+
+    def _autotune(self, gpuFree, hostFree=64 * GIB, cores=16, **kwargs):
+        module = sys.modules[autotune.__module__]
+        with mock.patch.object(module, 'getFreeGpuMemory', return_value=gpuFree), \
+                mock.patch.object(module, 'getNumCores', return_value=cores), \
+                mock.patch.object(module.psutil, 'virtual_memory',
+                                  return_value=mock.Mock(available=hostFree)):
+            return autotune(64, [0], **kwargs)
+
+    def testGpuLimit(self):
+        sample = sys.modules[autotune.__module__].estimateGpuSampleBytes(64)
+        for gpuFree, batchSize in [(8 * self.GIB, 4), (40 * self.GIB, 16), (self.GIB, 1)]:
+            choice = self._autotune(gpuFree, fallbackBatchSize=2)
+            self.assertEqual(choice['batchSize'], batchSize)
+            self.assertEqual(choice['gpuFreeBytes'], gpuFree)
+            self.assertLessEqual(choice['batchSize'] * sample, max(gpuFree - self.GIB, sample))
+
+    def testHostLimit(self):
+        choice = self._autotune(80 * self.GIB, hostFree=self.GIB // 4, cores=4)
+        # 0.7 * 256 MiB over 4 MiB samples, two batches per loader worker and the main process
+        self.assertEqual(choice['numWorkers'], 3)
+        self.assertEqual(choice['batchSize'], 4)
+
+    def testFallback(self):
+        # Without a GPU probe, the configured batch size is the limit
+        for fallback, batchSize in [(6, 4), (8, 8), (1, 1)]:
+            choice = self._autotune(None, fallbackBatchSize=fallback)
+            self.assertEqual(choice['batchSize'], batchSize)
+            self.assertIsNone(choice['gpuFreeBytes'])
+
+    def testWorkers(self):
+        for cores, jobs, numWorkers in [(16, 1, 8), (16, 2, 7), (4, 4, 1)]:
+            choice = self._autotune(8 * self.GIB, cores=cores, concurrentJobs=jobs)
+            self.assertEqual(choice['numWorkers'], numWorkers)
+
+
+class TestSubtomoStore(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_store_')
+
+    def _create(self, dtype):
+        return SubtomoStore.create(os.path.join(self.tmpDir, 'store'), BOX, chunkSize=4,
+                                   dtype=dtype)
+
+    def testFloat16Precision(self):
+        store = self._create('float16')
+        rng = np.random.default_rng(0)
+        for i in range(6):
+            store.append(*rng.normal(0, 1, (2,) + (BOX,) * 3), (0, i, 0, 0))
+        store.close()
+        report = store.getPrecisionReport()
+        self.assertEqual(len(store), 6)
+        self.assertFalse(report['overflow'])
+        self.assertLess(report['relativeRmsError'], 1e-3)
+
+    def testFloat16Overflow(self):
+        store = self._create('float16')
+        store.append(np.ones((BOX,) * 3), np.ones((BOX,) * 3), (0, 0, 0, 0))
+        with self.assertRaises(OverflowError):
+            store.append(np.full((BOX,) * 3, 1e6), np.ones((BOX,) * 3), (0, 1, 0, 0))
+        # The pair out of range is not added
+        self.assertEqual(len(store), 1)
+        store.close()
+        mean, std = store.computeMeanStd()
+        self.assertEqual((mean, std), (1.0, 0.0))
+
+    def testMeanStd(self):
+        # Far from zero, where summing squares would lose the variance
+        store = self._create('float32')
+        rng = np.random.default_rng(0)
+        pairs = rng.normal(1000, 2, (11, 2) + (BOX,) * 3).astype(np.float32)
+        for i, pair in enumerate(pairs):
+            store.append(pair[0], pair[1], (0, i, 0, 0), isVal=i % 3 == 0)
+        store.close()
+        valFlags = store.getValFlags()
+        for valFlag in [False, True]:
+            selected = pairs[valFlags == valFlag].astype(np.float64)
+            mean, std = store.computeMeanStd(valFlag, batchSize=3)
+            self.assertAlmostEqual(mean, selected.mean(), places=6)
+            self.assertAlmostEqual(std, selected.std(), places=6)
+
+
+class TestSubtomoSelection(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_selection_')
+
+    def testScores(self):
+        # Noise in the first half along x, flat elsewhere
+        vol = np.zeros((32, 32, 32), dtype=np.float32)
+        vol[:, :, :16] = np.random.default_rng(0).normal(0, 1, (32, 32, 16))
+        fnTomo = os.path.join(self.tmpDir, 'tomo.mrc')
+        writeMrc(fnTomo, vol)
+        positions = [(0, 0, 0), (0, 0, 16), (16, 16, 0)]
+        scores = scoreSubtomos(fnTomo, positions, 16, factor=2)
+        self.assertGreater(scores[0], 0)
+        self.assertEqual(scores[1], 0)
+        self.assertAlmostEqual(scores[0], scores[2], delta=0.5 * scores[0])
+
+        # The mask leaves out the second half along y
+        mask = np.zeros(vol.shape, dtype=np.float32)
+        mask[:, :16] = 1
+        fnMask = os.path.join(self.tmpDir, 'mask.mrc')
+        writeMrc(fnMask, mask)
+        maskedScores = scoreSubtomos(fnTomo, positions, 16, fnMask=fnMask, factor=2)
+        self.assertAlmostEqual(maskedScores[0], scores[0])
+        self.assertEqual(maskedScores[2], 0)
+
+    def testOverlapLowersScore(self):
+        positions = np.array([(0, 0, 0), (0, 0, 4), (0, 0, 16)])
+        candidates = {'TS_0': (positions, np.array([1.0, 0.9, 0.5]), (32, 32, 32))}
+        chosen = selectSubtomos(candidates, 8, 2, factor=1)
+        # The second box is mostly covered by the first one
+        self.assertEqual(chosen['TS_0'].tolist(), [[0, 0, 0], [0, 0, 16]])
+
+    def _stratify(self, counts, maxCount):
+        rng = np.random.default_rng(0)
+        candidates = {}
+        for i, count in enumerate(counts):
+            positions = np.stack([np.zeros(count), np.zeros(count), 8 * np.arange(count)],
+                                 axis=1).astype(np.int64)
+            candidates['TS_%d' % i] = (positions, rng.random(count), (8, 8, 8 * count))
+        chosen = selectSubtomos(candidates, 8, maxCount, stratify=True, factor=1)
+        return [len(chosen['TS_%d' % i]) for i in range(len(counts))]
+
+    def testStratifiedQuotas(self):
+        # Rounding the shares alone would choose 3 of each
+        self.assertEqual(sorted(self._stratify([10, 10, 10], 10)), [3, 3, 4])
+        # The largest remainder is the one of the smallest tomogram
+        self.assertEqual(self._stratify([10, 10, 10, 1], 10), [3, 3, 3, 1])
+        self.assertEqual(sum(self._stratify([7, 5, 3, 2, 1], 9)), 9)
+
+    def testWithoutStratify(self):
+        positions = np.stack([np.zeros(6), np.zeros(6), 8 * np.arange(6)], axis=1).astype(np.int64)
+        candidates = {'TS_0': (positions, np.arange(6.), (8, 8, 48)),
+                      'TS_1': (positions, np.zeros(6), (8, 8, 48))}
+        chosen = selectSubtomos(candidates, 8, 4, factor=1)
+        # The best scores, all in the first tomogram
+        self.assertEqual(chosen['TS_0'][:, 2].tolist(), [16, 24, 32, 40])
+        self.assertEqual(len(chosen['TS_1']), 0)
+
+
+class TestMaskScreening(BaseTest):
+    """ The summed volume table gives the brute force mask fractions. """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_masks_')
+        self.mask = (np.random.default_rng(0).random((13, 11, 9)) > 0.6).astype(np.int8)
+
+    def testFractions(self):
+        box = 4
+        # Every corner, so the boxes at the far edges of every axis are included
+        positions = np.stack(np.meshgrid(*[np.arange(dim - box + 1) for dim in self.mask.shape],
+                                         indexing='ij'), axis=-1).reshape(-1, 3)
+        fractions = maskFractions(self.mask, positions, box)
+        for (z, y, x), fraction in zip(positions, fractions):
+            self.assertAlmostEqual(fraction, self.mask[z:z + box, y:y + box, x:x + box].mean())
+
+    def testScreenMask(self):
+        fnMask = os.path.join(self.tmpDir, 'mask.mrc')
+        writeMrc(fnMask, self.mask)
+        box, strides = 4, (5, 3, 3)
+        accepted, fractions, total = screenMask(fnMask, box, strides, minFraction=0.4)
+        expected = {(z, y, x): self.mask[z:z + box, y:y + box, x:x + box].mean()
+                    for z in range(0, 10, 3) for y in range(0, 8, 3) for x in range(0, 6, 5)}
+        self.assertEqual(total, len(expected))
+        self.assertEqual(sorted(map(tuple, accepted.tolist())),
+                         sorted(corner for corner, f in expected.items() if f >= 0.4))
+        for corner, fraction in zip(map(tuple, accepted.tolist()), fractions):
+            self.assertAlmostEqual(fraction, expected[corner])
+        counts = countsForThresholds(list(expected.values()), thresholds=(0.4,))
+        self.assertEqual(counts[0.4], len(accepted))
+
+
+class TestTileBlender(BaseTest):
+
+    def testBlendAndHeaderStats(self):
+        data = np.random.default_rng(0).normal(3, 2, (24, 20, 16)).astype(np.float32)
+        fnOut = os.path.join(tempfile.mkdtemp(prefix='ddw_blend_'), 'blended.mrc')
+        blender = TileBlender(fnOut, data.shape, 4)
+        for tile in getTiles(data.shape, 12, 4):
+            blender.add(tile, data[tile])
+        blender.close()
+
+        with mrcfile.open(fnOut, permissive=True) as mrc:
+            self.assertTrue(np.allclose(mrc.data, data, atol=1e-5))
+            header = mrc.header
+            self.assertAlmostEqual(float(header.dmin), data.min(), places=4)
+            self.assertAlmostEqual(float(header.dmax), data.max(), places=4)
+            self.assertAlmostEqual(float(header.dmean), data.mean(), places=4)
+            self.assertAlmostEqual(float(header.rms), data.std(), places=4)
+
+
+class TestRoi(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_roi_')
+
+    def _writeMask(self, box, shape=(40, 32, 24)):
+        mask = np.zeros(shape, dtype=np.int8)
+        mask[box] = 1
+        fnMask = os.path.join(self.tmpDir, 'mask.mrc')
+        writeMrc(fnMask, mask)
+        return fnMask
+
+    def testBoundingBox(self):
+        fnMask = self._writeMask(np.s_[10:20, 8:12, 5:9])
+        self.assertEqual(maskBoundingBox(fnMask, padding=2),
+                         (slice(8, 22), slice(6, 14), slice(3, 11)))
+        # Grown to the minimum size around the mask
+        self.assertEqual(maskBoundingBox(fnMask, minSize=16)[1], slice(2, 18))
+        self.assertIsNone(maskBoundingBox(self._writeMask(np.s_[0:0])))
+
+    def testBoundingBoxAtEdges(self):
+        fnMask = self._writeMask(np.s_[0:3, 28:32, 20:24])
+        roi = maskBoundingBox(fnMask, padding=4, minSize=12)
+        # Clipped to the volume and shifted to keep the minimum size
+        self.assertEqual(roi, (slice(0, 12), slice(20, 32), slice(12, 24)))
+
+    def testCropPasteRoundTrip(self):
+        shape = (40, 32, 24)
+        data = np.random.default_rng(0).normal(0, 1, shape).astype(np.float32)
+        fnTomo = os.path.join(self.tmpDir, 'tomo.mrc')
+        writeMrc(fnTomo, data)
+        for box in [np.s_[10:20, 8:12, 5:9], np.s_[30:40, 0:5, 20:24]]:
+            roi = maskBoundingBox(self._writeMask(box, shape), padding=2, minSize=8)
+            fnCrop = os.path.join(self.tmpDir, 'crop.mrc')
+            writeTile(fnTomo, roi, fnCrop)
+            fnOut = os.path.join(self.tmpDir, 'pasted.mrc')
+            pasteRoi(fnCrop, roi, shape, fnOut, fill=5., slabSize=7)
+
+            expected = np.full(shape, 5., dtype=np.float32)
+            expected[roi] = data[roi]
+            with mrcfile.open(fnOut, permissive=True) as mrc:
+                self.assertTrue(np.array_equal(mrc.data, expected))
+                self.assertAlmostEqual(float(mrc.header.dmin), expected.min(), places=5)
+                self.assertAlmostEqual(float(mrc.header.dmax), expected.max(), places=5)
+                self.assertAlmostEqual(float(mrc.header.dmean), expected.mean(), places=4)
+                self.assertAlmostEqual(float(mrc.header.rms), expected.std(), places=4)
+
+
+class TestFloat16Conversion(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_f16_')
+
+    def testConvert(self):
+        data = np.random.default_rng(0).normal(3, 2, (20, 16, 12)).astype(np.float32)
+        fn = os.path.join(self.tmpDir, 'tomo.mrc')
+        writeMrc(fn, data)
+        report = convertToFloat16(fn, slabSize=6)
+        self.assertFalse(report['overflow'])
+        self.assertLess(report['bytesAfter'], report['bytesBefore'])
+
+        with mrcfile.open(fn, permissive=True) as mrc:
+            self.assertEqual(mrc.data.dtype, np.float16)
+            converted = mrc.data.astype(np.float64)
+            header = mrc.header
+            self.assertAlmostEqual(float(header.dmin), converted.min(), places=4)
+            self.assertAlmostEqual(float(header.dmax), converted.max(), places=4)
+            self.assertAlmostEqual(float(header.dmean), converted.mean(), places=4)
+            self.assertAlmostEqual(float(header.rms), converted.std(), places=4)
+        self.assertLess(np.abs(converted - data).max(), report['maxAbsError'] + 1e-6)
+
+    def testOverflowKeepsFile(self):
+        data = np.full((8, 8, 8), 1e6, dtype=np.float32)
+        fn = os.path.join(self.tmpDir, 'bright.mrc')
+        writeMrc(fn, data)
+        report = convertToFloat16(fn)
+        self.assertTrue(report['overflow'])
+        self.assertTrue(np.array_equal(mrcfile.read(fn), data))
+        self.assertFalse(os.path.exists(fn + '.f16'))
+
+
+class TestBinning(BaseTest):
+
+    def testBinVolume(self):
+        tmpDir = tempfile.mkdtemp(prefix='ddw_bin_')
+        # Sizes not multiple of the factor, and more sections than one slab
+        data = np.random.default_rng(0).normal(0, 1, (70, 21, 18)).astype(np.float32)
+        fnIn, fnOut = os.path.join(tmpDir, 'tomo.mrc'), os.path.join(tmpDir, 'binned.mrc')
+        writeMrc(fnIn, data, voxelSize=1.5)
+        shape = binVolume(fnIn, fnOut, 4)
+        self.assertEqual(shape, (17, 5, 4))
+
+        expected = data[:68, :20, :16].reshape(17, 4, 5, 4, 4, 4).mean(axis=(1, 3, 5))
+        with mrcfile.open(fnOut, permissive=True) as mrc:
+            self.assertTrue(np.allclose(mrc.data, expected, atol=1e-6))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 6.0)
+            header = mrc.header
+            self.assertAlmostEqual(float(header.dmin), expected.min(), places=5)
+            self.assertAlmostEqual(float(header.dmax), expected.max(), places=5)
+            self.assertAlmostEqual(float(header.dmean), expected.mean(), places=5)
+            self.assertAlmostEqual(float(header.rms), expected.std(), places=5)
+
+
+# Sleeps ignoring Ctrl+C, or exits with EXIT_CODE on it
+STUBBORN_JOB = """
+import os, signal, sys, time
+code = os.environ.get('EXIT_CODE')
+signal.signal(signal.SIGINT, signal.SIG_IGN if code is None else lambda *a: sys.exit(int(code)))
+print('started', flush=True)
+time.sleep(60)
+"""
+
+
+class TestStopFile(BaseTest):
+    """ The stop file escalates from SIGINT to SIGTERM and SIGKILL, and the
+    metrics keep the real return code. """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='ddw_stop_')
+        self.fnMetrics = os.path.join(self.tmpDir, 'job.json')
+        self.fnLog = os.path.join(self.tmpDir, 'job.log')
+        self.fnScript = os.path.join(self.tmpDir, 'job.py')
+        with open(self.fnScript, 'w') as f:
+            f.write(STUBBORN_JOB)
+
+    def _stopLater(self, seconds=1.):
+        timer = threading.Timer(seconds, lambda: open(monitor.getStopFile(self.fnMetrics), 'w').close())
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def _metrics(self):
+        with open(self.fnMetrics) as f:
+            return json.load(f)
+
+    def _monitor(self, exitCode=None):
+        env = '' if exitCode is None else 'EXIT_CODE=%d ' % exitCode
+        self._stopLater()
+        with mock.patch.object(monitor, 'STOP_GRACE_SECONDS', 1), \
+                mock.patch.object(monitor, 'POLL_SECONDS', 0.1):
+            return monitor.monitor('%sexec %s %s' % (env, sys.executable, self.fnScript),
+                                   self.fnMetrics, self.fnLog)
+
+    def testMonitorEscalates(self):
+        t0 = time.time()
+        self.assertEqual(self._monitor(), 0)
+        metrics = self._metrics()
+        self.assertTrue(metrics['stopped'])
+        self.assertEqual(metrics['stopSignal'], 'SIGTERM')
+        self.assertEqual(metrics['returnCode'], -signal.SIGTERM)
+        self.assertLess(time.time() - t0, 30)
+
+    def testMonitorStoppedCrash(self):
+        self.assertEqual(self._monitor(exitCode=3), 3)
+        metrics = self._metrics()
+        self.assertTrue(metrics['stopped'])
+        self.assertEqual(metrics['returnCode'], 3)
+
+    def _runJob(self, main):
+        dispatcher = worker_server.Dispatcher(main)
+        threading.Thread(target=dispatcher.serveForever, daemon=True).start()
+        self._stopLater()
+        with mock.patch.object(worker_server, 'STOP_GRACE_SECONDS', 1), \
+                mock.patch.object(worker_server, 'STOP_CHECK_SECONDS', 0.1):
+            return worker_server.runJob(dispatcher, {'argv': [], 'log': self.fnLog,
+                                                     'metrics': self.fnMetrics})
+
+    def testWorkerEscalates(self):
+        def main():
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            time.sleep(60)
+
+        self.assertEqual(self._runJob(main), 0)
+        metrics = self._metrics()
+        self.assertTrue(metrics['stopped'])
+        self.assertEqual(metrics['stopSignal'], 'SIGKILL')
+        self.assertEqual(metrics['returnCode'], -signal.SIGKILL)
+
+    def testWorkerStoppedCrash(self):
+        def main():
+            signal.signal(signal.SIGINT, lambda *args: sys.exit(3))
+            time.sleep(60)
+
+        self.assertEqual(self._runJob(main), 3)
+        metrics = self._metrics()
+        self.assertTrue(metrics['stopped'])
+        self.assertEqual(metrics['returnCode'], 3)
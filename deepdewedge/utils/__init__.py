@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# Module to declare helper utilities used by the protocols
+# **************************************************************************
+"""
+The utilities are imported from their module on first use, so loading the
+plugin does not load numpy, mrcfile or psutil, and a module failing to
+import only affects the code using it.
+"""
+
+import importlib
+
+# Public name -> module defining it
+_EXPORTS = {
+    'SubtomoCache': 'cache', 'computeExtractionKey': 'cache', 'linkEntry': 'cache',
+    'SubtomoStore': 'subtomo_store', 'extractSubtomos': 'subtomo_store',
+    'getExtractionPositions': 'subtomo_store',
+    'screenMask': 'masks', 'maskFractions': 'masks', 'countsForThresholds': 'masks',
+    'maskBoundingBox': 'masks',
+    'getTiles': 'tiling', 'writeTile': 'tiling', 'pasteRoi': 'tiling', 'TileBlender': 'tiling',
+    'loadStepMetrics': 'metrics', 'summarizeStepMetrics': 'metrics',
+    'parseTimedLog': 'metrics', 'PlateauDetector': 'metrics',
+    'WorkerClient': 'worker', 'startWorker': 'worker', 'getSocketPath': 'worker',
+    'WORKER_SCRIPT': 'worker',
+    'autotune': 'autotune',
+    'NormalizationCache': 'normalization', 'computeVolumeStats': 'normalization',
+    'combineVolumeStats': 'normalization',
+    'binVolume': 'binning',
+    'PrecisionReport': 'precision', 'convertToFloat16': 'precision',
+    'scoreSubtomos': 'selection', 'selectSubtomos': 'selection',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import os
+import subprocess
+
+import psutil
+
+# Default U-Net of deepdewedge
+UNET_DOWNSAMPLE_LAYERS = 3
+UNET_CHANNELS = 64
+# Feature maps kept per U-Net level for the backward pass: encoder and
+# decoder convolutions, normalizations and activations
+TENSORS_PER_LEVEL = 12
+# Fixed GPU memory taken by the CUDA context and the model
+GPU_OVERHEAD_BYTES = 1024 ** 3
+MAX_BATCH_SIZE = 64
+MAX_LOADER_WORKERS = 8
+
+
+def estimateGpuSampleBytes(boxSize, numLayers=UNET_DOWNSAMPLE_LAYERS, channels=UNET_CHANNELS,
+                           bytesPerValue=4):
+    """ GPU memory one training sample needs: the feature maps of every
+    U-Net level, which halves the size and doubles the channels. """
+    total = 0
+    for level in range(numLayers + 1):
+        voxels = (boxSize // 2 ** level) ** 3
+        total += voxels * channels * 2 ** level
+    return total * TENSORS_PER_LEVEL * bytesPerValue
+
+
+def estimateHostSampleBytes(boxSize, bytesPerValue=4):
+    """ Host memory of one sample in the data loader: the two input halves,
+    the target and the missing wedge mask. """
+    return 4 * boxSize ** 3 * bytesPerValue
+
+
+def getFreeGpuMemory(gpuIds):
+    """ Lowest free memory in bytes among the given GPUs, or None if it
+    cannot be queried. """
+    try:
+        output = subprocess.check_output(['nvidia-smi', '--query-gpu=index,memory.free',
+                                          '--format=csv,noheader,nounits'], text=True,
+                                         timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    free = {}
+    for line in output.strip().splitlines():
+        index, mem = [v.strip() for v in line.split(',')]
+        free[index] = int(mem) * 1024 ** 2
+    values = [free[str(g)] for g in gpuIds if str(g) in free]
+    return min(values) if values else None
+
+
+def getNumCores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _largestPowerOfTwo(limit):
+    size = 1
+    while size * 2 <= limit:
+        size *= 2
+    return size
+
+
+def autotune(boxSize, gpuIds, concurrentJobs=1, fallbackBatchSize=1,
+             numLayers=UNET_DOWNSAMPLE_LAYERS, channels=UNET_CHANNELS, safety=0.7):
+    """ Choose the largest power of two batch size that fits in the GPU and
+    host memory left for each concurrent job, for a U-Net of numLayers
+    downsampling layers and channels in its first level, and the data
+    loader workers from the cores left for each job. If the GPU memory
+    cannot be queried, the batch size does not go over fallbackBatchSize.
+    Returns the choices and the figures they come from. """
+    concurrentJobs = max(1, concurrentJobs)
+    cores = getNumCores()
+    numWorkers = max(1, min(MAX_LOADER_WORKERS, cores // concurrentJobs - 1))
+
+    gpuSample = estimateGpuSampleBytes(boxSize, numLayers, channels)
+    hostSample = estimateHostSampleBytes(boxSize)
+    gpuFree = getFreeGpuMemory(gpuIds)
+    hostFree = psutil.virtual_memory().available
+
+    # Each loader worker prefetches two batches
+    limits = [MAX_BATCH_SIZE,
+              safety * hostFree / concurrentJobs / (hostSample * 2 * (numWorkers + 1))]
+    if gpuFree is not None:
+        # The step executor books one device per GPU step, so the device is for one job
+        limits.append(safety * (gpuFree - GPU_OVERHEAD_BYTES) / gpuSample)
+    else:
+        limits.append(fallbackBatchSize)
+    batchSize = _largestPowerOfTwo(max(1, int(min(limits))))
+
+    return {'batchSize': batchSize,
+            'numWorkers': numWorkers,
+            'unetLayers': numLayers,
+            'unetChannels': channels,
+            'gpuSampleBytes': gpuSample,
+            'hostSampleBytes': hostSample,
+            'gpuFreeBytes': gpuFree,
+            'hostFreeBytes': hostFree,
+            'cores': cores,
+            'concurrentJobs': concurrentJobs}
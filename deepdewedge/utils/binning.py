@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+import numpy as np
+import mrcfile
+
+from .normalization import HeaderStats
+
+SLAB_BINNED_SECTIONS = 8
+
+
+def binBlocks(data, factor):
+    """ Average the factor^3 blocks of a (z, y, x) array, whose sizes must be
+    multiples of factor, with a single reshape and mean. """
+    nz, ny, nx = (dim // factor for dim in data.shape)
+    blocks = data.reshape(nz, factor, ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3, 5), dtype=np.float64).astype(np.float32)
+
+
+def binVolume(fnIn, fnOut, factor):
+    """ Downsample a memory mapped MRC volume by averaging blocks of
+    factor^3 voxels, a few binned sections at a time. The voxels left over
+    when a size is not a multiple of factor are dropped. The header
+    statistics are taken from the binned sections as they are written. """
+    stats = HeaderStats()
+    with mrcfile.mmap(fnIn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = tuple(dim // factor for dim in data.shape)
+        with mrcfile.new_mmap(fnOut, shape=shape, mrc_mode=2, overwrite=True) as mrcOut:
+            ny, nx = shape[1] * factor, shape[2] * factor
+            for z in range(0, shape[0], SLAB_BINNED_SECTIONS):
+                zEnd = min(z + SLAB_BINNED_SECTIONS, shape[0])
+                slab = np.asarray(data[z * factor:zEnd * factor, :ny, :nx], dtype=np.float32)
+                binned = binBlocks(slab, factor)
+                mrcOut.data[z:zEnd] = binned
+                stats.update(binned)
+            mrcOut.voxel_size = tuple(v * factor for v in mrc.voxel_size.item())
+            stats.setHeader(mrcOut)
+    return shape
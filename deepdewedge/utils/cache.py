@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+CACHE_INDEX = 'index.json'
+CACHE_LOCK = '.lock'
+
+
+def fileIdentity(fn):
+    """ Cheap identity of a file: real path, size and modification time. """
+    fn = os.path.realpath(fn)
+    st = os.stat(fn)
+    return [fn, st.st_size, st.st_mtime_ns]
+
+
+def computeExtractionKey(files, params):
+    """ Hash identifying an extraction from its input files and parameters.
+    The order of the files matters, as it defines the tomo0/tomo1 pairing. """
+    content = {'files': [fileIdentity(fn) for fn in files],
+               'params': params}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def getDirSize(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            fnPath = os.path.join(root, fn)
+            if not os.path.islink(fnPath):
+                size += os.path.getsize(fnPath)
+    return size
+
+
+class SubtomoCache:
+    """ Content addressed cache of extracted subtomograms. Every entry is a
+    folder named after its extraction key. The index keeps the entry sizes,
+    their last use and the hit/miss counters, and entries are evicted in
+    least recently used order to keep the cache under maxBytes. An entry
+    is pinned for every folder linking to it until the folder releases it
+    or is removed, and pinned entries are never evicted. """
+
+    _threadLock = threading.Lock()
+
+    def __init__(self, cacheDir, maxBytes):
+        self._cacheDir = cacheDir
+        self._maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def getEntryPath(self, key):
+        return os.path.join(self._cacheDir, key)
+
+    @contextmanager
+    def _locked(self):
+        """ Serialize the index access between threads and processes. """
+        with self._threadLock:
+            with open(os.path.join(self._cacheDir, CACHE_LOCK), 'w') as fLock:
+                fcntl.flock(fLock, fcntl.LOCK_EX)
+                try:
+                    yield self._readIndex()
+                finally:
+                    fcntl.flock(fLock, fcntl.LOCK_UN)
+
+    def _readIndex(self):
+        fnIndex = os.path.join(self._cacheDir, CACHE_INDEX)
+        if os.path.exists(fnIndex):
+            with open(fnIndex) as f:
+                return json.load(f)
+        return {'entries': {}, 'hits': 0, 'misses': 0}
+
+    def _writeIndex(self, index):
+        fnIndex = os.path.join(self._cacheDir, CACHE_INDEX)
+        with open(fnIndex + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(fnIndex + '.tmp', fnIndex)
+
+    def get(self, key, user=None):
+        """ Return the entry folder of a key, or None on a miss. On a hit,
+        the entry is pinned for the user folder, if given. """
+        with self._locked() as index:
+            entry = index['entries'].get(key)
+            if entry is not None and os.path.isdir(self.getEntryPath(key)):
+                entry['lastUsed'] = time.time()
+                self._pin(entry, user)
+                index['hits'] += 1
+                result = self.getEntryPath(key)
+            else:
+                index['entries'].pop(key, None)
+                index['misses'] += 1
+                result = None
+            self._writeIndex(index)
+        return result
+
+    def put(self, key, srcDir, user=None):
+        """ Move the content of srcDir into the cache, pin it for the user
+        folder, if given, and evict the least recently used entries not
+        pinned if the cache grows over its size limit. """
+        with self._locked() as index:
+            entryPath = self.getEntryPath(key)
+            if os.path.exists(entryPath):
+                shutil.rmtree(entryPath)
+            shutil.move(srcDir, entryPath)
+            entry = {'size': getDirSize(entryPath),
+                     'lastUsed': time.time()}
+            if user is not None:
+                # Ready for the links, so the pin is not taken as stale
+                os.makedirs(user, exist_ok=True)
+                self._pin(entry, user)
+            index['entries'][key] = entry
+            self._evict(index, keep=key)
+            self._writeIndex(index)
+        return entryPath
+
+    def release(self, key, user):
+        """ Unpin an entry for a user folder that does not need it anymore. """
+        with self._locked() as index:
+            entry = index['entries'].get(key)
+            if entry is not None and user in entry.get('users', []):
+                entry['users'].remove(user)
+                self._writeIndex(index)
+
+    @staticmethod
+    def _pin(entry, user):
+        if user is not None and user not in entry.setdefault('users', []):
+            entry['users'].append(user)
+
+    @staticmethod
+    def _isPinned(entry):
+        """ Whether a user folder of the entry still exists. The others are
+        dropped, as their protocol was deleted. """
+        entry['users'] = [user for user in entry.get('users', []) if os.path.lexists(user)]
+        return bool(entry['users'])
+
+    def _evict(self, index, keep):
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['lastUsed']):
+            if total <= self._maxBytes:
+                break
+            if key == keep or self._isPinned(entries[key]):
+                continue
+            total -= entries.pop(key)['size']
+            shutil.rmtree(self.getEntryPath(key), ignore_errors=True)
+
+    def getStats(self):
+        with self._locked() as index:
+            entries = index['entries']
+            return {'hits': index['hits'],
+                    'misses': index['misses'],
+                    'entries': len(entries),
+                    'bytes': sum(e['size'] for e in entries.values())}
+
+
+def linkEntry(entryPath, dstDir):
+    """ Populate dstDir with links to the files of a cache entry. """
+    os.makedirs(dstDir, exist_ok=True)
+    for fn in os.listdir(entryPath):
+        dst = os.path.join(dstDir, fn)
+        if os.path.lexists(dst):
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            else:
+                os.remove(dst)
+        os.symlink(os.path.abspath(os.path.join(entryPath, fn)), dst)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import numpy as np
+import mrcfile
+
+from .subtomo_store import getExtractionPositions
+
+DEFAULT_THRESHOLDS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def summedVolumeTable(mask):
+    """ 3D integral image of the nonzero voxels of a mask, padded with a
+    leading zero plane on every axis so box sums need no bound checks. """
+    dtype = np.int32 if mask.size < np.iinfo(np.int32).max else np.int64
+    svt = np.zeros(tuple(d + 1 for d in mask.shape), dtype=dtype)
+    np.not_equal(mask, 0, out=svt[1:, 1:, 1:], casting='unsafe')
+    for axis in range(3):
+        np.cumsum(svt, axis=axis, out=svt)
+    return svt
+
+
+def boxSums(svt, positions, boxSize):
+    """ Number of nonzero voxels inside each box with the given (z, y, x)
+    corners, computed with 8 lookups per box. """
+    z0, y0, x0 = (positions[:, i] for i in range(3))
+    z1, y1, x1 = z0 + boxSize, y0 + boxSize, x0 + boxSize
+    return (svt[z1, y1, x1] - svt[z0, y1, x1] - svt[z1, y0, x1] - svt[z1, y1, x0]
+            + svt[z0, y0, x1] + svt[z0, y1, x0] + svt[z1, y0, x0] - svt[z0, y0, x0])
+
+
+def maskFractions(mask, positions, boxSize):
+    """ Fraction of nonzero mask voxels in every candidate box. """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+    return boxSums(summedVolumeTable(mask), positions, boxSize) / float(boxSize ** 3)
+
+
+def screenMask(fnMask, boxSize, strides=None, minFraction=0.):
+    """ Screen the extraction grid of a mask file. Returns the accepted
+    corners, their mask fractions and the number of candidate boxes. """
+    with mrcfile.mmap(fnMask, mode='r', permissive=True) as mrc:
+        positions = getExtractionPositions(mrc.data.shape, boxSize, strides)
+        fractions = maskFractions(mrc.data, positions, boxSize)
+    accepted = fractions >= minFraction
+    return positions[accepted], fractions[accepted], len(positions)
+
+
+def maskBoundingBox(fnMask, padding=0, minSize=0, slabSize=32):
+    """ Slices of the bounding box of the nonzero voxels of a mask file,
+    grown by padding and to at least minSize voxels per axis, and clipped to
+    the volume. The mask is read in slabs. Returns None for an empty mask. """
+    with mrcfile.mmap(fnMask, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = data.shape
+        zAny = np.zeros(shape[0], dtype=bool)
+        yxAny = np.zeros(shape[1:], dtype=bool)
+        for z in range(0, shape[0], slabSize):
+            slab = np.not_equal(data[z:z + slabSize], 0)
+            zAny[z:z + slabSize] = slab.any(axis=(1, 2))
+            yxAny |= slab.any(axis=0)
+    if not zAny.any():
+        return None
+
+    roi = []
+    for dim, nonzero in zip(shape, (zAny, yxAny.any(axis=1), yxAny.any(axis=0))):
+        indexes = np.flatnonzero(nonzero)
+        start, end = indexes[0] - padding, indexes[-1] + 1 + padding
+        missing = min(minSize, dim) - (end - start)
+        if missing > 0:
+            start -= missing // 2
+            end += missing - missing // 2
+        start, end = max(0, start), min(dim, end)
+        # Shift a box clipped on one side to keep the minimum size
+        if end - start < min(minSize, dim):
+            start, end = (0, min(minSize, dim)) if start == 0 else (dim - min(minSize, dim), dim)
+        roi.append(slice(int(start), int(end)))
+    return tuple(roi)
+
+
+def countsForThresholds(fractions, thresholds=DEFAULT_THRESHOLDS):
+    """ Number of boxes that would be kept with each threshold. """
+    fractions = np.sort(np.asarray(fractions))
+    kept = len(fractions) - np.searchsorted(fractions, thresholds, side='left')
+    return dict(zip(thresholds, kept.tolist()))
+
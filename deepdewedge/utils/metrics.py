@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import glob
+import json
+import os
+import re
+
+EPOCH_RE = re.compile(r'Epoch\s+(\d+)')
+LOSS_RE = re.compile(r'(\w*loss)\s*[=:]\s*([0-9.]+(?:[eE][+-]?\d+)?)')
+
+
+def parseTimedLog(fnLog):
+    """ Epoch timings and losses from a log saved by the monitor, where
+    every line starts with its elapsed time. Returns one dict per epoch
+    with its start, duration and the last value of each loss. """
+    epochs = {}
+    if not os.path.exists(fnLog):
+        return []
+    with open(fnLog) as f:
+        for line in f:
+            elapsed, _, text = line.partition('\t')
+            match = EPOCH_RE.search(text)
+            if match is None:
+                continue
+            epoch = epochs.setdefault(int(match.group(1)), {'start': float(elapsed)})
+            epoch['end'] = float(elapsed)
+            for name, value in LOSS_RE.findall(text):
+                epoch[name] = float(value)
+
+    # An epoch ends with its last line, as the progress bar keeps updating
+    result = []
+    previousEnd = None
+    for n in sorted(epochs):
+        epoch = epochs[n]
+        start = epoch['start'] if previousEnd is None else previousEnd
+        losses = {k: v for k, v in epoch.items() if k.endswith('loss')}
+        result.append(dict(epoch=n, seconds=epoch['end'] - start, **losses))
+        previousEnd = epoch['end']
+    return result
+
+
+class PlateauDetector:
+    """ Tell when the validation loss stops improving: after patience
+    epochs without lowering the best loss by more than a relative
+    tolerance. """
+
+    def __init__(self, tolerance, patience):
+        self._tolerance = tolerance
+        self._patience = patience
+        self.bestLoss = None
+        self.bestEpoch = None
+        self._epochsWithoutImprovement = 0
+
+    def update(self, epoch, loss):
+        """ Add the validation loss of an epoch. Returns True on a plateau. """
+        if self.bestLoss is None or self.bestLoss - loss > self._tolerance * abs(self.bestLoss):
+            self.bestLoss, self.bestEpoch = loss, epoch
+            self._epochsWithoutImprovement = 0
+        else:
+            if loss < self.bestLoss:
+                self.bestLoss, self.bestEpoch = loss, epoch
+            self._epochsWithoutImprovement += 1
+        return self._epochsWithoutImprovement >= self._patience
+
+
+def loadStepMetrics(metricsDir):
+    """ Metrics of every monitored call, indexed by their label. """
+    metrics = {}
+    for fnMetrics in sorted(glob.glob(os.path.join(metricsDir, '*.json'))):
+        label = os.path.splitext(os.path.basename(fnMetrics))[0]
+        with open(fnMetrics) as f:
+            metrics[label] = json.load(f)
+        metrics[label]['epochs'] = parseTimedLog(os.path.splitext(fnMetrics)[0] + '.log')
+    return metrics
+
+
+def formatBytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return '%0.1f %s' % (n, unit)
+        n /= 1024.
+    return '%0.1f TB' % n
+
+
+def summarizeStepMetrics(metrics):
+    """ One human readable line per monitored call. """
+    lines = []
+    for label, m in metrics.items():
+        line = ('%s: %0.1f s, peak memory %s, read %s, written %s'
+                % (label, m['wallTime'], formatBytes(m['peakRss']),
+                   formatBytes(m['readBytes']), formatBytes(m['writeBytes'])))
+        epochs = m.get('epochs')
+        if epochs:
+            line += ', %d epochs of %0.1f s' % (len(epochs),
+                                               sum(e['seconds'] for e in epochs) / len(epochs))
+            losses = ['%s %0.4f' % (k, v) for k, v in epochs[-1].items() if k.endswith('loss')]
+            if losses:
+                line += ', last ' + ', '.join(losses)
+        lines.append(line)
+    return lines
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Run a shell command recording its wall time, the peak resident memory of
+its whole process tree and the bytes it read and wrote. The command output
+is passed through and also saved, with the elapsed time of every line, so
+it can be parsed afterwards. Creating the stop file (the metrics file with
+a .stop extension) interrupts the command, like Ctrl+C, and if it is still
+running after STOP_GRACE_SECONDS it is terminated and then killed. The
+metrics keep its real return code and whether it was stopped, and the run
+counts as a success if it ended because of the stop. This file is run as a standalone script by Plugin.runDeepdewedge
+and only depends on psutil:
+
+    python monitor.py METRICS_JSON TIMED_LOG -- COMMAND
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+
+POLL_SECONDS = 0.5
+STOP_GRACE_SECONDS = 30
+# Like Ctrl+C first, so the tool can finish cleanly
+STOP_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
+
+
+def _treeStats(root, ioSeen):
+    """ Current RSS of the process tree, updating the last I/O counters seen
+    for every process so finished children are still accounted. """
+    rss = 0
+    for proc in [root] + root.children(recursive=True):
+        try:
+            with proc.oneshot():
+                rss += proc.memory_info().rss
+                io = proc.io_counters()
+                ioSeen[proc.pid] = (io.read_bytes, io.write_bytes)
+        except (psutil.NoSuchProcess, psutil.AccessDenied, AttributeError):
+            pass
+    return rss
+
+
+def _tee(stream, fnLog, t0):
+    """ Forward the output, splitting progress bar updates ('\\r') into
+    lines, and save every line with its elapsed time. """
+    with open(fnLog, 'w') as fLog:
+        buffer = b''
+        for chunk in iter(lambda: stream.read1(4096), b''):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+            buffer += chunk
+            *lines, buffer = buffer.replace(b'\r', b'\n').split(b'\n')
+            for line in lines:
+                if line.strip():
+                    fLog.write('%0.3f\t%s\n' % (time.time() - t0, line.decode(errors='replace')))
+            fLog.flush()
+        if buffer.strip():
+            fLog.write('%0.3f\t%s\n' % (time.time() - t0, buffer.decode(errors='replace')))
+
+
+def getStopFile(fnMetrics):
+    return os.path.splitext(fnMetrics)[0] + '.stop'
+
+
+def getExitCode(returnCode, stopSignals):
+    """ Exit code of the run: 0 if it was stopped and ended cleanly or by one
+    of the stop signals, its return code otherwise. """
+    stopCodes = {0} | {-sig for sig in stopSignals} | {128 + sig for sig in stopSignals}
+    return 0 if stopSignals and returnCode in stopCodes else returnCode
+
+
+def monitor(command, fnMetrics, fnLog):
+    t0 = time.time()
+    fnStop = getStopFile(fnMetrics)
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, start_new_session=True)
+    teeThread = threading.Thread(target=_tee, args=(process.stdout, fnLog, t0))
+    teeThread.start()
+
+    root = psutil.Process(process.pid)
+    ioSeen = {}
+    peakRss = 0
+    stopSignals, signalTime = [], None
+    while process.poll() is None:
+        peakRss = max(peakRss, _treeStats(root, ioSeen))
+        if len(stopSignals) < len(STOP_SIGNALS) and os.path.exists(fnStop) and \
+                (signalTime is None or time.time() - signalTime > STOP_GRACE_SECONDS):
+            sig = STOP_SIGNALS[len(stopSignals)]
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+            stopSignals.append(sig)
+            signalTime = time.time()
+        time.sleep(POLL_SECONDS)
+    teeThread.join()
+
+    metrics = {'command': command,
+               'returnCode': process.returncode,
+               'stopped': bool(stopSignals),
+               'stopSignal': stopSignals[-1].name if stopSignals else None,
+               'wallTime': time.time() - t0,
+               'peakRss': peakRss,
+               'readBytes': sum(r for r, _ in ioSeen.values()),
+               'writeBytes': sum(w for _, w in ioSeen.values())}
+    with open(fnMetrics, 'w') as f:
+        json.dump(metrics, f, indent=2)
+    return getExitCode(process.returncode, stopSignals)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5 or sys.argv[3] != '--':
+        sys.exit('Usage: monitor.py METRICS_JSON TIMED_LOG -- COMMAND')
+    sys.exit(monitor(' '.join(sys.argv[4:]), sys.argv[1], sys.argv[2]))
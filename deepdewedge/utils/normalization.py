@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import mrcfile
+
+from .cache import fileIdentity
+
+SLAB_SIZE = 16
+
+
+def mergeStats(statsA, statsB):
+    """ Merge two (count, mean, M2) partial results, M2 being the sum of
+    squared deviations from the mean (Chan et al. update of Welford). """
+    countA, meanA, m2A = statsA
+    countB, meanB, m2B = statsB
+    count = countA + countB
+    if not count:
+        return 0, 0.0, 0.0
+    delta = meanB - meanA
+    mean = meanA + delta * countB / count
+    return count, mean, m2A + m2B + delta ** 2 * countA * countB / count
+
+
+class HeaderStats:
+    """ MRC header statistics of a volume written slab by slab: minimum,
+    maximum, mean and rms (the standard deviation, as mrcfile computes it).
+    The slabs are merged with mergeStats, so no full size temporary is
+    needed as with mrcfile's update_header_stats. """
+
+    def __init__(self):
+        self._stats = (0, 0.0, 0.0)
+        self._min = np.inf
+        self._max = -np.inf
+
+    def update(self, slab):
+        slab = np.asarray(slab, dtype=np.float64)
+        if not slab.size:
+            return
+        slabMean = slab.mean()
+        self._stats = mergeStats(self._stats, (slab.size, slabMean,
+                                               np.square(slab - slabMean).sum()))
+        self._min = min(self._min, float(slab.min()))
+        self._max = max(self._max, float(slab.max()))
+
+    def setHeader(self, mrc):
+        count, mean, m2 = self._stats
+        if not count:
+            return
+        mrc.header.dmin = self._min
+        mrc.header.dmax = self._max
+        mrc.header.dmean = mean
+        mrc.header.rms = np.sqrt(m2 / count)
+
+
+def computeVolumeStats(fn, slabSize=SLAB_SIZE):
+    """ Mean and standard deviation of a memory mapped MRC volume, read in
+    slabs of slabSize sections and merged with Welford's algorithm, so
+    memory use does not depend on the volume size. """
+    stats = (0, 0.0, 0.0)
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        for z in range(0, data.shape[0], slabSize):
+            slab = np.asarray(data[z:z + slabSize], dtype=np.float64)
+            slabMean = slab.mean()
+            stats = mergeStats(stats, (slab.size, slabMean,
+                                       np.square(slab - slabMean).sum()))
+    count, mean, m2 = stats
+    return {'count': int(count), 'mean': float(mean),
+            'std': float(np.sqrt(m2 / count)) if count else 1.0}
+
+
+def combineVolumeStats(statsList):
+    """ Mean and standard deviation of the union of several volumes. """
+    stats = (0, 0.0, 0.0)
+    for s in statsList:
+        stats = mergeStats(stats, (s['count'], s['mean'], s['count'] * s['std'] ** 2))
+    count, mean, m2 = stats
+    return {'count': int(count), 'mean': float(mean),
+            'std': float(np.sqrt(m2 / count)) if count else 1.0}
+
+
+class NormalizationCache:
+    """ Volume statistics cached per file, keyed by its path, size and
+    modification time, so they are computed once across refinements and
+    runs. Every entry is a small json file written atomically. """
+
+    def __init__(self, cacheDir):
+        self._cacheDir = cacheDir
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def _getEntryFn(self, fn):
+        key = hashlib.sha1(json.dumps(fileIdentity(fn)).encode()).hexdigest()
+        return os.path.join(self._cacheDir, key + '.json')
+
+    def getStats(self, fn):
+        fnEntry = self._getEntryFn(fn)
+        if os.path.exists(fnEntry):
+            with open(fnEntry) as f:
+                return json.load(f)
+        stats = computeVolumeStats(fn)
+        # Unique name, as the steps computing the same file may be threads of one process
+        fd, fnTmp = tempfile.mkstemp(suffix='.tmp', dir=self._cacheDir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stats, f)
+        os.replace(fnTmp, fnEntry)
+        return stats
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+import os
+
+import numpy as np
+import mrcfile
+
+from .normalization import HeaderStats
+
+FLOAT16_MRC_MODE = 12
+SLAB_SIZE = 16
+
+
+class PrecisionReport:
+    """ Error made by storing float32 data with a narrower type, accumulated
+    block by block: maximum absolute error and RMS error, also relative to
+    the RMS of the data. """
+
+    def __init__(self):
+        self.count = 0
+        self.maxAbsError = 0.0
+        self.overflow = False
+        self._sumSqError = 0.0
+        self._sumSq = 0.0
+
+    def update(self, data, converted):
+        data = np.asarray(data, dtype=np.float64)
+        converted = np.asarray(converted, dtype=np.float64)
+        if not np.isfinite(converted).all():
+            self.overflow = True
+            converted = np.where(np.isfinite(converted), converted, data)
+        error = np.abs(converted - data)
+        self.count += data.size
+        self.maxAbsError = max(self.maxAbsError, float(error.max(initial=0)))
+        self._sumSqError += float(np.square(error).sum())
+        self._sumSq += float(np.square(data).sum())
+
+    def toDict(self):
+        rmsError = np.sqrt(self._sumSqError / self.count) if self.count else 0.0
+        rms = np.sqrt(self._sumSq / self.count) if self.count else 0.0
+        return {'count': self.count,
+                'maxAbsError': self.maxAbsError,
+                'rmsError': float(rmsError),
+                'relativeRmsError': float(rmsError / rms) if rms else 0.0,
+                'overflow': self.overflow}
+
+
+def convertToFloat16(fn, slabSize=SLAB_SIZE):
+    """ Rewrite a float32 MRC file as float16 (mode 12), slab by slab through
+    memory mapping, and report the error and the sizes. The header
+    statistics are taken from the slabs too. If some value does not fit in
+    float16 the file is left untouched. """
+    fnTmp = fn + '.f16'
+    report = PrecisionReport()
+    stats = HeaderStats()
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        with mrcfile.new_mmap(fnTmp, shape=data.shape, mrc_mode=FLOAT16_MRC_MODE,
+                              overwrite=True) as mrcOut:
+            for z in range(0, data.shape[0], slabSize):
+                slab = data[z:z + slabSize]
+                with np.errstate(over='ignore'):
+                    mrcOut.data[z:z + slabSize] = slab.astype(np.float16)
+                report.update(slab, mrcOut.data[z:z + slabSize])
+                if not report.overflow:
+                    stats.update(mrcOut.data[z:z + slabSize])
+            mrcOut.voxel_size = mrc.voxel_size
+            if not report.overflow:
+                stats.setHeader(mrcOut)
+
+    result = report.toDict()
+    result['bytesBefore'] = os.path.getsize(fn)
+    if report.overflow:
+        os.remove(fnTmp)
+        result['bytesAfter'] = result['bytesBefore']
+    else:
+        result['bytesAfter'] = os.path.getsize(fnTmp)
+        os.replace(fnTmp, fn)
+    return result
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+import heapq
+
+import numpy as np
+import mrcfile
+
+from .binning import binBlocks
+from .masks import summedVolumeTable
+
+SCORE_BINNING = 4
+SLAB_BINNED_SECTIONS = 8
+
+
+def _binnedVolume(fn, factor):
+    """ Block averaged copy of a memory mapped volume, read in slabs. """
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = tuple(dim // factor for dim in data.shape)
+        binned = np.empty(shape, dtype=np.float32)
+        ny, nx = shape[1] * factor, shape[2] * factor
+        for z in range(0, shape[0], SLAB_BINNED_SECTIONS):
+            zEnd = min(z + SLAB_BINNED_SECTIONS, shape[0])
+            binned[z:zEnd] = binBlocks(np.asarray(data[z * factor:zEnd * factor, :ny, :nx],
+                                                  dtype=np.float32), factor)
+    return binned
+
+
+def _binnedBoxSums(svt, corners, size):
+    """ Sums of a summed volume table over boxes of the given binned size. """
+    z0, y0, x0 = (np.minimum(corners[:, i], svt.shape[i] - 1 - size) for i in range(3))
+    z0, y0, x0 = (np.maximum(c, 0) for c in (z0, y0, x0))
+    z1, y1, x1 = z0 + size, y0 + size, x0 + size
+    return (svt[z1, y1, x1] - svt[z0, y1, x1] - svt[z1, y0, x1] - svt[z1, y1, x0]
+            + svt[z0, y0, x1] + svt[z0, y1, x0] + svt[z1, y0, x0] - svt[z0, y0, x0])
+
+
+def scoreSubtomos(fnTomo, positions, boxSize, fnMask=None, factor=SCORE_BINNING):
+    """ Score the boxes at the given (z, y, x) corners by the variance of the
+    block averaged tomogram inside them, times their mask coverage if a mask
+    is given. Block averaging keeps the structure and removes most of the
+    noise, and the per box sums come from summed volume tables of the binned
+    data and of its square, so every score costs a few lookups. """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+    binned = _binnedVolume(fnTomo, factor).astype(np.float64)
+    size = max(1, min(boxSize // factor, *binned.shape))
+    corners = positions // factor
+    count = float(size ** 3)
+
+    svt = np.zeros(tuple(d + 1 for d in binned.shape))
+    svt[1:, 1:, 1:] = binned
+    svtSq = np.zeros_like(svt)
+    svtSq[1:, 1:, 1:] = np.square(binned)
+    for axis in range(3):
+        np.cumsum(svt, axis=axis, out=svt)
+        np.cumsum(svtSq, axis=axis, out=svtSq)
+    mean = _binnedBoxSums(svt, corners, size) / count
+    scores = np.maximum(_binnedBoxSums(svtSq, corners, size) / count - mean ** 2, 0.)
+
+    if fnMask is not None:
+        coverage = _binnedBoxSums(summedVolumeTable(_binnedVolume(fnMask, factor) > 0.5),
+                                  corners, size) / count
+        scores *= coverage
+    return scores
+
+
+class _Occupancy:
+    """ Binned map of the voxels covered by the boxes chosen in a tomogram. """
+
+    def __init__(self, shape, boxSize, factor):
+        self._factor = factor
+        self._size = max(1, boxSize // factor)
+        self._grid = np.zeros(tuple(max(1, -(-dim // factor)) for dim in shape), dtype=bool)
+
+    def _slices(self, position):
+        return tuple(slice(p // self._factor, p // self._factor + self._size) for p in position)
+
+    def overlap(self, position):
+        return float(self._grid[self._slices(position)].mean())
+
+    def add(self, position):
+        self._grid[self._slices(position)] = True
+
+
+def _stratifiedQuotas(counts, maxCount):
+    """ Split maxCount among the tomograms proportionally to their number of
+    candidates by largest remainders, so the quotas add up to maxCount. """
+    total = float(sum(counts.values()) or 1)
+    shares = {tsId: maxCount * count / total for tsId, count in counts.items()}
+    quotas = {tsId: int(share) for tsId, share in shares.items()}
+    left = maxCount - sum(quotas.values())
+    for tsId in sorted(shares, key=lambda t: quotas[t] - shares[t])[:left]:
+        quotas[tsId] += 1
+    return quotas
+
+
+def selectSubtomos(candidates, boxSize, maxCount, stratify=False, factor=SCORE_BINNING):
+    """ Choose up to maxCount boxes from candidates, a dict tsId -> (positions,
+    scores, tomogram shape). The boxes are taken greedily by their score
+    scaled by the fraction of them not covered by the boxes already chosen
+    in the same tomogram. As the overlap only grows, outdated scores are
+    upper bounds and are only recomputed when they reach the top (lazy
+    greedy). If stratify, every tomogram gets a share of maxCount
+    proportional to its candidates, the shares adding up to maxCount.
+    Returns the chosen positions by tsId. """
+    if stratify:
+        quotas = _stratifiedQuotas({tsId: len(positions)
+                                    for tsId, (positions, _, _) in candidates.items()}, maxCount)
+    else:
+        quotas = {tsId: maxCount for tsId in candidates}
+
+    heap = []
+    occupancies, chosen = {}, {}
+    for order, (tsId, (positions, scores, shape)) in enumerate(candidates.items()):
+        occupancies[tsId] = _Occupancy(shape, boxSize, factor)
+        chosen[tsId] = []
+        heap.extend((-float(score), order, i, tsId, score) for i, score in enumerate(scores))
+    heapq.heapify(heap)
+
+    numChosen = 0
+    while heap and numChosen < maxCount:
+        negScore, order, i, tsId, score = heapq.heappop(heap)
+        if len(chosen[tsId]) >= quotas[tsId]:
+            continue
+        position = candidates[tsId][0][i]
+        current = score * (1. - occupancies[tsId].overlap(position))
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, order, i, tsId, score))
+            continue
+        occupancies[tsId].add(position)
+        chosen[tsId].append(i)
+        numChosen += 1
+
+    return {tsId: np.asarray(candidates[tsId][0])[sorted(indexes)].reshape(-1, 3)
+            for tsId, indexes in chosen.items()}
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import json
+import os
+import zipfile
+
+import numpy as np
+import mrcfile
+
+from .normalization import mergeStats
+from .precision import PrecisionReport
+
+STORE_INDEX = 'index.json'
+STORE_POSITIONS = 'positions.npy'
+STORE_VAL_FLAGS = 'val_flags.npy'
+CHUNK_TEMPLATE = 'chunk_%05d.npy'
+
+
+def getExtractionPositions(shape, boxSize, strides=None):
+    """ Corners (z, y, x) of the boxes of a regular grid inside a volume of
+    the given (z, y, x) shape. Strides are given as (x, y, z) like in the
+    protocol form; without them the boxes do not overlap. """
+    strides = strides or (boxSize, boxSize, boxSize)
+    axes = [np.arange(0, dim - boxSize + 1, stride)
+            for dim, stride in zip(shape, strides[::-1])]
+    grid = np.meshgrid(*axes, indexing='ij')
+    return np.stack([g.ravel() for g in grid], axis=1).astype(np.int64)
+
+
+class SubtomoStore:
+    """ On-disk store of odd/even subtomogram pairs. The pairs are written
+    to fixed size chunks of memory mapped .npy files, so only one chunk is
+    ever mapped while writing and reading is lazy. The index keeps the
+    chunk layout, and the positions and validation flags of every pair are
+    stored next to it. Pairs stored as float16 have their conversion error
+    accounted in a PrecisionReport, and a pair out of the float16 range
+    raises OverflowError. """
+
+    def __init__(self, path, boxSize, chunkSize, dtype, chunkCounts, mode='r'):
+        self._path = path
+        self._boxSize = boxSize
+        self._chunkSize = chunkSize
+        self._dtype = np.dtype(dtype)
+        self._chunkCounts = chunkCounts
+        self._mode = mode
+        self._positions = []
+        self._valFlags = []
+        self._chunk = None
+        self._precision = PrecisionReport() if self._dtype == np.float16 else None
+
+    @classmethod
+    def create(cls, path, boxSize, chunkSize=256, dtype='float32'):
+        os.makedirs(path, exist_ok=True)
+        return cls(path, boxSize, chunkSize, dtype, [], mode='w')
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, STORE_INDEX)) as f:
+            index = json.load(f)
+        store = cls(path, index['boxSize'], index['chunkSize'], index['dtype'],
+                    index['chunkCounts'])
+        store._positions = np.load(os.path.join(path, STORE_POSITIONS), mmap_mode='r')
+        store._valFlags = np.load(os.path.join(path, STORE_VAL_FLAGS), mmap_mode='r')
+        return store
+
+    def getBoxSize(self):
+        return self._boxSize
+
+    def getDtype(self):
+        return self._dtype
+
+    def getPositions(self):
+        return np.asarray(self._positions)
+
+    def getValFlags(self):
+        return np.asarray(self._valFlags, dtype=bool)
+
+    def _getChunkFn(self, chunkIndex):
+        return os.path.join(self._path, CHUNK_TEMPLATE % chunkIndex)
+
+    def append(self, subtomo0, subtomo1, position, isVal=False):
+        """ Write an odd/even pair to the current chunk, opening a new
+        chunk file when the current one is full. A float16 store raises
+        OverflowError if the pair does not fit in float16, without adding
+        it. """
+        if self._mode != 'w':
+            raise IOError('Subtomogram store %s is open read only.' % self._path)
+        if self._chunk is None or self._chunkCounts[-1] == self._chunkSize:
+            self._flushChunk()
+            shape = (self._chunkSize, 2) + (self._boxSize,) * 3
+            self._chunk = np.lib.format.open_memmap(self._getChunkFn(len(self._chunkCounts)),
+                                                    mode='w+', dtype=self._dtype, shape=shape)
+            self._chunkCounts.append(0)
+        n = self._chunkCounts[-1]
+        with np.errstate(over='ignore'):
+            self._chunk[n, 0] = subtomo0
+            self._chunk[n, 1] = subtomo1
+        if self._precision is not None:
+            self._precision.update(subtomo0, self._chunk[n, 0])
+            self._precision.update(subtomo1, self._chunk[n, 1])
+            if self._precision.overflow:
+                raise OverflowError('Subtomogram at %s out of the float16 range.'
+                                    % (tuple(int(p) for p in position),))
+        self._chunkCounts[-1] += 1
+        self._positions.append(position)
+        self._valFlags.append(bool(isVal))
+
+    def _flushChunk(self):
+        if self._chunk is not None:
+            self._chunk.flush()
+            self._chunk = None
+
+    def close(self):
+        """ Flush the last chunk and write the index. """
+        if self._mode != 'w':
+            return
+        self._flushChunk()
+        np.save(os.path.join(self._path, STORE_POSITIONS),
+                np.asarray(self._positions, dtype=np.int64).reshape(-1, 4))
+        np.save(os.path.join(self._path, STORE_VAL_FLAGS),
+                np.asarray(self._valFlags, dtype=bool))
+        with open(os.path.join(self._path, STORE_INDEX), 'w') as f:
+            json.dump({'boxSize': self._boxSize,
+                       'chunkSize': self._chunkSize,
+                       'dtype': self._dtype.str,
+                       'chunkCounts': self._chunkCounts}, f, indent=2)
+        self._mode = 'r'
+
+    def getPrecisionReport(self):
+        """ Conversion error of the pairs appended so far, or None if they
+        are stored without loss. """
+        return None if self._precision is None else self._precision.toDict()
+
+    def __len__(self):
+        return sum(self._chunkCounts)
+
+    def __getitem__(self, i):
+        """ Odd/even pair i as a (2, box, box, box) array. """
+        if not 0 <= i < len(self):
+            raise IndexError('Subtomogram %d out of range.' % i)
+        return np.array(self._readChunk(i // self._chunkSize)[i % self._chunkSize])
+
+    def _readChunk(self, chunkIndex):
+        chunk = np.load(self._getChunkFn(chunkIndex), mmap_mode='r')
+        return chunk[:self._chunkCounts[chunkIndex]]
+
+    def iterChunks(self):
+        """ Yield (firstIndex, chunk) with each chunk memory mapped. """
+        first = 0
+        for chunkIndex, count in enumerate(self._chunkCounts):
+            yield first, self._readChunk(chunkIndex)
+            first += count
+
+    def exportNpz(self, fnTrain, fnVal, dtype=None):
+        """ Write the training and validation pairs to the .npz files read
+        by the fit tool, as dtype or the store type. The arrays are streamed
+        chunk by chunk. """
+        valFlags = self.getValFlags()
+        dtype = self._dtype if dtype is None else np.dtype(dtype)
+        for fn, selected in [(fnTrain, ~valFlags), (fnVal, valFlags)]:
+            with zipfile.ZipFile(fn, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for key, half in [('subtomos0', 0), ('subtomos1', 1)]:
+                    with zf.open(key + '.npy', 'w', force_zip64=True) as f:
+                        self._writeHalf(f, half, selected, dtype)
+
+    def _writeHalf(self, f, half, selected, dtype):
+        shape = (int(selected.sum()),) + (self._boxSize,) * 3
+        np.lib.format.write_array_header_2_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                 'fortran_order': False,
+                                                 'shape': shape})
+        for first, chunk in self.iterChunks():
+            mask = selected[first:first + len(chunk)]
+            if mask.any():
+                f.write(np.ascontiguousarray(chunk[mask, half], dtype=dtype).tobytes())
+
+    def computeMeanStd(self, valFlag=False, batchSize=16):
+        """ Mean and standard deviation of the selected pairs. They are read
+        in batches of batchSize pairs as float32, and the count, mean and
+        sum of squared deviations of every batch are merged in float64. """
+        valFlags = self.getValFlags()
+        stats = (0, 0.0, 0.0)
+        for first, chunk in self.iterChunks():
+            indexes = np.flatnonzero(valFlags[first:first + len(chunk)] == valFlag)
+            for start in range(0, len(indexes), batchSize):
+                data = np.asarray(chunk[indexes[start:start + batchSize]], dtype=np.float32)
+                mean = data.mean(dtype=np.float64)
+                m2 = np.square(data - np.float32(mean)).sum(dtype=np.float64)
+                stats = mergeStats(stats, (data.size, mean, m2))
+        count, mean, m2 = stats
+        if not count:
+            return 0.0, 1.0
+        return mean, np.sqrt(m2 / count)
+
+
+def extractSubtomos(store, fnTomo0, fnTomo1, positions, valFraction=0., tomoIndex=0, seed=0):
+    """ Extract the odd/even boxes at the given corners from memory mapped
+    tomograms and append them to the store. Returns the number of pairs. """
+    rng = np.random.default_rng(seed + tomoIndex)
+    box = store.getBoxSize()
+    with mrcfile.mmap(fnTomo0, mode='r', permissive=True) as mrc0, \
+            mrcfile.mmap(fnTomo1, mode='r', permissive=True) as mrc1:
+        for z, y, x in positions:
+            sl = np.s_[z:z + box, y:y + box, x:x + box]
+            store.append(mrc0.data[sl], mrc1.data[sl], (tomoIndex, z, y, x),
+                         isVal=rng.random() < valFraction)
+    return len(positions)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import os
+
+import numpy as np
+import mrcfile
+
+from .normalization import HeaderStats
+
+SLAB_SIZE = 16
+
+
+def getTileStarts(dim, tileSize, overlap):
+    """ Start of the tiles covering one axis, with at least overlap voxels
+    shared by neighbouring tiles. The last tile is aligned to the end. """
+    if dim <= tileSize:
+        return [0]
+    step = max(1, tileSize - overlap)
+    starts = list(range(0, dim - tileSize, step))
+    starts.append(dim - tileSize)
+    return starts
+
+
+def getTiles(shape, tileSize, overlap):
+    """ Slices of the overlapping tiles covering a (z, y, x) volume. """
+    tiles = []
+    sizes = [min(tileSize, dim) for dim in shape]
+    for z in getTileStarts(shape[0], tileSize, overlap):
+        for y in getTileStarts(shape[1], tileSize, overlap):
+            for x in getTileStarts(shape[2], tileSize, overlap):
+                tiles.append(np.s_[z:z + sizes[0], y:y + sizes[1], x:x + sizes[2]])
+    return tiles
+
+
+def getBlendWeights(tileShape, overlap):
+    """ Separable weights ramping up linearly over the overlap at each tile
+    border, so overlapping tiles are cross-faded. They never reach zero, as
+    the borders of the volume are covered by one tile only. """
+    weights = []
+    for dim in tileShape:
+        ramp = min(overlap, dim // 2)
+        w = np.ones(dim, dtype=np.float32)
+        if ramp > 0:
+            edge = np.arange(1, ramp + 1, dtype=np.float32) / (ramp + 1)
+            w[:ramp] = edge
+            w[dim - ramp:] = edge[::-1]
+        weights.append(w)
+    return weights[0][:, None, None] * weights[1][None, :, None] * weights[2][None, None, :]
+
+
+def writeTile(fnIn, tile, fnOut, scale=1., offset=0.):
+    """ Write one tile of a memory mapped volume to its own MRC file,
+    optionally mapped by scale * value + offset. """
+    with mrcfile.mmap(fnIn, mode='r', permissive=True) as mrc:
+        data = np.asarray(mrc.data[tile], dtype=np.float32)
+        if scale != 1. or offset != 0.:
+            data = data * np.float32(scale) + np.float32(offset)
+        with mrcfile.new(fnOut, data=data, overwrite=True) as mrcOut:
+            mrcOut.voxel_size = mrc.voxel_size
+
+
+def pasteRoi(fnRoi, roi, shape, fnOut, fill=0., voxelSize=None, slabSize=SLAB_SIZE):
+    """ Write a full size volume filled with a constant, with the content
+    of fnRoi pasted at the given slices. The output is written in slabs of
+    sections, which also give the header statistics. """
+    stats = HeaderStats()
+    with mrcfile.new_mmap(fnOut, shape=tuple(shape), mrc_mode=2, fill=fill,
+                          overwrite=True) as mrcOut:
+        with mrcfile.mmap(fnRoi, mode='r', permissive=True) as mrc:
+            zRoi = roi[0]
+            for z in range(0, shape[0], slabSize):
+                zEnd = min(z + slabSize, shape[0])
+                z0, z1 = max(z, zRoi.start), min(zEnd, zRoi.stop)
+                if z0 < z1:
+                    mrcOut.data[z0:z1, roi[1], roi[2]] = mrc.data[z0 - zRoi.start:z1 - zRoi.start]
+                stats.update(mrcOut.data[z:zEnd])
+        if voxelSize is not None:
+            mrcOut.voxel_size = voxelSize
+        stats.setHeader(mrcOut)
+
+
+class TileBlender:
+    """ Accumulate refined tiles into a memory mapped output MRC, weighting
+    the overlaps, so only one tile is in memory at a time. The weight sum
+    lives in a temporary memory mapped file next to the output. """
+
+    def __init__(self, fnOut, shape, overlap, voxelSize=None):
+        self._fnOut = fnOut
+        self._fnWeights = fnOut + '.weights'
+        self._overlap = overlap
+        self._mrc = mrcfile.new_mmap(fnOut, shape=tuple(shape), mrc_mode=2, fill=0, overwrite=True)
+        if voxelSize is not None:
+            self._mrc.voxel_size = voxelSize
+        self._weights = np.memmap(self._fnWeights, dtype=np.float32, mode='w+', shape=tuple(shape))
+
+    def add(self, tile, data):
+        w = getBlendWeights(data.shape, self._overlap)
+        self._mrc.data[tile] += data * w
+        self._weights[tile] += w
+
+    def close(self):
+        """ Normalize by the accumulated weights section by section, which
+        also gives the header statistics, and close. """
+        stats = HeaderStats()
+        for z in range(self._mrc.data.shape[0]):
+            weights = self._weights[z]
+            self._mrc.data[z] /= np.where(weights > 0, weights, 1)
+            stats.update(self._mrc.data[z])
+        stats.setHeader(self._mrc)
+        self._mrc.close()
+        del self._weights
+        os.remove(self._fnWeights)
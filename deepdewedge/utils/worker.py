@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'worker_server.py')
+
+
+def getSocketPath(key):
+    """ Unix socket paths are limited to ~100 characters, so they live in
+    the temporary folder instead of the, often deep, run folder. """
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'ddw_worker_%s.sock' % digest)
+
+
+class WorkerClient:
+    """ Client of a worker_server.py process listening on a Unix socket. """
+
+    def __init__(self, socketPath):
+        self._socketPath = socketPath
+
+    def _request(self, request, timeout=None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(self._socketPath)
+            with conn.makefile('rw') as stream:
+                stream.write(json.dumps(request) + '\n')
+                stream.flush()
+                return json.loads(stream.readline())
+
+    def isAlive(self):
+        try:
+            return self._request({'command': 'ping'}, timeout=5)['returnCode'] == 0
+        except (OSError, ValueError):
+            return False
+
+    def run(self, argv, fnLog, cwd=None, env=None, fnMetrics=None):
+        """ Run a job and wait for it. Returns its exit code. """
+        return self._request({'argv': argv, 'cwd': cwd or os.getcwd(), 'env': env or {},
+                              'log': fnLog, 'metrics': fnMetrics})['returnCode']
+
+    def shutdown(self):
+        try:
+            self._request({'command': 'shutdown'}, timeout=5)
+        except (OSError, ValueError):
+            pass
+
+
+def startWorker(launchCmd, socketPath, env=None, fnLog=None, timeout=300):
+    """ Launch a worker with a shell command that ends by running
+    worker_server.py on socketPath, and wait until it answers. Returns the
+    client, or None if the worker did not come up in time. """
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    with open(fnLog or os.devnull, 'a') as fLog:
+        process = subprocess.Popen(launchCmd, shell=True, env=env, stdout=fLog,
+                                   stderr=subprocess.STDOUT, start_new_session=True)
+    client = WorkerClient(socketPath)
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if process.poll() is not None:
+            return None
+        if os.path.exists(socketPath) and client.isAlive():
+            return client
+        time.sleep(0.5)
+    process.kill()
+    return None
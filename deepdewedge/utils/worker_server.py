@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Long lived deepdewedge worker. It is started once inside the deepdewedge
+environment, imports the command line entry point (and with it torch)
+and then serves jobs over a Unix socket. Every job is run in a forked
+child, so it starts with the imports already done, can use its own
+CUDA_VISIBLE_DEVICES and cannot leave state behind. The connections are
+served by threads, but every fork is done by the main thread, which only
+dispatches the forks and holds no lock while forking, instead of by the
+connection threads. This file is run as a
+standalone script and only depends on the standard library:
+
+    python worker_server.py SOCKET [--entry module:function | file.py:function]
+                            [--preload torch] [--parent-pid PID]
+
+Requests are one JSON line with argv, cwd, env, log and metrics, and the
+reply is one JSON line with the return code. The job output is saved in
+the log file with the elapsed time of every line, and its wall time, peak
+memory and I/O in the metrics file, in the same format as monitor.py.
+As there, creating the stop file (the metrics file with a .stop
+extension) interrupts the job, escalating to SIGTERM and SIGKILL if it is
+still running after STOP_GRACE_SECONDS, and the job counts as a success
+if it ended because of the stop. The metrics keep its real return code.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+
+PING = 'ping'
+SHUTDOWN = 'shutdown'
+PARENT_CHECK_SECONDS = 5
+STOP_CHECK_SECONDS = 0.5
+STOP_GRACE_SECONDS = 30
+STOP_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
+
+
+def loadEntry(entry):
+    """ Load the job entry point. By default, the 'ddw' console script. """
+    if entry is None:
+        from importlib.metadata import entry_points
+        return [ep for ep in entry_points(group='console_scripts') if ep.name == 'ddw'][0].load()
+    module, func = entry.rsplit(':', 1)
+    if module.endswith('.py'):
+        spec = importlib.util.spec_from_file_location('worker_entry', module)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    else:
+        mod = importlib.import_module(module)
+    return getattr(mod, func)
+
+
+def _runChild(main, request, writeFd):
+    """ Body of the forked child: run the entry point as the command line
+    would, with its output going to the pipe. """
+    try:
+        os.dup2(writeFd, 1)
+        os.dup2(writeFd, 2)
+        os.chdir(request.get('cwd') or os.getcwd())
+        os.environ.update(request.get('env', {}))
+        sys.argv = ['ddw'] + request['argv']
+        code = 0
+        try:
+            main()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def _saveTimedLog(readFd, fnLog, t0):
+    with os.fdopen(readFd, 'rb') as stream, open(fnLog, 'w') as fLog:
+        for line in stream:
+            for part in line.replace(b'\r', b'\n').split(b'\n'):
+                if part.strip():
+                    fLog.write('%0.3f\t%s\n' % (time.time() - t0, part.decode(errors='replace')))
+                    fLog.flush()
+
+
+def _watchStopFile(pid, fnStop, done, stopSignals):
+    """ Once the stop file exists, send the next of STOP_SIGNALS to the job
+    every STOP_GRACE_SECONDS until it ends, adding them to stopSignals. """
+    signalTime = None
+    while not done.wait(STOP_CHECK_SECONDS) and len(stopSignals) < len(STOP_SIGNALS):
+        if os.path.exists(fnStop) and \
+                (signalTime is None or time.time() - signalTime > STOP_GRACE_SECONDS):
+            sig = STOP_SIGNALS[len(stopSignals)]
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                return
+            stopSignals.append(sig)
+            signalTime = time.time()
+
+
+def getExitCode(returnCode, stopSignals):
+    """ Exit code of the job: 0 if it was stopped and ended cleanly or by one
+    of the stop signals, its return code otherwise. """
+    stopCodes = {0} | {-sig for sig in stopSignals} | {128 + sig for sig in stopSignals}
+    return 0 if stopSignals and returnCode in stopCodes else returnCode
+
+
+def startJob(main, request):
+    """ Fork the child of a job. Returns its pid and the read end of its
+    output pipe. Only called from the dispatcher. """
+    readFd, writeFd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readFd)
+        _runChild(main, request, writeFd)
+    os.close(writeFd)
+    return pid, readFd
+
+
+class Dispatcher:
+    """ Queue of the jobs to fork, served by the thread calling serveForever. """
+
+    def __init__(self, main):
+        self._main = main
+        self._queue = queue.Queue()
+
+    def start(self, request):
+        """ Have the job forked and wait for its pid and output pipe. """
+        reply = queue.Queue(maxsize=1)
+        self._queue.put((request, reply))
+        result = reply.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def serveForever(self):
+        while True:
+            request, reply = self._queue.get()
+            try:
+                reply.put(startJob(self._main, request))
+            except OSError as e:
+                reply.put(e)
+
+
+def runJob(dispatcher, request):
+    t0 = time.time()
+    pid, readFd = dispatcher.start(request)
+
+    done, stopSignals = threading.Event(), []
+    watcher = None
+    if request.get('metrics'):
+        fnStop = os.path.splitext(request['metrics'])[0] + '.stop'
+        watcher = threading.Thread(target=_watchStopFile, args=(pid, fnStop, done, stopSignals),
+                                   daemon=True)
+        watcher.start()
+    _saveTimedLog(readFd, request['log'], t0)
+    # Stop the watcher before reaping the child, so it never signals a reused pid
+    os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    done.set()
+    if watcher is not None:
+        watcher.join()
+    _, status, usage = os.wait4(pid, 0)
+    returnCode = os.waitstatus_to_exitcode(status)
+    if request.get('metrics'):
+        with open(request['metrics'], 'w') as f:
+            json.dump({'command': ' '.join(['ddw'] + request['argv']),
+                       'returnCode': returnCode,
+                       'stopped': bool(stopSignals),
+                       'stopSignal': stopSignals[-1].name if stopSignals else None,
+                       'wallTime': time.time() - t0,
+                       'peakRss': usage.ru_maxrss * 1024,
+                       'readBytes': usage.ru_inblock * 512,
+                       'writeBytes': usage.ru_oublock * 512}, f, indent=2)
+    return getExitCode(returnCode, stopSignals)
+
+
+def handle(conn, dispatcher, server):
+    with conn, conn.makefile('rw') as stream:
+        request = json.loads(stream.readline())
+        if request.get('command') == SHUTDOWN:
+            stream.write(json.dumps({'returnCode': 0}) + '\n')
+            stream.flush()
+            server.close()
+            os._exit(0)
+        code = 0 if request.get('command') == PING else runJob(dispatcher, request)
+        stream.write(json.dumps({'returnCode': code}) + '\n')
+
+
+def _watchParent(parentPid):
+    """ Exit when the process that started the worker is gone. """
+    while True:
+        time.sleep(PARENT_CHECK_SECONDS)
+        try:
+            os.kill(parentPid, 0)
+        except OSError:
+            os._exit(0)
+
+
+def serve(socketPath, entry=None, preload=(), parentPid=None):
+    for module in preload:
+        importlib.import_module(module)
+    main = loadEntry(entry)
+
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath + '.tmp')
+    os.rename(socketPath + '.tmp', socketPath)  # Clients only see a ready socket
+    server.listen()
+
+    if parentPid:
+        threading.Thread(target=_watchParent, args=(parentPid,), daemon=True).start()
+    dispatcher = Dispatcher(main)
+    threading.Thread(target=_accept, args=(server, dispatcher), daemon=True).start()
+    dispatcher.serveForever()
+
+
+def _accept(server, dispatcher):
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle, args=(conn, dispatcher, server), daemon=True).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket')
+    parser.add_argument('--entry')
+    parser.add_argument('--preload', nargs='*', default=[])
+    parser.add_argument('--parent-pid', type=int)
+    args = parser.parse_args()
+    serve(args.socket, args.entry, args.preload, args.parent_pid)
@@ -3,5 +3,3 @@
 # Module to declare wizards
 # Find documentation here: https://scipion-em.github.io/docs/release-3.0.0/docs/developer/tutorials/introduction-to-template-plugin.html#other-elements
 # **************************************************************************
-
-from .wizard_hello_world import MyPluginPrefixHelloWorldWizard